@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""Runs saved requests from the command line, without the web UI.
+
+    python o4cli.py NAME [NAME ...] [--collection C] [--env E] [--format json|junit]
+    python o4cli.py --workflow W [--env E] [--format json|junit]
+    python o4cli.py --list
+
+Reads the same store as o4rest.py and records the sends in its history
+(unless --no-history). The json backend's history log is indexed in memory
+by the server process, so with it the sends are not recorded. Exits with 0 if every request succeeded, 1 if any
+failed and 2 on usage errors, so it can gate cron jobs and CI pipelines.
+The engine is imported only after the arguments are parsed, and Flask not
+at all, to keep the startup overhead small.
+"""
+import argparse
+import json
+import sys
+import time
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run saved requests of the REST Client Tool.")
+    parser.add_argument("names", nargs="*", help="saved requests to run, in this order")
+    parser.add_argument("-c", "--collection", help="also run every saved request of this collection")
+    parser.add_argument("-W", "--workflow", help="run this workflow instead of single requests")
+    parser.add_argument("-e", "--env", help="environment whose variables fill in {{placeholders}}")
+    parser.add_argument("-f", "--format", choices=("json", "junit"), default="json", help="report format")
+    parser.add_argument("-o", "--output", help="write the report to this file instead of stdout")
+    parser.add_argument("-w", "--workers", type=int, help="max requests in flight")
+    parser.add_argument("--per-host", type=int, help="max requests in flight per upstream host")
+    parser.add_argument("--no-history", action="store_true", help="don't record the sends in history")
+    parser.add_argument("-l", "--list", action="store_true", help="list saved requests and exit")
+    return parser.parse_args(argv)
+
+
+def junit_report(results, elapsed, suite_name="resttool"):
+    """Formats results as JUnit XML: one testcase per saved request or workflow step."""
+    import xml.etree.ElementTree as ET
+
+    suite = ET.Element("testsuite", name=suite_name, tests=str(len(results)), time=f"{elapsed:.3f}")
+    failures = errors = skipped = 0
+    for result in results:
+        case = ET.SubElement(suite, "testcase", name=result.get("name") or result["id"],
+                             classname=result.get("collection") or result.get("request") or "saved",
+                             time=f"{(result.get('timing') or {}).get('total_ms', 0) / 1000.0:.3f}")
+        if "skipped" in result:
+            skipped += 1
+            ET.SubElement(case, "skipped", message=result["skipped"])
+        elif "error" in result:
+            errors += 1
+            ET.SubElement(case, "error", message=result["error"], type="send")
+        elif "extract_error" in result:
+            failures += 1
+            ET.SubElement(case, "failure", message=result["extract_error"], type="extract")
+        elif result.get("assertions"):
+            failed = [item for item in result["assertions"]["results"] if not item["passed"]]
+            if failed:
+                failures += 1
+                message = "; ".join(f"{item['assertion']} (got {item['actual']})" for item in failed)
+                ET.SubElement(case, "failure", message=message, type="assertion")
+        elif result.get("status_code", 500) >= 400:
+            failures += 1
+            ET.SubElement(case, "failure", message=f"HTTP {result['status_code']}", type="status")
+    suite.set("failures", str(failures))
+    suite.set("errors", str(errors))
+    suite.set("skipped", str(skipped))
+    root = ET.Element("testsuites")
+    root.append(suite)
+    return ET.tostring(root, encoding="unicode") + "\n"
+
+
+def write_report(report, output):
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        sys.stdout.write(report)
+
+
+def run_workflow(o4engine, args, saved, variables):
+    """Runs the workflow named by --workflow. Returns the exit status."""
+    _, _, _, workflow_store = o4engine.open_stores()
+    workflow = workflow_store.get(args.workflow)
+    if workflow is None:
+        print(f"Workflow not found: {args.workflow}", file=sys.stderr)
+        return 2
+    try:
+        plan = o4engine.WorkflowPlan(workflow, saved)
+    except ValueError as e:
+        print(f"Invalid workflow: {e}", file=sys.stderr)
+        return 2
+    workers = max(1, min(args.workers or o4engine.BATCH_DEFAULT_WORKERS, o4engine.BATCH_MAX_WORKERS))
+    per_host = max(1, args.per_host or o4engine.WORKFLOW_PER_HOST_LIMIT)
+
+    started = time.monotonic()
+    results = list(o4engine.run_workflow(plan, workers, per_host, record=not args.no_history, variables=variables))
+    elapsed = time.monotonic() - started
+    summary = o4engine.workflow_report(plan, results, elapsed)
+    if args.format == "junit":
+        report = junit_report(summary["steps"], elapsed, suite_name=args.workflow)
+    else:
+        report = json.dumps(dict(summary, workflow=args.workflow), indent=2, ensure_ascii=False) + "\n"
+    write_report(report, args.output)
+    return 0 if summary["passed"] else 1
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    import o4engine
+
+    saved_store, _, _, _ = o4engine.open_stores()
+    saved = saved_store.all()
+    if o4engine.STORAGE_BACKEND == "json" and not args.no_history:
+        # A running server would hand out the same ids again and misread its log
+        print("Not recording history: the json backend's history can't be shared with a server",
+              file=sys.stderr)
+        args.no_history = True
+    if args.list:
+        for name in sorted(saved):
+            item = saved[name]
+            collection = f" [{item['collection']}]" if item.get("collection") else ""
+            print(f"{name}{collection}\t{item.get('method', 'GET')} {item.get('url', '')}")
+        return 0
+
+    try:
+        variables = o4engine.load_environment(args.env)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.workflow:
+        if args.names or args.collection:
+            print("--workflow can't be combined with names or --collection", file=sys.stderr)
+            return 2
+        return run_workflow(o4engine, args, saved, variables)
+
+    jobs, missing = o4engine.select_saved(saved, args.names, args.collection)
+    if missing:
+        print(f"Saved requests not found: {', '.join(missing)}", file=sys.stderr)
+        return 2
+    if not jobs:
+        print("No saved requests selected; give names or a non-empty --collection", file=sys.stderr)
+        return 2
+    workers = max(1, min(args.workers or o4engine.BATCH_DEFAULT_WORKERS, o4engine.BATCH_MAX_WORKERS))
+    per_host = max(1, args.per_host or o4engine.BATCH_PER_HOST_LIMIT)
+
+    started = time.monotonic()
+    results = sorted(o4engine.run_batch(jobs, workers, per_host, record=not args.no_history, variables=variables),
+                     key=lambda result: result["index"])
+    elapsed = time.monotonic() - started
+    for result in results:
+        result["collection"] = saved[result["name"]].get("collection", "")
+    passed = sum(o4engine.send_succeeded(result) for result in results)
+
+    if args.format == "junit":
+        report = junit_report(results, elapsed)
+    else:
+        report = json.dumps({
+            "total": len(results),
+            "passed": passed,
+            "failed": len(results) - passed,
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "results": results,
+        }, indent=2, ensure_ascii=False) + "\n"
+    write_report(report, args.output)
+    return 0 if passed == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
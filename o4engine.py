@@ -0,0 +1,3332 @@
+"""Request engine of the REST Client Tool, without the web UI.
+
+Sends requests, keeps history, saved requests and response bodies, and runs
+batches and load tests. o4rest.py serves it over Flask; o4cli.py runs saved
+requests from the command line. Importing this module opens no files; the
+stores are opened by open_stores().
+"""
+import requests
+import atexit
+import bisect
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import random
+import re
+import secrets
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from importlib.util import find_spec
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NameResolutionError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+# Filenames for storing data
+SAVED_REQUESTS_FILE = 'saved_requests.json'
+SAVED_RECHECK_INTERVAL = 1.0 # Seconds between checks for outside edits of the file
+SAVED_CHANGE_LOG_SIZE = 1000 # Saved-request changes remembered for incremental updates
+ENVIRONMENTS_FILE = 'environments.json' # Named sets of {{variables}} (json backend)
+REQUEST_HISTORY_FILE = 'request_history.json' # Legacy format, migrated into the log
+REQUEST_HISTORY_DIR = 'request_history' # Append-only JSONL segments
+MAX_HISTORY_SIZE = 100000 # Entries kept in the history log
+HISTORY_SEGMENT_SIZE = 10000 # Entries per segment file before starting a new one
+
+# Storage backend: 'sqlite' (indexed, queryable) or 'json' (flat files above)
+STORAGE_BACKEND = 'sqlite'
+SQLITE_DB_FILE = 'resttool.db' # The JSON files are imported into it on first start
+
+# Write-behind persistence: store changes are written by a background thread
+PERSIST_WRITE_BEHIND = True # False writes every change before the request returns
+PERSIST_FLUSH_INTERVAL = 0.2 # Seconds of changes coalesced into one write
+HISTORY_ID_BLOCK = 1000 # History ids reserved at a time in the SQLite database
+
+# Request templates: {{variable}} placeholders in URL, headers and body
+TEMPLATE_CACHE_SIZE = 1024 # Compiled requests kept, keyed by their URL, headers and body
+
+# Response bodies
+RESPONSE_PREVIEW_BYTES = 1024 * 1024 # Body bytes kept in memory and shown in the panel
+RESPONSE_CHUNK_SIZE = 64 * 1024 # Bytes read from the upstream per chunk
+DOWNLOAD_TTL = 3600 # Seconds a spilled full body stays downloadable
+
+# Prometheus metrics (/metrics)
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Seconds
+
+# Record-and-replay response cache
+REPLAY_MODES = ("off", "record", "replay", "offline")
+REPLAY_TTL = 300 # Seconds a recorded response may be replayed (not applied in offline mode)
+REPLAY_CACHE_SIZE = 500 # Max recorded responses (least recently used are dropped)
+REPLAY_CACHE_MAX_BYTES = 64 * 1024 * 1024 # Max total body bytes held by the cache
+REPLAY_KEY_HEADERS = ("accept", "accept-encoding", "authorization", "content-type", "cookie") # Part of the fingerprint
+
+# Batch runs (/batch)
+BATCH_MAX_WORKERS = 16 # Upper bound on parallel sends per batch
+BATCH_DEFAULT_WORKERS = 8
+BATCH_PER_HOST_LIMIT = 2 # Default max in-flight sends to one upstream host
+
+# Workflows (/workflows)
+WORKFLOWS_FILE = 'workflows.json' # Workflow definitions (json backend)
+WORKFLOW_MAX_STEPS = 200
+WORKFLOW_PER_HOST_LIMIT = 8 # Default max in-flight steps against one upstream host
+
+# Response body store (history attachments)
+STORE_RESPONSE_BODIES = True # Keep full response bodies referenced from history
+RESPONSE_BLOB_DIR = 'response_blobs' # Content-addressed, zlib-compressed bodies
+RESPONSE_BLOB_LEVEL = 6 # zlib compression level (1 fastest .. 9 smallest)
+RESPONSE_BLOB_SEEK_INTERVAL = 1024 * 1024 # Uncompressed bytes between seek points
+RESPONSE_BLOB_GRACE = 3600 # Seconds an unreferenced blob is kept (its history entry may not be written yet)
+
+# Load test limits
+LOADTEST_MAX_CONCURRENCY = 200 # Upper bound on worker threads per load test
+LOADTEST_MAX_DURATION = 300 # Seconds; the /loadtest call blocks until done
+LOADTEST_MAX_RATE = 5000 # Requests per second, upper bound for open-loop profiles
+LOADTEST_PROFILES = ("constant", "ramp", "step", "spike") # Open-loop arrival rate shapes
+
+# Outbound connection pooling
+SESSION_POOL_SIZE = 10 # Max keep-alive connections kept per upstream host
+SESSION_IDLE_TIMEOUT = 60 # Seconds before an unused host session is closed
+
+# Outbound client engines: "http1" uses requests, "http2" uses httpx (optional)
+HTTP_ENGINES = ("http1", "http2")
+
+# Timeouts and retries of outbound sends (overridable per request / saved request)
+DEFAULT_CONNECT_TIMEOUT = 10 # Seconds to establish a connection
+DEFAULT_READ_TIMEOUT = 10 # Seconds to wait for the next bytes from the upstream
+MAX_TIMEOUT = 3600 # Upper bound for any timeout or deadline
+RETRY_MAX = 10 # Upper bound for "retries"
+RETRY_DEFAULT_STATUSES = (502, 503, 504) # Upstream statuses retried when "retry_on" is not given
+RETRY_BACKOFF_BASE = 0.2 # Seconds; the backoff cap doubles on every retry
+RETRY_BACKOFF_MAX = 10 # Seconds; largest pause between attempts
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"} # Only these are retried
+
+# --- Metrics ---
+class Metrics:
+    """Minimal thread-safe Prometheus registry (counters, gauges, histograms).
+
+    Rendered in the text exposition format by /metrics. Kept in-process so
+    the tool needs no extra dependency.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._meta = {} # name -> (type, help)
+        self._values = {} # name -> {label tuple: value or histogram state}
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+        self._values.setdefault(name, {})
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, amount=1):
+        """Adds to a counter, or to a gauge (amount may be negative)."""
+        key = self._key(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                state["buckets"][index] += 1
+            state["sum"] += seconds
+            state["count"] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """Observes the duration of the with-block into a histogram."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - t0)
+
+    @staticmethod
+    def _format_labels(pairs):
+        if not pairs:
+            return ""
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in self._values[name].items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._format_labels(key)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, value["buckets"]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._format_labels(key + (('le', repr(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{self._format_labels(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{self._format_labels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{self._format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_LATENCY_BUCKETS)
+metrics.describe("resttool_outbound_request_duration_seconds", "histogram",
+                 "Duration of requests sent to upstreams, including body download.")
+metrics.describe("resttool_outbound_errors_total", "counter",
+                 "Outbound requests that got no response, by kind (timeout, connection, other).")
+metrics.describe("resttool_outbound_in_flight", "gauge", "Outbound requests currently in progress.")
+metrics.describe("resttool_outbound_retries_total", "counter", "Outbound requests repeated by the retry policy.")
+metrics.describe("resttool_store_write_duration_seconds", "histogram", "Latency of store writes; with write-behind, of each batched flush.")
+metrics.describe("resttool_response_blobs_removed_total", "counter",
+                 "Recorded response bodies deleted after their history entries were dropped.")
+metrics.describe("resttool_store_write_errors_total", "counter", "Failed writes of JSON data files.")
+metrics.describe("resttool_assertions_total", "counter", "Response assertions evaluated, by outcome (pass, fail).")
+metrics.describe("resttool_replay_cache_total", "counter", "Replay cache lookups by result (hit, miss).")
+
+def status_class(status_code):
+    """Groups an HTTP status for metric labels, e.g. 404 -> "4xx"."""
+    return f"{status_code // 100}xx" if status_code else "none"
+
+# --- Helper functions for file handling ---
+def load_data(filename, default_data):
+    """Loads data from a JSON file. Creates the file if it doesn't exist.
+
+    A file that is not valid JSON is moved aside to <filename>.corrupt-<time>
+    rather than overwritten, so nothing is lost; the defaults are returned.
+    """
+    if not os.path.exists(filename):
+        save_data(filename, default_data)
+        return default_data
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        backup = f"{filename}.corrupt-{datetime.utcnow():%Y%m%dT%H%M%S}"
+        os.replace(filename, backup)
+        print(f"Warning: {filename} is not valid JSON; moved it to {backup} and started empty")
+        return default_data
+
+def save_data(filename, data):
+    """Saves data to a JSON file atomically.
+
+    The JSON is written to a temp file in the same directory, flushed to disk
+    and renamed over the target, so readers and crashes only ever see the old
+    or the new file, never a truncated one. Raises OSError if the write fails.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    temp_name = None
+    try:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, prefix=".tmp-",
+                                         suffix=".json", delete=False) as f:
+            temp_name = f.name
+            json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, filename)
+    except OSError as e:
+        metrics.inc("resttool_store_write_errors_total", {"file": os.path.basename(filename)})
+        print(f"Error saving data to {filename}: {e}")
+        if temp_name and os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+# --- Per-phase timing ---
+# send_request() puts a dict in _phase_timing.current while it runs; the
+# connection classes below add DNS, TCP connect and TLS durations to it when
+# a new connection has to be opened. Reused connections leave them at 0.
+_phase_timing = threading.local()
+
+class _TimedConnectionMixin:
+    def _new_conn(self):
+        timing = getattr(_phase_timing, "current", None)
+        if timing is None:
+            return super()._new_conn()
+        t0 = time.perf_counter()
+        try:
+            # Resolve separately so DNS time can be told apart from TCP connect
+            infos = socket.getaddrinfo(self._dns_host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        t1 = time.perf_counter()
+        timing["dns"] = t1 - t0
+        dns_host = self._dns_host
+        last_error = None
+        try:
+            # Try each address in order, like create_connection() would
+            for address in dict.fromkeys(info[4][0] for info in infos):
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except NewConnectionError as e:
+                    last_error = e
+            else:
+                raise last_error
+        finally:
+            self._dns_host = dns_host
+        timing["connect"] = time.perf_counter() - t1
+        return sock
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        timing = getattr(_phase_timing, "current", None)
+        t0 = time.perf_counter()
+        super().connect()
+        if timing is not None:
+            # Whatever connect() spent beyond DNS + TCP was the TLS handshake
+            timing["tls"] = max(0.0, time.perf_counter() - t0 - timing["dns"] - timing["connect"])
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose connections report per-phase timing."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+def timing_summary(timing, t_start, t_headers, t_end, body_bytes):
+    """Turns raw phase durations into the millisecond breakdown for results."""
+    def ms(seconds):
+        return round(seconds * 1000.0, 3)
+    summary = {
+        "dns_ms": ms(timing["dns"]),
+        "connect_ms": ms(timing["connect"]),
+        "tls_ms": ms(timing["tls"]),
+        "total_ms": ms(t_end - t_start),
+    }
+    if t_headers is not None:
+        setup = timing["dns"] + timing["connect"] + timing["tls"]
+        download = t_end - t_headers
+        summary.update({
+            "ttfb_ms": ms(t_headers - t_start), # From start of the send, like curl
+            "wait_ms": ms(max(0.0, t_headers - t_start - setup)), # Request sent -> first byte
+            "download_ms": ms(download),
+            "bytes_per_sec": round(body_bytes / download, 1) if download > 0 else None,
+        })
+    return summary
+
+# --- Outbound session pool ---
+# One shared requests.Session per scheme+host, so repeated calls to the same
+# upstream reuse keep-alive connections instead of a new TCP/TLS handshake.
+# The sessions are shared by every user and send, so they keep no cookies:
+# a Set-Cookie from one response must not be sent with the next request.
+NO_COOKIES = DefaultCookiePolicy(allowed_domains=[]) # Accepts and returns no cookies
+_session_pool = {} # "scheme://host:port" -> pool entry (see get_session)
+_session_pool_lock = threading.Lock()
+
+def _host_key(url):
+    """Returns the pool key (scheme://host:port) for a URL."""
+    parts = urlsplit(url)
+    scheme = (parts.scheme or "http").lower()
+    port = parts.port or (443 if scheme == "https" else 80)
+    return f"{scheme}://{(parts.hostname or '').lower()}:{port}"
+
+def _evict_idle_sessions(now):
+    """Closes host sessions that have been idle too long. Caller holds the lock."""
+    for key, entry in list(_session_pool.items()):
+        if entry["in_use"] == 0 and now - entry["last_used"] > SESSION_IDLE_TIMEOUT:
+            del _session_pool[key]
+            entry["session"].close()
+
+def get_session(url):
+    """Checks out the shared Session for the URL's host. Pair with release_session()."""
+    key = _host_key(url)
+    now = time.monotonic()
+    with _session_pool_lock:
+        _evict_idle_sessions(now)
+        entry = _session_pool.get(key)
+        if entry is None:
+            session = requests.Session()
+            session.cookies.set_policy(NO_COOKIES)
+            adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=SESSION_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            entry = {
+                "session": session,
+                "in_use": 0,
+                "last_used": now,
+                # Sockets seen before; a hit means the connection was reused
+                "sockets": weakref.WeakSet(),
+            }
+            _session_pool[key] = entry
+        entry["in_use"] += 1
+        entry["last_used"] = now
+    return entry
+
+def release_session(entry):
+    """Returns a session checked out with get_session() to the pool."""
+    with _session_pool_lock:
+        entry["in_use"] -= 1
+        entry["last_used"] = time.monotonic()
+
+def connection_was_reused(entry, resp):
+    """Tells whether a streamed response came over an already used socket."""
+    sock = getattr(getattr(resp.raw, "connection", None), "sock", None)
+    if sock is None:
+        return None
+    with _session_pool_lock:
+        reused = sock in entry["sockets"]
+        entry["sockets"].add(sock)
+    return reused
+
+# --- HTTP/2 client pool ---
+# Sends with engine "http2" go through one httpx.Client per host. httpx
+# negotiates h2 over TLS (ALPN) and multiplexes concurrent sends to the host
+# as streams of one connection; servers without h2, and plain http:// URLs,
+# are spoken to over HTTP/1.1. The engine needs httpx with the h2 extra
+# (`pip install "httpx[http2]"`); it is imported on first use only, since
+# importing it costs more than everything else a CLI run needs.
+HTTP2_AVAILABLE = find_spec("httpx") is not None and find_spec("h2") is not None
+httpx = None # The module, once load_httpx() has run
+# Exceptions of the HTTP/2 engine; empty tuples match nothing until it is loaded
+HTTPX_CONNECT_TIMEOUT_ERRORS = ()
+HTTPX_TIMEOUT_ERRORS = ()
+HTTPX_REQUEST_ERRORS = ()
+_h2_clients = {} # "scheme://host:port" -> httpx.Client
+_h2_clients_lock = threading.Lock()
+
+def load_httpx():
+    """Imports httpx and its exception types. Caller holds _h2_clients_lock."""
+    global httpx, HTTPX_CONNECT_TIMEOUT_ERRORS, HTTPX_TIMEOUT_ERRORS, HTTPX_REQUEST_ERRORS
+    if httpx is None:
+        import httpx as module
+        HTTPX_CONNECT_TIMEOUT_ERRORS = (module.ConnectTimeout, module.PoolTimeout)
+        HTTPX_TIMEOUT_ERRORS = (module.TimeoutException,)
+        HTTPX_REQUEST_ERRORS = (module.HTTPError, module.StreamError)
+        httpx = module
+
+def get_h2_client(url):
+    """Returns the shared HTTP/2-capable client for the URL's host."""
+    key = _host_key(url)
+    with _h2_clients_lock:
+        load_httpx()
+        client = _h2_clients.get(key)
+        if client is None:
+            client = httpx.Client(http2=True, cookies=CookieJar(NO_COOKIES), limits=httpx.Limits(
+                max_connections=SESSION_POOL_SIZE, keepalive_expiry=SESSION_IDLE_TIMEOUT))
+            _h2_clients[key] = client
+    return client
+
+def h2_trace(timing, events):
+    """httpx trace hook filling the phase timing dict.
+
+    httpx resolves and connects in one step, so DNS time is part of
+    "connect". Seen event names are added to `events`; no connect event
+    means the send went over an existing connection.
+    """
+    started = {}
+
+    def trace(event, info):
+        name, _, phase = event.rpartition(".")
+        if phase == "started":
+            started[name] = time.perf_counter()
+        elif phase == "complete" and name in started:
+            events.add(name)
+            if name == "connection.connect_tcp":
+                timing["connect"] = time.perf_counter() - started[name]
+            elif name == "connection.start_tls":
+                timing["tls"] = time.perf_counter() - started[name]
+    return trace
+
+# --- Spilled response bodies ---
+# Bodies larger than RESPONSE_PREVIEW_BYTES are written to temp files and
+# served from /download/<token> instead of being held in memory.
+_downloads = {} # token -> {"path", "content_type", "created"}
+_downloads_lock = threading.Lock()
+_download_dir = None
+
+def _expire_downloads(now):
+    """Deletes spilled bodies older than DOWNLOAD_TTL. Caller holds the lock."""
+    for token, item in list(_downloads.items()):
+        if now - item["created"] > DOWNLOAD_TTL:
+            del _downloads[token]
+            try:
+                os.remove(item["path"])
+            except OSError:
+                pass
+
+def new_download_file():
+    """Opens a temp file for a spilled body. Returns (token, file)."""
+    global _download_dir
+    with _downloads_lock:
+        _expire_downloads(time.monotonic())
+        if _download_dir is None:
+            _download_dir = tempfile.mkdtemp(prefix="resttool-downloads-")
+    token = secrets.token_urlsafe(16)
+    return token, open(os.path.join(_download_dir, token), "wb")
+
+def register_download(token, path, content_type):
+    with _downloads_lock:
+        _downloads[token] = {"path": path, "content_type": content_type, "created": time.monotonic()}
+
+def get_download(token):
+    with _downloads_lock:
+        return _downloads.get(token)
+
+class DeadlineExceeded(Exception):
+    """Raised when a send runs past its overall deadline."""
+
+def read_body(resp, keep_body=True, blob=None, chunks=None, deadline=None, spill_body=True):
+    """Reads a streamed response with bounded memory.
+
+    Up to RESPONSE_PREVIEW_BYTES are kept for display; the rest is written
+    to a temp file together with the preview (unless spill_body is False,
+    then it is only counted). With keep_body=False the body is only counted
+    (used for load tests). If a BlobWriter is given the full
+    body also goes to the blob store. `chunks` overrides the body iterator
+    (for httpx responses). Past `deadline` (time.monotonic() value) the read
+    is abandoned with DeadlineExceeded. Returns the result fields.
+    """
+    preview = bytearray()
+    total = 0
+    spill = None
+    token = None
+    if chunks is None:
+        chunks = resp.iter_content(RESPONSE_CHUNK_SIZE)
+    try:
+        for chunk in chunks:
+            if deadline is not None and time.monotonic() > deadline:
+                raise DeadlineExceeded()
+            total += len(chunk)
+            if blob is not None:
+                blob.write(chunk)
+            if not keep_body:
+                continue
+            if spill is None and len(preview) + len(chunk) <= RESPONSE_PREVIEW_BYTES:
+                preview += chunk
+                continue
+            if not spill_body:
+                preview += chunk[:RESPONSE_PREVIEW_BYTES - len(preview)]
+                continue
+            if spill is None:
+                token, spill = new_download_file()
+                spill.write(preview)
+                del preview[RESPONSE_PREVIEW_BYTES:]
+            spill.write(chunk)
+            if len(preview) < RESPONSE_PREVIEW_BYTES:
+                preview += chunk[:RESPONSE_PREVIEW_BYTES - len(preview)]
+    except BaseException:
+        if spill is not None:
+            spill.close()
+            os.remove(spill.name)
+        if blob is not None:
+            blob.abort()
+        raise
+    fields = {"body_bytes": total, "body_truncated": spill is not None or (keep_body and total > len(preview))}
+    if blob is not None:
+        fields["response_body"] = {
+            "sha256": blob.commit(),
+            "bytes": total,
+            "content_type": resp.headers.get("Content-Type", ""),
+        }
+    if keep_body:
+        # Mirror resp.text: declared charset, else a utf-8 best effort
+        fields["body"] = bytes(preview).decode(resp.encoding or "utf-8", errors="replace")
+    if spill is not None:
+        spill.close()
+        register_download(token, spill.name, resp.headers.get("Content-Type", "application/octet-stream"))
+        fields["download_url"] = f"/download/{token}"
+    return fields
+
+# --- Response body store ---
+class BlobWriter:
+    """Streams one body into the blob store: hashes and compresses as it goes.
+
+    Every seek_interval uncompressed bytes the compressor is fully flushed
+    and a seek point (uncompressed offset, compressed offset, newlines so
+    far) is recorded, so a byte range or line can later be decompressed
+    starting from the nearest point instead of from the top.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.size = 0
+        self.lines = 0
+        self._compressed = 0
+        self._points = [[0, 0, 0]]
+        self._hash = hashlib.sha256()
+        self._compressor = zlib.compressobj(store.level)
+        self._file = tempfile.NamedTemporaryFile(dir=store.directory, prefix=".tmp-", delete=False)
+
+    def _emit(self, data):
+        self._file.write(data)
+        self._compressed += len(data)
+
+    def write(self, chunk):
+        interval = self.store.seek_interval
+        while chunk:
+            if self.size and self.size % interval == 0 and self._points[-1][0] != self.size:
+                self._emit(self._compressor.flush(zlib.Z_FULL_FLUSH))
+                self._points.append([self.size, self._compressed, self.lines])
+            room = interval - self.size % interval
+            part, chunk = chunk[:room], chunk[room:]
+            self.size += len(part)
+            self.lines += part.count(b"\n")
+            self._hash.update(part)
+            self._emit(self._compressor.compress(part))
+
+    def commit(self):
+        """Finishes the blob. Returns its sha256; a body already stored is not written twice."""
+        self._emit(self._compressor.flush())
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self.store.path(digest)
+        try:
+            os.utime(path) # Deduplicated; a fresh mtime keeps sweep() off it until history refers to it
+            os.remove(self._file.name)
+            return digest
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index = {"size": self.size, "lines": self.lines, "points": self._points}
+        with tempfile.NamedTemporaryFile("w", dir=self.store.directory, prefix=".tmp-", delete=False) as f:
+            json.dump(index, f)
+        # Index first, so a blob that exists always has its index
+        os.replace(f.name, self.store.index_path(digest))
+        os.replace(self._file.name, path)
+        return digest
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except OSError:
+            pass
+
+class BlobStore:
+    """Content-addressed store of response bodies, zlib-compressed on disk.
+
+    Blobs are named by the SHA-256 of the uncompressed body, so identical
+    responses share one file and history entries only keep the digest. A
+    small JSON index next to each blob lists its seek points (see
+    BlobWriter); read_range() and line_offset() memory-map the blob and
+    decompress only from the nearest point. sweep() deletes the blobs that
+    no history entry refers to any more.
+    """
+
+    INDEX_CACHE_SIZE = 64
+
+    def __init__(self, directory, level, seek_interval):
+        self.directory = directory
+        self.level = level
+        self.seek_interval = seek_interval
+        self._indexes = OrderedDict() # digest -> parsed index, most recently used last
+        self._lock = threading.Lock()
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + ".z")
+
+    def index_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + ".idx")
+
+    def writer(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return BlobWriter(self)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def sweep(self, referenced, grace):
+        """Deletes blobs whose digest is not in `referenced` and that are
+        older than grace seconds, plus leftovers of interrupted writes.
+        Returns the number of blobs deleted."""
+        cutoff = time.time() - grace
+        removed = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            folder = os.path.join(self.directory, name)
+            if name.startswith(".tmp-"):
+                self._remove_older(folder, cutoff)
+                continue
+            if not os.path.isdir(folder):
+                continue
+            for filename in os.listdir(folder):
+                digest, ext = os.path.splitext(filename)
+                if ext == ".idx" and not os.path.exists(self.path(digest)):
+                    self._remove_older(os.path.join(folder, filename), cutoff) # Blob never committed
+                if ext != ".z" or digest in referenced:
+                    continue
+                if self._remove_older(os.path.join(folder, filename), cutoff):
+                    removed += 1
+                    with self._lock:
+                        self._indexes.pop(digest, None)
+                    self._remove_older(self.index_path(digest), time.time())
+        return removed
+
+    @staticmethod
+    def _remove_older(path, cutoff):
+        """Deletes a file last modified before cutoff. Returns True if it did."""
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                return False
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def iter_chunks(self, digest, chunk_size=RESPONSE_CHUNK_SIZE):
+        """Yields the decompressed body in chunks."""
+        decompressor = zlib.decompressobj()
+        with open(self.path(digest), "rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                out = decompressor.decompress(data)
+                if out:
+                    yield out
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+    def index(self, digest):
+        """Returns {"size", "lines", "points"}; size/lines are None if the blob has no index."""
+        with self._lock:
+            cached = self._indexes.get(digest)
+            if cached is not None:
+                self._indexes.move_to_end(digest)
+                return cached
+        try:
+            with open(self.index_path(digest), "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (IOError, json.JSONDecodeError):
+            # No seek points: everything is read from the start
+            index = {"size": None, "lines": None, "points": [[0, 0, 0]]}
+        with self._lock:
+            self._indexes[digest] = index
+            while len(self._indexes) > self.INDEX_CACHE_SIZE:
+                self._indexes.popitem(last=False)
+        return index
+
+    def _iter_from(self, digest, point):
+        """Yields decompressed chunks starting at a seek point [uoffset, coffset, lines]."""
+        with open(self.path(digest), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # The first point includes the zlib header; later ones are raw deflate
+                decompressor = zlib.decompressobj() if point[1] == 0 else zlib.decompressobj(-zlib.MAX_WBITS)
+                position = point[1]
+                while position < len(mapped):
+                    data = mapped[position:position + RESPONSE_CHUNK_SIZE]
+                    position += len(data)
+                    out = decompressor.decompress(data)
+                    if out:
+                        yield out
+                    if decompressor.eof:
+                        return
+                tail = decompressor.flush()
+                if tail:
+                    yield tail
+
+    def read_range(self, digest, offset, length):
+        """Returns up to `length` bytes of the body starting at `offset`."""
+        points = self.index(digest)["points"]
+        point = points[bisect.bisect_right([p[0] for p in points], offset) - 1]
+        position = point[0]
+        parts = []
+        wanted = length
+        for chunk in self._iter_from(digest, point):
+            if position + len(chunk) <= offset:
+                position += len(chunk)
+                continue
+            start = max(0, offset - position)
+            part = chunk[start:start + wanted]
+            parts.append(part)
+            wanted -= len(part)
+            position += len(chunk)
+            if wanted <= 0:
+                break
+        return b"".join(parts)
+
+    def line_offset(self, digest, line):
+        """Returns the byte offset where 0-based line `line` starts, or None past the end."""
+        if line <= 0:
+            return 0
+        points = self.index(digest)["points"]
+        # Start from the last point with fewer than `line` newlines before it
+        point = points[max(0, bisect.bisect_left([p[2] for p in points], line) - 1)]
+        position, remaining = point[0], line - point[2]
+        for chunk in self._iter_from(digest, point):
+            count = chunk.count(b"\n")
+            if count < remaining:
+                remaining -= count
+                position += len(chunk)
+                continue
+            found = -1
+            for _ in range(remaining):
+                found = chunk.index(b"\n", found + 1)
+            return position + found + 1
+        return None
+
+blob_store = BlobStore(RESPONSE_BLOB_DIR, RESPONSE_BLOB_LEVEL, RESPONSE_BLOB_SEEK_INTERVAL)
+_blob_sweep_lock = threading.Lock()
+BLOB_DIGEST_PATTERN = re.compile(rb'"sha256": "([0-9a-f]{64})"') # response_body references in history JSON
+
+def sweep_blobs(history):
+    """Deletes, in a background thread, the bodies no entry of `history` refers to.
+
+    History stores call it after dropping old entries. A sweep already
+    running makes this a no-op; the next trim catches up.
+    """
+    def run():
+        if not _blob_sweep_lock.acquire(blocking=False):
+            return
+        try:
+            removed = blob_store.sweep(history.blob_digests(), RESPONSE_BLOB_GRACE)
+            metrics.inc("resttool_response_blobs_removed_total", amount=removed)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error removing unreferenced response bodies: {e}")
+        finally:
+            _blob_sweep_lock.release()
+    threading.Thread(target=run, name="blob-sweep", daemon=True).start()
+
+# --- Outbound request execution ---
+def parse_headers(headers):
+    """Returns headers as a dict. Saved requests keep them as a JSON string."""
+    if isinstance(headers, dict):
+        return headers
+    if headers is None:
+        return {}
+    if not isinstance(headers, str):
+        raise ValueError("Headers must be a JSON object")
+    if not headers.strip():
+        return {}
+    parsed = json.loads(headers)
+    if not isinstance(parsed, dict):
+        raise ValueError("Headers must be a JSON object")
+    return parsed
+
+def send_request(method, url, headers, body, keep_body=True, store_body=False, engine="http1",
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT), deadline=None, spill_body=True):
+    """Sends one request upstream through the session pool.
+
+    Returns (result, status_code): the dict shown in the response panel and
+    the HTTP status to answer with (408/503/500 for failed attempts). The
+    body is read with bounded memory, see read_body(). With store_body the
+    full body is put in the blob store and referenced as result["response_body"].
+    engine "http2" sends through httpx (see get_h2_client) if it is installed,
+    otherwise falls back to HTTP/1.1 with a warning in the result. timeout
+    is (connect, read) seconds; deadline (time.monotonic() value) also bounds
+    the body download. spill_body=False keeps just the preview of large
+    bodies (for assertions in bulk runs). See send_with_retries() for retries.
+    """
+    result = {}
+    status_code = 500 # Default for unexpected errors
+    connection_reused = None
+    timing = {"dns": 0.0, "connect": 0.0, "tls": 0.0}
+    t_headers = None
+    body_bytes = 0
+    http_version = None
+    warning = None
+
+    error_kind = None
+    host = urlsplit(url).hostname or ""
+    if engine == "http2" and not HTTP2_AVAILABLE:
+        engine = "http1"
+        warning = 'HTTP/2 engine not available (pip install "httpx[http2]"); sent with HTTP/1.1.'
+
+    pool_entry = get_session(url) if engine == "http1" else None
+    _phase_timing.current = timing
+    metrics.inc("resttool_outbound_in_flight", amount=1)
+    t_start = time.perf_counter()
+    try:
+        # Send body as JSON if Content-Type is application/json
+        # Otherwise send as raw data (string)
+        kwargs = {
+            "headers": headers,
+            "timeout": timeout # (connect, read)
+        }
+        if body:
+            # Try to parse as JSON only if Content-Type header is set correctly
+            if str(headers.get("Content-Type", "")).lower().strip() == "application/json":
+                try:
+                    # Use json= for requests library to handle serialization and Content-Type
+                    kwargs["json"] = json.loads(body)
+                except json.JSONDecodeError:
+                    # If it's not valid JSON but header is set, send as data anyway? Or error?
+                    # Sending as data here. Ensure it's bytes.
+                     kwargs["data"] = body.encode('utf-8')
+            else:
+                 # Ensure body is bytes for the data argument
+                 kwargs["data"] = body.encode('utf-8')
+
+        if engine == "http2":
+            if "data" in kwargs:
+                kwargs["content"] = kwargs.pop("data") # httpx name for a raw body
+            client = get_h2_client(url)
+            kwargs["timeout"] = httpx.Timeout(connect=timeout[0], read=timeout[1], write=timeout[1], pool=timeout[0])
+            events = set()
+            resp = client.send(client.build_request(method, url, extensions={"trace": h2_trace(timing, events)},
+                                                    **kwargs), stream=True)
+            t_headers = time.perf_counter()
+            connection_reused = "connection.connect_tcp" not in events
+            http_version = resp.http_version
+            chunks = resp.iter_bytes(RESPONSE_CHUNK_SIZE)
+        else:
+            # Stream so the connection is still attached when checking reuse
+            resp = pool_entry["session"].request(method, url, stream=True, **kwargs)
+            t_headers = time.perf_counter()
+            _phase_timing.current = None
+            connection_reused = connection_was_reused(pool_entry, resp)
+            http_version = "HTTP/1.0" if resp.raw.version == 10 else "HTTP/1.1"
+            chunks = None
+
+        blob = blob_store.writer() if store_body and STORE_RESPONSE_BODIES else None
+        try:
+            body_fields = read_body(resp, keep_body, blob, chunks, deadline, spill_body)
+        finally:
+            resp.close()
+
+        status_code = resp.status_code
+        result = {
+            "status_code": resp.status_code,
+            "http_version": http_version,
+            "headers": dict(resp.headers),
+            "connection_reused": connection_reused
+        }
+        result.update(body_fields) # body (always text, even for JSON), byte counts, download link
+        body_bytes = body_fields["body_bytes"]
+    except (requests.exceptions.ConnectTimeout, *HTTPX_CONNECT_TIMEOUT_ERRORS):
+        result = {"error": f"Connecting timed out after {timeout[0]:g} seconds."}
+        status_code = 408
+        error_kind = "timeout"
+    except (requests.exceptions.Timeout, *HTTPX_TIMEOUT_ERRORS):
+        result = {"error": f"Request timed out: no data for {timeout[1]:g} seconds."}
+        status_code = 408
+        error_kind = "timeout"
+    except DeadlineExceeded:
+        result = {"error": "Deadline exceeded while reading the response."}
+        status_code = 408
+        error_kind = "timeout"
+    except (requests.exceptions.RequestException, *HTTPX_REQUEST_ERRORS) as e:
+        result = { "error": f"Request failed: {str(e)}" }
+        # Status code isn't set by the exception, default 500 might be misleading
+        # Let's use a common code for connection errors if possible, or leave it
+        status_code = 503 # Service Unavailable might fit network issues
+        error_kind = "connection"
+    except Exception as e:
+        result = { "error": f"An unexpected error occurred: {str(e)}" }
+        status_code = 500
+        error_kind = "other"
+    finally:
+        _phase_timing.current = None
+        if pool_entry is not None:
+            release_session(pool_entry)
+        metrics.inc("resttool_outbound_in_flight", amount=-1)
+
+    t_end = time.perf_counter()
+    labels = {"host": host, "method": method}
+    if error_kind:
+        metrics.inc("resttool_outbound_errors_total", dict(labels, kind=error_kind))
+    metrics.observe("resttool_outbound_request_duration_seconds",
+                    dict(labels, engine=engine, status_class="error" if error_kind else status_class(status_code)),
+                    t_end - t_start)
+    result["engine"] = engine
+    if warning:
+        result["warning"] = warning
+    result["timing"] = timing_summary(timing, t_start, t_headers, t_end, body_bytes)
+    return result, status_code
+
+# --- Timeouts and retries ---
+def parse_send_options(data):
+    """Reads the timeout and retry settings of a request or saved request.
+
+    Fields (all optional): connect_timeout, read_timeout and deadline in
+    seconds, retries (extra attempts) and retry_on (upstream statuses, list
+    or comma separated). Raises ValueError with a message for the client.
+    """
+    def seconds(name, default):
+        value = data.get(name)
+        if value in (None, ""):
+            return default
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"'{name}' must be a number of seconds")
+        if not 0 < value <= MAX_TIMEOUT:
+            raise ValueError(f"'{name}' must be between 0 and {MAX_TIMEOUT} seconds")
+        return value
+
+    try:
+        retries = int(data.get("retries") or 0)
+    except (TypeError, ValueError):
+        raise ValueError("'retries' must be an integer")
+    if not 0 <= retries <= RETRY_MAX:
+        raise ValueError(f"'retries' must be between 0 and {RETRY_MAX}")
+    retry_on = data.get("retry_on")
+    if retry_on in (None, "", []):
+        retry_on = RETRY_DEFAULT_STATUSES
+    elif isinstance(retry_on, str):
+        retry_on = [part for part in retry_on.replace(" ", "").split(",") if part]
+    try:
+        retry_on = frozenset(int(code) for code in retry_on)
+    except (TypeError, ValueError):
+        raise ValueError("'retry_on' must be a list of status codes")
+    return {
+        "connect_timeout": seconds("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+        "read_timeout": seconds("read_timeout", DEFAULT_READ_TIMEOUT),
+        "deadline": seconds("deadline", None),
+        "retries": retries,
+        "retry_on": retry_on,
+    }
+
+DEFAULT_SEND_OPTIONS = parse_send_options({})
+SEND_OPTION_FIELDS = ("connect_timeout", "read_timeout", "deadline", "retries", "retry_on")
+
+def retry_delay(attempt, result):
+    """Seconds to wait before retry number `attempt` (1-based).
+
+    Exponential backoff with full jitter, so parallel senders retrying the
+    same upstream spread out. A numeric Retry-After from the upstream is
+    honoured as a minimum.
+    """
+    delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1)))
+    headers = result.get("headers") or {}
+    # HTTP/2 responses carry lowercase names, so match the header case-insensitively
+    retry_after = next((str(value).strip() for key, value in headers.items() if key.lower() == "retry-after"), "")
+    if retry_after.isdigit():
+        delay = max(delay, min(float(retry_after), RETRY_BACKOFF_MAX))
+    return delay
+
+def send_with_retries(method, url, headers, body, options=None, **kwargs):
+    """send_request() with the timeouts, deadline and retry policy in options.
+
+    Only idempotent methods are retried: after a timeout or connection
+    failure, or when the upstream answers with a status in retry_on. No
+    attempt starts or waits past the deadline. With retries configured the
+    result lists every attempt with its status and timing under "attempts".
+    """
+    options = options or DEFAULT_SEND_OPTIONS
+    started = time.monotonic()
+    deadline = started + options["deadline"] if options["deadline"] else None
+    retryable = method.upper() in IDEMPOTENT_METHODS
+    attempts = []
+    attempt = 0
+    while True:
+        attempt += 1
+        connect_timeout, read_timeout = options["connect_timeout"], options["read_timeout"]
+        if deadline is not None:
+            remaining = max(0.001, deadline - time.monotonic())
+            connect_timeout, read_timeout = min(connect_timeout, remaining), min(read_timeout, remaining)
+        result, status_code = send_request(method, url, headers, body, timeout=(connect_timeout, read_timeout),
+                                           deadline=deadline, **kwargs)
+        attempts.append({"attempt": attempt, "status_code": result.get("status_code"),
+                         "error": result.get("error"), "timing": result.get("timing")})
+        if "error" in result:
+            # Timeouts and connection failures; not unexpected errors (500)
+            failed = status_code in (408, 503)
+        else:
+            failed = status_code in options["retry_on"]
+        if not (failed and retryable and attempt <= options["retries"]):
+            break
+        delay = retry_delay(attempt, result)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            break
+        attempts[-1]["backoff_ms"] = round(delay * 1000.0, 1)
+        metrics.inc("resttool_outbound_retries_total", {"host": urlsplit(url).hostname or ""})
+        time.sleep(delay)
+
+    if options["retries"]:
+        result["attempts"] = attempts
+        result["elapsed_ms"] = round((time.monotonic() - started) * 1000.0, 3)
+    if deadline is not None and "error" in result and time.monotonic() >= deadline:
+        result["error"] += f" Deadline of {options['deadline']:g} seconds reached."
+    return result, status_code
+
+# --- Request templates and environments ---
+# URL, headers and body may contain {{name}} placeholders, filled in from the
+# selected environment when the request is sent, and generated values such
+# as {{$uuid}}. Requests are parsed once into Template objects and the
+# compiled form is cached, so repeated sends only join strings. \{{ is sent
+# as a literal {{. Without an environment, placeholders that are not
+# generated values are sent as written, so Mustache or Handlebars payloads
+# still go out unchanged.
+TEMPLATE_PATTERN = re.compile(r"\\(\{\{)|\{\{\s*(\$?[A-Za-z_][\w.-]*)\s*\}\}") # Escape or placeholder
+VARIABLE_NAME_PATTERN = re.compile(r"[A-Za-z_][\w.-]*")
+
+_send_counter = itertools.count(1) # next() is atomic, so no lock is needed
+
+# Generated values; each is drawn once per send, so a {{$uuid}} used in both
+# a header and the body has the same value
+GENERATED_VARIABLES = {
+    "$uuid": lambda: str(uuid.uuid4()),
+    "$timestamp": lambda: str(int(time.time())), # Unix seconds
+    "$timestamp_ms": lambda: str(int(time.time() * 1000)),
+    "$iso_timestamp": lambda: datetime.utcnow().isoformat() + "Z",
+    "$counter": lambda: str(next(_send_counter)), # Per process, from 1
+    "$random_int": lambda: str(random.randint(0, 1000)),
+}
+
+class TemplateError(ValueError):
+    """A placeholder could not be resolved."""
+
+class Template:
+    """A string with {{name}} placeholders, split once into its parts.
+
+    parts alternates literal text (escapes already resolved) and placeholder
+    names; raw holds each placeholder as written. A string without
+    placeholders renders to its literal text.
+    """
+
+    __slots__ = ("source", "parts", "raw", "names")
+
+    def __init__(self, source):
+        self.source = source
+        parts = [""]
+        raw = []
+        position = 0
+        for match in TEMPLATE_PATTERN.finditer(source):
+            parts[-1] += source[position:match.start()]
+            if match.group(1):
+                parts[-1] += match.group(1)
+            else:
+                parts += [match.group(2), ""]
+                raw.append(match.group(0))
+            position = match.end()
+        parts[-1] += source[position:]
+        self.parts = parts
+        self.raw = raw
+        self.names = frozenset(parts[1::2])
+
+    def render(self, variables, generated, strict=True):
+        """Fills in the placeholders. `generated` caches generated values for one send.
+
+        Unknown names raise TemplateError, or are left as written unless strict.
+        """
+        if len(self.parts) == 1:
+            return self.parts[0]
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            value = variables.get(name)
+            if value is None:
+                value = generated.get(name)
+                if value is None:
+                    if name in GENERATED_VARIABLES:
+                        value = generated[name] = GENERATED_VARIABLES[name]()
+                    elif strict:
+                        raise TemplateError(f"Undefined variable '{name}'")
+                    else:
+                        value = self.raw[i // 2]
+            parts[i] = value
+        return "".join(parts)
+
+class CompiledRequest:
+    """URL, headers and body of a request, parsed into templates.
+
+    Header names and string values are templates too; other JSON values are
+    passed through. Raises ValueError for headers that are not a JSON object.
+    """
+
+    def __init__(self, url, headers, body):
+        self.url = Template(url or "")
+        self.headers = [(Template(key), Template(value) if isinstance(value, str) else value)
+                        for key, value in parse_headers(headers).items()]
+        self.body = Template(body or "") if isinstance(body, str) else body
+        templates = [self.url, self.body] + [part for pair in self.headers for part in pair]
+        self.names = frozenset().union(*(t.names for t in templates if isinstance(t, Template)))
+
+    def render(self, variables, strict=None):
+        """Returns (url, headers dict, body) for one send.
+
+        variables None means no environment; unknown placeholders are then
+        sent as written, unless strict is given as True.
+        """
+        if strict is None:
+            strict = variables is not None
+        variables = variables or {}
+        generated = {}
+        headers = {}
+        for key, value in self.headers:
+            headers[key.render(variables, generated, strict)] = (value.render(variables, generated, strict)
+                                                                 if isinstance(value, Template) else value)
+        body = self.body.render(variables, generated, strict) if isinstance(self.body, Template) else self.body
+        return self.url.render(variables, generated, strict), headers, body
+
+class CompileCache:
+    """LRU of compiled forms keyed by the stored strings they were built from.
+
+    Saved requests are served from memory, so the key strings are the same
+    objects on every send and their hashes are computed only once.
+    """
+
+    def __init__(self, size, build):
+        self.size = size
+        self.build = build
+        self._entries = OrderedDict() # key -> compiled, most recently used last
+        self._lock = threading.Lock()
+
+    def get(self, *key):
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                return compiled
+        compiled = self.build(*key)
+        with self._lock:
+            self._entries[key] = compiled
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return compiled
+
+_compiled_requests = CompileCache(TEMPLATE_CACHE_SIZE, CompiledRequest)
+
+def compile_request(url, headers, body):
+    """Returns the CompiledRequest for these fields, parsing them only on a cache miss.
+
+    Saved requests keep headers as a JSON string and are cached. Ad-hoc
+    sends with header dicts are compiled every time.
+    """
+    if all(isinstance(part, str) for part in (url, headers, body)):
+        return _compiled_requests.get(url, headers, body)
+    return CompiledRequest(url, headers, body)
+
+def parse_environment(data):
+    """Validates {"variables": {...}} of an environment. Returns them as {name: str}."""
+    variables = data.get("variables") if isinstance(data, dict) else None
+    if not isinstance(variables, dict):
+        raise ValueError("'variables' must be a JSON object")
+    parsed = {}
+    for name, value in variables.items():
+        if not VARIABLE_NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid variable name '{name}'")
+        if isinstance(value, (dict, list)) or value is None:
+            raise ValueError(f"Variable '{name}' must be a string, number or boolean")
+        parsed[name] = value if isinstance(value, str) else json.dumps(value)
+    return parsed
+
+def load_environment(name):
+    """Returns the variables of a named environment, None for no environment.
+    Raises ValueError if unknown."""
+    if not name:
+        return None
+    environment = environment_store.get(name)
+    if environment is None:
+        raise ValueError(f"Environment '{name}' not found")
+    return environment["variables"]
+
+# --- Response assertions ---
+# Saved requests may carry "assertions", a JSON list kept as a string like
+# the headers, checked against every response right after it arrives:
+#   {"type": "status", "value": 200}          (or a list of codes, or "2xx")
+#   {"type": "header", "name": "Content-Type", "pattern": "json"}
+#   {"type": "jsonpath", "path": "$.items[0].id", "equals": 7}
+#   {"type": "body", "pattern": "regular expression"}
+#   {"type": "latency", "max_ms": 500}
+#   {"type": "size", "max_bytes": 65536}
+# header and jsonpath take one of "equals", "pattern" (regex search) or
+# "exists" (true/false, the default is true). Without a status assertion a
+# status below 400 is required, as for requests without assertions.
+JSONPATH_STEP = re.compile(r"\.([A-Za-z_][\w-]*)|\[(-?\d+)\]|\['([^']*)'\]|\[\"([^\"]*)\"\]")
+_MISSING = object() # A JSONPath that matched nothing
+
+def compile_jsonpath(path):
+    """Parses the JSONPath subset $.key, $['key'] and $[index] into a tuple of steps."""
+    if not isinstance(path, str) or not path.startswith("$"):
+        raise ValueError(f"JSONPath must start with '$': {path!r}")
+    steps = []
+    pos = 1
+    while pos < len(path):
+        match = JSONPATH_STEP.match(path, pos)
+        if match is None:
+            raise ValueError(f"Unsupported JSONPath {path!r} at position {pos}")
+        name, index, single, double = match.groups()
+        if index is not None:
+            steps.append(int(index))
+        else:
+            steps.append(next(part for part in (name, single, double) if part is not None))
+        pos = match.end()
+    return tuple(steps)
+
+def resolve_jsonpath(document, steps):
+    for step in steps:
+        if isinstance(step, int):
+            if not isinstance(document, list) or not -len(document) <= step < len(document):
+                return _MISSING
+        elif not isinstance(document, dict) or step not in document:
+            return _MISSING
+        document = document[step]
+    return document
+
+class ResponseView:
+    """A send result as assertions see it; header map and JSON body are built on first use."""
+
+    __slots__ = ("result", "_headers", "_json")
+
+    def __init__(self, result):
+        self.result = result
+        self._headers = None
+        self._json = None
+
+    def header(self, name):
+        if self._headers is None:
+            self._headers = {key.lower(): value for key, value in (self.result.get("headers") or {}).items()}
+        return self._headers.get(name.lower(), _MISSING)
+
+    def json(self):
+        if self._json is None:
+            try:
+                self._json = json.loads(self.result.get("body") or "")
+            except ValueError:
+                self._json = _MISSING
+        return self._json
+
+def _value_check(spec, what):
+    """Builds the test for header and jsonpath assertions: (description suffix, test(value))."""
+    if "equals" in spec:
+        expected = spec["equals"]
+        return f" == {json.dumps(expected)}", lambda value: value is not _MISSING and value == expected
+    if "pattern" in spec:
+        try:
+            pattern = re.compile(str(spec["pattern"]))
+        except re.error as e:
+            raise ValueError(f"Invalid pattern for {what}: {e}")
+        def matches(value):
+            if value is _MISSING:
+                return False
+            return pattern.search(value if isinstance(value, str) else json.dumps(value)) is not None
+        return f" ~ /{pattern.pattern}/", matches
+    if spec.get("exists", True):
+        return " exists", lambda value: value is not _MISSING
+    return " is absent", lambda value: value is _MISSING
+
+def _shown(value):
+    return "missing" if value is _MISSING else value if isinstance(value, str) else json.dumps(value)
+
+def compile_assertion(spec):
+    """Compiles one assertion. Returns (description, check(view) -> (ok, actual))."""
+    if not isinstance(spec, dict):
+        raise ValueError("Each assertion must be a JSON object")
+    kind = spec.get("type")
+    if kind == "status":
+        value = spec.get("value")
+        if isinstance(value, int):
+            return f"status == {value}", lambda view: (view.result.get("status_code") == value,
+                                                       view.result.get("status_code"))
+        if isinstance(value, list) and value and all(isinstance(code, int) for code in value):
+            codes = frozenset(value)
+            return f"status in {sorted(codes)}", lambda view: (view.result.get("status_code") in codes,
+                                                               view.result.get("status_code"))
+        if isinstance(value, str) and len(value) == 3 and value[0] in "12345" and value[1:].lower() == "xx":
+            digit = int(value[0])
+            return f"status {value.lower()}", lambda view: ((view.result.get("status_code") or 0) // 100 == digit,
+                                                            view.result.get("status_code"))
+        raise ValueError("'status' assertions need a 'value': a code, a list of codes or a class like '2xx'")
+    if kind == "header":
+        name = spec.get("name")
+        if not name or not isinstance(name, str):
+            raise ValueError("'header' assertions need a 'name'")
+        suffix, test = _value_check(spec, f"header {name}")
+        def check_header(view):
+            value = view.header(name)
+            return test(value), _shown(value)
+        return f"header {name}{suffix}", check_header
+    if kind == "jsonpath":
+        path = spec.get("path")
+        steps = compile_jsonpath(path)
+        suffix, test = _value_check(spec, path)
+        def check_jsonpath(view):
+            document = view.json()
+            value = _MISSING if document is _MISSING else resolve_jsonpath(document, steps)
+            return test(value), _shown(value)
+        return f"{path}{suffix}", check_jsonpath
+    if kind == "body":
+        try:
+            pattern = re.compile(str(spec.get("pattern") or ""))
+        except re.error as e:
+            raise ValueError(f"Invalid body pattern: {e}")
+        if not pattern.pattern:
+            raise ValueError("'body' assertions need a 'pattern'")
+        return f"body ~ /{pattern.pattern}/", lambda view: (pattern.search(view.result.get("body") or "") is not None,
+                                                            f"{view.result.get('body_bytes', 0)} bytes")
+    if kind in ("latency", "size"):
+        field = "max_ms" if kind == "latency" else "max_bytes"
+        limit = spec.get(field)
+        if isinstance(limit, bool) or not isinstance(limit, (int, float)) or limit <= 0:
+            raise ValueError(f"'{kind}' assertions need a positive '{field}'")
+        if kind == "latency":
+            def check_latency(view):
+                elapsed = (view.result.get("timing") or {}).get("total_ms", 0)
+                return elapsed <= limit, elapsed
+            return f"latency <= {limit:g} ms", check_latency
+        return f"size <= {limit:g} bytes", lambda view: (view.result.get("body_bytes", 0) <= limit,
+                                                         view.result.get("body_bytes", 0))
+    raise ValueError(f"Unknown assertion type {kind!r}; use status, header, jsonpath, body, latency or size")
+
+class AssertionSet:
+    """Compiled assertions of a request.
+
+    Raises ValueError for assertions that are not a JSON list or can't be
+    compiled. needs_body tells the sender to keep the body preview (up to
+    RESPONSE_PREVIEW_BYTES) for jsonpath and body assertions.
+    """
+
+    def __init__(self, assertions):
+        specs = json.loads(assertions) if isinstance(assertions, str) and assertions.strip() else assertions or []
+        if not isinstance(specs, list):
+            raise ValueError("Assertions must be a JSON list")
+        self.checks = [compile_assertion(spec) for spec in specs]
+        if self.checks and not any(spec.get("type") == "status" for spec in specs):
+            self.checks.insert(0, ("status < 400", lambda view: ((view.result.get("status_code") or 500) < 400,
+                                                                 view.result.get("status_code"))))
+        self.needs_body = any(spec.get("type") in ("jsonpath", "body") for spec in specs)
+
+    def __bool__(self):
+        return bool(self.checks)
+
+    def evaluate(self, result):
+        """Returns [(ok, actual)] per check. A send without a response fails all of them."""
+        if "error" in result:
+            return [(False, "no response")] * len(self.checks)
+        view = ResponseView(result)
+        return [check(view) for _, check in self.checks]
+
+    def summary(self, outcomes):
+        """Formats evaluate() output as result["assertions"]."""
+        passed = sum(ok for ok, _ in outcomes)
+        metrics.inc("resttool_assertions_total", {"outcome": "pass"}, passed)
+        metrics.inc("resttool_assertions_total", {"outcome": "fail"}, len(outcomes) - passed)
+        return {
+            "passed": passed,
+            "failed": len(outcomes) - passed,
+            "results": [{"assertion": description, "passed": ok, "actual": actual}
+                        for (description, _), (ok, actual) in zip(self.checks, outcomes)],
+        }
+
+_compiled_assertions = CompileCache(TEMPLATE_CACHE_SIZE, AssertionSet)
+
+def compile_assertions(assertions):
+    """Returns the AssertionSet for a request's "assertions", cached for stored strings."""
+    if isinstance(assertions, str):
+        return _compiled_assertions.get(assertions)
+    return AssertionSet(assertions)
+
+# --- Record-and-replay cache ---
+def normalize_url(url):
+    """Canonical form of a URL for fingerprinting: lowercase scheme/host,
+    no default port, sorted query parameters, no fragment."""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port and parts.port != {"http": 80, "https": 443}.get(scheme):
+        netloc += f":{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+def request_fingerprint(method, url, headers, body):
+    """Identifies requests that should get the same recorded response."""
+    digest = hashlib.sha256()
+    digest.update(method.upper().encode())
+    digest.update(b"\0" + normalize_url(url).encode())
+    lowered = {str(key).lower(): str(value) for key, value in headers.items()}
+    for name in REPLAY_KEY_HEADERS:
+        if name in lowered:
+            digest.update(b"\0" + name.encode() + b":" + lowered[name].encode())
+    digest.update(b"\0" + hashlib.sha256((body or "").encode("utf-8")).digest())
+    return digest.hexdigest()
+
+class ReplayCache:
+    """LRU store of recorded results keyed by request fingerprint.
+
+    Bounded both by entry count and by the total size of the stored body
+    previews, so recording large responses cannot grow memory without limit.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # fingerprint -> (recorded_at, size, result)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age=None):
+        """Returns (result copy, age in seconds), or (None, None) on a miss."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None, None
+            recorded_at, _, result = item
+            age = time.monotonic() - recorded_at
+            if max_age is not None and age > max_age:
+                return None, None
+            self._entries.move_to_end(key)
+        return dict(result), age
+
+    def put(self, key, result):
+        size = len(result.get("body", "")) if isinstance(result.get("body"), str) else 0
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[1]
+            self._entries[key] = (time.monotonic(), size, dict(result))
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, dropped, _) = self._entries.popitem(last=False)
+                self._bytes -= dropped
+
+replay_cache = ReplayCache(REPLAY_CACHE_SIZE, REPLAY_CACHE_MAX_BYTES)
+
+def send_with_replay(method, url, headers, body, mode, engine="http1", options=None):
+    """send_with_retries() behind the record-and-replay cache.
+
+    off: always live. record: live, and store the response. replay: serve a
+    fresh (REPLAY_TTL) recording if there is one, else go live and record.
+    offline: serve any recording regardless of age, never go live.
+    """
+    if mode not in ("record", "replay", "offline"):
+        return send_with_retries(method, url, headers, body, options, store_body=True, engine=engine)
+
+    t0 = time.perf_counter()
+    key = request_fingerprint(method, url, headers, body)
+    if mode in ("replay", "offline"):
+        cached, age = replay_cache.get(key, max_age=None if mode == "offline" else REPLAY_TTL)
+        metrics.inc("resttool_replay_cache_total", {"result": "miss" if cached is None else "hit"})
+        if cached is not None:
+            cached.update({
+                "replayed": True,
+                "replay_age_s": round(age, 3),
+                "recorded_timing": cached.get("timing"),
+                "timing": {"total_ms": round((time.perf_counter() - t0) * 1000.0, 3)},
+            })
+            return cached, cached["status_code"]
+        if mode == "offline":
+            return {"error": "No recorded response for this request (offline replay mode).",
+                    "replayed": False}, 504
+
+    result, status_code = send_with_retries(method, url, headers, body, options, store_body=True, engine=engine)
+    if "error" not in result:
+        replay_cache.put(key, result)
+    return result, status_code
+
+# --- Load testing ---
+class LatencyHistogram:
+    """Fixed-memory log-linear histogram of latencies in microseconds.
+
+    Values below SUB_BUCKETS are exact; above that each power of two is split
+    into SUB_BUCKETS slots, so recorded values are within ~1.6% of the truth.
+    Memory stays constant no matter how many samples are recorded.
+    """
+    SUB_BUCKETS = 64
+    MAX_SHIFT = 32 # Tops out at roughly 76 hours
+
+    def __init__(self):
+        self.counts = [0] * (self.SUB_BUCKETS * (self.MAX_SHIFT + 2))
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def _index(self, micros):
+        if micros < self.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - self.SUB_BUCKETS.bit_length()
+        if shift > self.MAX_SHIFT:
+            return len(self.counts) - 1
+        return (shift + 1) * self.SUB_BUCKETS + (micros >> shift) - self.SUB_BUCKETS
+
+    def _value(self, index):
+        """Returns the midpoint of the value range covered by a slot."""
+        bucket, sub = divmod(index, self.SUB_BUCKETS)
+        if bucket == 0:
+            return sub
+        shift = bucket - 1
+        return ((self.SUB_BUCKETS + sub) << shift) + ((1 << shift) >> 1)
+
+    def record(self, seconds):
+        micros = max(0, int(seconds * 1_000_000))
+        with self._lock:
+            self.counts[self._index(micros)] += 1
+            self.total += 1
+            self.sum += micros
+            self.min = micros if self.min is None else min(self.min, micros)
+            self.max = max(self.max, micros)
+
+    def percentile(self, pct):
+        """Returns the latency in microseconds at the given percentile (0-100)."""
+        if self.total == 0:
+            return 0
+        target = max(1, int(round(self.total * pct / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def summary_ms(self):
+        """Returns min/mean/percentiles/max in milliseconds for JSON output."""
+        def ms(micros):
+            return round(micros / 1000.0, 3)
+        return {
+            "min": ms(self.min or 0),
+            "mean": ms(self.sum / self.total) if self.total else 0,
+            "p50": ms(self.percentile(50)),
+            "p90": ms(self.percentile(90)),
+            "p99": ms(self.percentile(99)),
+            "p999": ms(self.percentile(99.9)),
+            "max": ms(self.max),
+        }
+
+# Names for the synthetic status codes send_request() uses on failure
+SEND_ERROR_KINDS = {408: "timeout", 503: "connection_error", 500: "error"}
+
+def count_outcome(result, status_code, status_counts, error_counts):
+    """Adds one send to the per-status or per-error-kind counts. Caller holds the lock."""
+    if "error" in result:
+        kind = SEND_ERROR_KINDS.get(status_code, "error")
+        error_counts[kind] = error_counts.get(kind, 0) + 1
+    else:
+        key = str(status_code)
+        status_counts[key] = status_counts.get(key, 0) + 1
+
+def failed_count(status_counts, error_counts):
+    return sum(error_counts.values()) + sum(n for code, n in status_counts.items() if int(code) >= 400)
+
+def count_assertions(outcomes, tallies):
+    """Adds AssertionSet.evaluate() output to per-assertion [passed, failed]
+    tallies. Returns whether all passed. Caller holds the lock."""
+    all_passed = True
+    for tally, (ok, _) in zip(tallies, outcomes):
+        tally[0 if ok else 1] += 1
+        all_passed = all_passed and ok
+    return all_passed
+
+def assertion_report(checks, tallies, failed_sends):
+    """Summary fields for the assertions of a load test."""
+    metrics.inc("resttool_assertions_total", {"outcome": "pass"}, sum(passed for passed, _ in tallies))
+    metrics.inc("resttool_assertions_total", {"outcome": "fail"}, sum(failed for _, failed in tallies))
+    return {
+        "assertions": [{"assertion": description, "passed": passed, "failed": failed}
+                       for (description, _), (passed, failed) in zip(checks.checks, tallies)],
+        "assertion_failures": failed_sends, # Sends with at least one failed assertion
+    }
+
+def run_load_test(saved, count, concurrency, duration, variables=None):
+    """Fires a saved request repeatedly from a worker pool and summarizes it.
+
+    Stops after `count` requests or `duration` seconds, whichever comes first
+    (either may be None, but not both). The saved request's timeouts apply,
+    but not its retries: a retried send would hide the failure in the stats.
+    Placeholders are filled from `variables` and the saved request's
+    assertions are checked for every send.
+    """
+    method = saved.get("method", "GET").upper()
+    template = compile_request(saved.get("url", ""), saved.get("headers", ""), saved.get("body", ""))
+    url = template.render(variables)[0] # Also fails early on undefined variables
+    checks = compile_assertions(saved.get("assertions"))
+    engine = saved.get("engine") or "http1"
+    options = parse_send_options(saved)
+    timeout = (options["connect_timeout"], options["read_timeout"])
+
+    histogram = LatencyHistogram()
+    status_counts = {}
+    error_counts = {}
+    tallies = [[0, 0] for _ in checks.checks]
+    failed_sends = [0] # Sends with a failed assertion
+    counter_lock = threading.Lock()
+    issued = [0]
+    started = time.monotonic()
+    deadline = started + duration if duration else None
+
+    def claim():
+        """Reserves the next iteration; False once the test should stop."""
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        with counter_lock:
+            if count is not None and issued[0] >= count:
+                return False
+            issued[0] += 1
+            return True
+
+    def worker():
+        while claim():
+            send_url, headers, body = template.render(variables)
+            t0 = time.perf_counter()
+            result, status_code = send_request(method, send_url, headers, body, keep_body=checks.needs_body,
+                                               engine=engine, timeout=timeout, spill_body=False)
+            histogram.record(time.perf_counter() - t0)
+            outcomes = checks.evaluate(result) if checks else None
+            with counter_lock:
+                count_outcome(result, status_code, status_counts, error_counts)
+                if outcomes is not None and not count_assertions(outcomes, tallies):
+                    failed_sends[0] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    elapsed = time.monotonic() - started
+    failed = failed_count(status_counts, error_counts)
+    summary = {
+        "url": url,
+        "method": method,
+        "mode": "closed",
+        "requests": histogram.total,
+        "concurrency": concurrency,
+        "engine": engine,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(histogram.total / elapsed, 2) if elapsed > 0 else 0,
+        "status_counts": status_counts,
+        "errors": error_counts,
+        "failed": failed,
+        "latency_ms": histogram.summary_ms(),
+    }
+    if checks:
+        summary.update(assertion_report(checks, tallies, failed_sends[0]))
+    return summary
+
+def load_profile(params):
+    """Builds an open-loop arrival rate profile from /loadtest parameters.
+
+    Returns segments of (seconds, start rate, end rate); the rate changes
+    linearly within a segment. Profiles:
+      constant: `rate` for `duration`
+      ramp:     `start_rate` (default 0) to `rate` over `duration`
+      step:     `steps`, a list of [seconds, rate] or "seconds:rate,..."
+      spike:    `rate`, with `spike_rate` from `spike_at` for `spike_duration`
+    Raises ValueError with a message for the client.
+    """
+    def number(name, default=None):
+        value = params.get(name)
+        if value in (None, ""):
+            if default is None:
+                raise ValueError(f"'{name}' is required for the {kind} profile")
+            return default
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"'{name}' must be a number")
+
+    kind = params.get("profile") or "constant"
+    if kind not in LOADTEST_PROFILES:
+        raise ValueError(f"'profile' must be one of: {', '.join(LOADTEST_PROFILES)}")
+    if kind == "step":
+        steps = params.get("steps") or []
+        if isinstance(steps, str):
+            steps = [step.split(":") for step in steps.replace(" ", "").split(",") if step]
+        try:
+            segments = [(float(seconds), float(rate), float(rate)) for seconds, rate in steps]
+        except (TypeError, ValueError):
+            raise ValueError("'steps' must be a list of [seconds, rate] pairs")
+    else:
+        rate, duration = number("rate"), number("duration")
+        if kind == "constant":
+            segments = [(duration, rate, rate)]
+        elif kind == "ramp":
+            segments = [(duration, number("start_rate", 0.0), rate)]
+        else:
+            spike_at, spike_duration = number("spike_at"), number("spike_duration")
+            segments = [(spike_at, rate, rate), (spike_duration, number("spike_rate"), number("spike_rate")),
+                        (duration - spike_at - spike_duration, rate, rate)]
+            segments = [segment for segment in segments if segment[0] > 0]
+    if not segments or any(seconds < 0 or min(a, b) < 0 or max(a, b) > LOADTEST_MAX_RATE
+                           for seconds, a, b in segments):
+        raise ValueError(f"Rates must be between 0 and {LOADTEST_MAX_RATE} and durations positive")
+    if sum(seconds for seconds, _, _ in segments) > LOADTEST_MAX_DURATION:
+        raise ValueError(f"The profile may last at most {LOADTEST_MAX_DURATION} seconds")
+    if not any(max(a, b) > 0 for _, a, b in segments):
+        raise ValueError("The profile never sends a request (all rates are 0)")
+    return segments
+
+def arrival_offsets(segments):
+    """Yields the intended send time (seconds from start) of each request.
+
+    Request n is due when the integral of the rate reaches n, so arrivals are
+    evenly spaced at constant rate and follow ramps exactly.
+    """
+    start = 0.0 # Time at which the current segment begins
+    due = 1.0 # Cumulative request count of the next arrival
+    done = 0.0 # Cumulative count at the start of the segment
+    for seconds, rate_from, rate_to in segments:
+        slope = (rate_to - rate_from) / seconds if seconds else 0.0
+        total = (rate_from + rate_to) / 2.0 * seconds # Requests within this segment
+        while total > 0 and due - done <= total + 1e-9:
+            n = due - done
+            # Solve rate_from*t + slope*t^2/2 = n for t
+            if abs(slope) < 1e-12:
+                t = n / rate_from
+            else:
+                # Rounding can push the discriminant just below 0 at the end of a ramp down to 0
+                t = (-rate_from + max(0.0, rate_from * rate_from + 2.0 * slope * n) ** 0.5) / slope
+            yield start + min(t, seconds)
+            due += 1.0
+        start += seconds
+        done += total
+
+def run_open_load_test(saved, segments, max_in_flight, variables=None):
+    """Fires a saved request at the arrival rates of a profile (open loop).
+
+    A dispatcher submits each request at its intended time whether or not
+    earlier ones have finished, with up to max_in_flight running at once;
+    requests beyond that wait in the queue. Latency is measured from the
+    intended send time, so a stalled server shows up as the queueing delay
+    its clients would see (coordinated omission correction); the time spent
+    on the wire alone is reported as service_time_ms. Assertions are
+    counted as in run_load_test().
+    """
+    method = saved.get("method", "GET").upper()
+    template = compile_request(saved.get("url", ""), saved.get("headers", ""), saved.get("body", ""))
+    url = template.render(variables)[0] # Also fails early on undefined variables
+    checks = compile_assertions(saved.get("assertions"))
+    engine = saved.get("engine") or "http1"
+    options = parse_send_options(saved)
+    timeout = (options["connect_timeout"], options["read_timeout"])
+    total_seconds = sum(seconds for seconds, _, _ in segments)
+
+    latency = LatencyHistogram() # From intended send time
+    service = LatencyHistogram() # From actual send time
+    status_counts = {}
+    error_counts = {}
+    tallies = [[0, 0] for _ in checks.checks]
+    failed_sends = [0] # Sends with a failed assertion
+    timeline = [[0, 0] for _ in range(int(total_seconds) + 1)] # Per second: [scheduled, completed]
+    counter_lock = threading.Lock()
+    max_lag = 0.0
+
+    def fire(intended):
+        send_url, headers, body = template.render(variables)
+        t0 = time.perf_counter()
+        result, status_code = send_request(method, send_url, headers, body, keep_body=checks.needs_body,
+                                           engine=engine, timeout=timeout, spill_body=False)
+        t_end = time.perf_counter()
+        service.record(t_end - t0)
+        latency.record(t_end - intended)
+        outcomes = checks.evaluate(result) if checks else None
+        with counter_lock:
+            count_outcome(result, status_code, status_counts, error_counts)
+            if outcomes is not None and not count_assertions(outcomes, tallies):
+                failed_sends[0] += 1
+            second = int(t_end - started)
+            if second < len(timeline):
+                timeline[second][1] += 1
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+    started = time.perf_counter()
+    scheduled = 0
+    try:
+        for offset in arrival_offsets(segments):
+            intended = started + offset
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+            executor.submit(fire, intended)
+            scheduled += 1
+            timeline[min(int(offset), len(timeline) - 1)][0] += 1
+    finally:
+        executor.shutdown(wait=True)
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        "url": url,
+        "method": method,
+        "mode": "open",
+        "engine": engine,
+        "requests": latency.total,
+        "max_in_flight": max_in_flight,
+        "profile_s": round(total_seconds, 3),
+        "duration_s": round(elapsed, 3),
+        "target_rps": round(scheduled / total_seconds, 2) if total_seconds else 0,
+        "achieved_rps": round(latency.total / elapsed, 2) if elapsed > 0 else 0,
+        # Dispatcher running behind its schedule means the tool, not the server, was the limit
+        "max_dispatch_lag_ms": round(max_lag * 1000.0, 3),
+        "status_counts": status_counts,
+        "errors": error_counts,
+        "failed": failed_count(status_counts, error_counts),
+        "latency_ms": latency.summary_ms(),
+        "service_time_ms": service.summary_ms(),
+        "timeline": [{"second": i, "target": target, "achieved": achieved}
+                     for i, (target, achieved) in enumerate(timeline)],
+    }
+    if checks:
+        summary.update(assertion_report(checks, tallies, failed_sends[0]))
+    return summary
+
+# --- History recording ---
+def new_history_entry(url, method, headers, body, proxy):
+    """Builds the history entry for a send that is about to happen."""
+    return {
+        "timestamp": datetime.utcnow().isoformat() + "Z", # ISO 8601 UTC
+        "url": url,
+        "method": method,
+        # Store headers as string in history, like saved requests
+        "headers": json.dumps(headers) if headers else "",
+        "body": body,
+        "proxy": proxy
+    }
+
+def record_history(entry, result):
+    """Adds the outcome of a send to its history entry and stores it. Returns the id."""
+    entry["connection_reused"] = result.get("connection_reused")
+    entry["timing"] = result.get("timing")
+    # Upstream status (None if no response arrived) so history can be filtered on it
+    entry["status_code"] = result.get("status_code")
+    entry["http_version"] = result.get("http_version")
+    if "error" in result:
+        entry["error"] = result["error"]
+    if result.get("replayed"):
+        entry["replayed"] = True
+    if result.get("attempts"):
+        entry["attempts"] = len(result["attempts"])
+    if result.get("response_body"):
+        # Digest reference only; the body itself lives in the blob store
+        entry["response_body"] = result["response_body"]
+    with store_write_timer("history"):
+        return history_store.append(entry)
+
+# --- Batch runs ---
+def send_saved(saved, variables, record=True, keep_body=False, strict=None):
+    """Fills in, sends and checks one saved request. Returns the result.
+
+    The body preview is only kept in the result with keep_body; assertions
+    that need it see it either way. The send is recorded in history unless
+    record is False. Problems with the saved request itself are returned
+    as an error result. strict is passed to CompiledRequest.render().
+    """
+    method = saved.get("method", "GET").upper()
+    try:
+        template = compile_request(saved.get("url", ""), saved.get("headers", ""), saved.get("body", ""))
+    except ValueError as e:
+        return {"error": f"Invalid headers in saved request: {e}"}
+    try:
+        url, headers, body = template.render(variables, strict)
+    except TemplateError as e:
+        return {"error": f"Could not fill in the saved request: {e}"}
+    try:
+        checks = compile_assertions(saved.get("assertions"))
+    except ValueError as e:
+        return {"error": f"Invalid assertions in saved request: {e}"}
+    try:
+        options = parse_send_options(saved)
+    except ValueError as e:
+        return {"error": f"Invalid timeout or retry settings in saved request: {e}"}
+    entry = new_history_entry(url, method, headers, body, saved.get("proxy", False))
+    result, _ = send_with_retries(method, url, headers, body, options, keep_body=keep_body or checks.needs_body,
+                                  store_body=record, engine=saved.get("engine") or "http1", spill_body=False)
+    if checks:
+        result["assertions"] = checks.summary(checks.evaluate(result))
+    if not keep_body:
+        result.pop("body", None)
+    if record:
+        result["history_id"] = record_history(entry, result)
+    result.update({"url": url, "method": method})
+    return result
+
+def saved_host(saved, variables):
+    """Pool key of a saved request's upstream, with variables in the URL filled in."""
+    url = saved.get("url", "")
+    try:
+        url = compile_request(url, saved.get("headers", ""), saved.get("body", "")).url.render(
+            variables or {}, {}, strict=False)
+        return _host_key(url)
+    except ValueError:
+        return url # Fails in send_saved(); any key will do
+
+def run_batch(jobs, max_workers, per_host, record=True, variables=None):
+    """Sends saved requests in parallel, yielding each outcome as it finishes.
+
+    jobs is a list of (name, saved request). At most max_workers sends run at
+    once and at most per_host of them against the same upstream host; jobs
+    for a busy host wait without holding a worker. Placeholders are filled
+    from `variables`. Every send is recorded in history unless record is False.
+    """
+    pending = list(enumerate(jobs))
+    in_flight = {} # future -> (index, name, host key)
+    host_busy = {}
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while pending or in_flight:
+            # Start every pending job whose host still has capacity
+            for item in list(pending):
+                if len(in_flight) >= max_workers:
+                    break
+                index, (name, saved) = item
+                host = saved_host(saved, variables)
+                if host_busy.get(host, 0) >= per_host:
+                    continue
+                pending.remove(item)
+                host_busy[host] = host_busy.get(host, 0) + 1
+                in_flight[executor.submit(send_saved, saved, variables, record)] = (index, name, host)
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index, name, host = in_flight.pop(future)
+                host_busy[host] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"error": f"An unexpected error occurred: {str(e)}"}
+                result.update({"index": index, "name": name})
+                yield result
+    finally:
+        # Also reached when the client disconnects mid-stream
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def select_saved(saved, names, collection=None):
+    """Picks batch jobs: the named requests in order, then the rest of the
+    collection by name. Returns (jobs, names that are not saved)."""
+    missing = [name for name in names if name not in saved]
+    selected = list(dict.fromkeys(name for name in names if name in saved))
+    if collection:
+        selected += sorted(name for name, item in saved.items()
+                           if item.get("collection") == collection and name not in selected)
+    return [(name, saved[name]) for name in selected], missing
+
+def send_succeeded(result):
+    """Tells whether a send got a response that passed its assertions.
+
+    Without assertions that means a non-error status.
+    """
+    if "error" in result:
+        return False
+    if result.get("assertions"):
+        return result["assertions"]["failed"] == 0
+    return result.get("status_code", 500) < 400
+
+# --- Workflows ---
+# A workflow chains saved requests into a dependency graph:
+#   {"steps": [{"id": "login", "request": "login",
+#               "extract": {"token": "$.access_token", "session": "header:Set-Cookie"}},
+#              {"id": "create", "request": "create-item", "after": ["login"],
+#               "extract": {"item_id": "$.id"}},
+#              ...]}
+# Extracted values become {{variables}} of later steps. A step runs after
+# the steps in its "after" list and after the steps extracting variables
+# it uses, so independent branches run concurrently.
+def compile_extractor(source):
+    """Compiles an extraction source: "$.json.path", "header:Name" or "status".
+
+    Returns (needs_body, extract(view)), where extract returns the value as a
+    string or _MISSING.
+    """
+    if not isinstance(source, str):
+        raise ValueError("Extraction sources must be strings")
+    if source.startswith("$"):
+        steps = compile_jsonpath(source)
+        def extract_jsonpath(view):
+            document = view.json()
+            value = _MISSING if document is _MISSING else resolve_jsonpath(document, steps)
+            return value if value is _MISSING or isinstance(value, str) else json.dumps(value)
+        return True, extract_jsonpath
+    if source.startswith("header:") and source[len("header:"):].strip():
+        name = source[len("header:"):].strip()
+        return False, lambda view: view.header(name)
+    if source == "status":
+        return False, lambda view: str(view.result.get("status_code"))
+    raise ValueError(f"Invalid extraction source {source!r}; use '$.path', 'header:Name' or 'status'")
+
+def parse_workflow(data):
+    """Validates a workflow definition. Returns it normalized as {"steps": [...]}."""
+    steps = data.get("steps") if isinstance(data, dict) else None
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("'steps' must be a non-empty list")
+    if len(steps) > WORKFLOW_MAX_STEPS:
+        raise ValueError(f"A workflow has at most {WORKFLOW_MAX_STEPS} steps")
+    parsed = []
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or not isinstance(step.get("request"), str) or not step["request"]:
+            raise ValueError(f"Step {index + 1} needs the name of a saved request as 'request'")
+        step_id = step.get("id", step["request"])
+        if not isinstance(step_id, str) or not step_id:
+            raise ValueError(f"Step {index + 1} has an invalid 'id'")
+        if any(other["id"] == step_id for other in parsed):
+            raise ValueError(f"Duplicate step id '{step_id}'; give repeated requests their own 'id'")
+        after = step.get("after", [])
+        if isinstance(after, str):
+            after = [after]
+        if not isinstance(after, list) or not all(isinstance(item, str) for item in after):
+            raise ValueError(f"'after' of step '{step_id}' must be a list of step ids")
+        extract = step.get("extract", {})
+        if not isinstance(extract, dict):
+            raise ValueError(f"'extract' of step '{step_id}' must be a JSON object")
+        for name, source in extract.items():
+            if not VARIABLE_NAME_PATTERN.fullmatch(name):
+                raise ValueError(f"Invalid variable name '{name}' in step '{step_id}'")
+            compile_extractor(source)
+        parsed.append({"id": step_id, "request": step["request"], "after": after, "extract": extract})
+    ids = {step["id"] for step in parsed}
+    for step in parsed:
+        unknown = [item for item in step["after"] if item not in ids]
+        if unknown:
+            raise ValueError(f"Step '{step['id']}' runs after unknown steps: {', '.join(unknown)}")
+    return {"steps": parsed}
+
+class WorkflowStep:
+    __slots__ = ("id", "request", "saved", "after", "dependents", "extract", "needs_body")
+
+class WorkflowPlan:
+    """A parsed workflow resolved against the saved requests.
+
+    Adds the dependencies implied by extracted variables to the explicit
+    "after" lists and orders the steps topologically. Raises ValueError for
+    missing saved requests, a variable extracted by two steps, or a cycle.
+    """
+
+    def __init__(self, definition, saved):
+        self.steps = {}
+        producers = {} # variable -> id of the step extracting it
+        for spec in definition["steps"]:
+            if spec["request"] not in saved:
+                raise ValueError(f"Step '{spec['id']}' uses unknown saved request '{spec['request']}'")
+            step = WorkflowStep()
+            step.id = spec["id"]
+            step.request = spec["request"]
+            step.saved = saved[spec["request"]]
+            step.after = set(spec["after"])
+            step.dependents = []
+            step.extract = []
+            step.needs_body = False
+            for name, source in spec["extract"].items():
+                if name in producers:
+                    raise ValueError(f"Variable '{name}' is extracted by both '{producers[name]}' and '{step.id}'")
+                producers[name] = step.id
+                needs_body, extract = compile_extractor(source)
+                step.needs_body = step.needs_body or needs_body
+                step.extract.append((name, source, extract))
+            self.steps[step.id] = step
+        for step in self.steps.values():
+            saved_request = step.saved
+            try:
+                names = compile_request(saved_request.get("url", ""), saved_request.get("headers", ""),
+                                        saved_request.get("body", "")).names
+            except ValueError:
+                names = () # Reported when the step is sent
+            step.after.update(producers[name] for name in names if name in producers)
+            step.after.discard(step.id)
+            for dependency in step.after:
+                self.steps[dependency].dependents.append(step.id)
+        # Kahn's algorithm, keeping the definition order among ready steps
+        waiting = {step_id: len(step.after) for step_id, step in self.steps.items()}
+        self.order = [step_id for step_id, count in waiting.items() if count == 0]
+        for step_id in self.order:
+            for dependent in self.steps[step_id].dependents:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    self.order.append(dependent)
+        if len(self.order) < len(self.steps):
+            cycle = [step_id for step_id in self.steps if waiting[step_id]]
+            raise ValueError(f"Workflow steps depend on each other in a cycle: {', '.join(cycle)}")
+
+def run_workflow(plan, max_workers, per_host, record=True, variables=None):
+    """Runs the steps of a WorkflowPlan, yielding each step's result as it finishes.
+
+    A step starts as soon as all steps it depends on have passed, with the
+    same worker and per-host limits as run_batch(). Its result holds the
+    "extracted" variables and "started_ms"/"finished_ms" since the start of
+    the run. When a step fails, or a value can't be extracted, the steps
+    depending on it are yielded as "skipped"; other branches go on.
+    """
+    values = dict(variables or {}) # Environment plus everything extracted so far
+    strict = variables is not None # Without an environment unknown placeholders pass through
+    waiting = {step_id: set(step.after) for step_id, step in plan.steps.items()}
+    ready = [step_id for step_id in plan.order if not waiting[step_id]]
+    skipped = set()
+    in_flight = {} # future -> (step id, host key)
+    host_busy = {}
+    started = time.monotonic()
+
+    def execute(step, step_variables):
+        t_start = time.monotonic()
+        result = send_saved(step.saved, step_variables, record, keep_body=step.needs_body, strict=strict)
+        if send_succeeded(result) and step.extract:
+            view = ResponseView(result)
+            extracted = {}
+            for name, source, extract in step.extract:
+                value = extract(view)
+                if value is _MISSING:
+                    result["extract_error"] = f"Could not extract '{name}' from {source}"
+                    break
+                extracted[name] = value
+            else:
+                result["extracted"] = extracted
+        result.pop("body", None)
+        result["started_ms"] = round((t_start - started) * 1000, 1)
+        result["finished_ms"] = round((time.monotonic() - started) * 1000, 1)
+        return result
+
+    def skip_dependents(step_id):
+        """Yields skipped results for everything downstream of a failed step."""
+        queue = [(dependent, step_id) for dependent in plan.steps[step_id].dependents]
+        while queue:
+            dependent, cause = queue.pop(0)
+            if dependent in skipped:
+                continue
+            skipped.add(dependent)
+            yield {"id": dependent, "request": plan.steps[dependent].request, "passed": False,
+                   "skipped": f"Step '{cause}' did not pass"}
+            queue.extend((item, dependent) for item in plan.steps[dependent].dependents)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while ready or in_flight:
+            for step_id in list(ready):
+                if len(in_flight) >= max_workers:
+                    break
+                step = plan.steps[step_id]
+                host = saved_host(step.saved, values)
+                if host_busy.get(host, 0) >= per_host:
+                    continue
+                ready.remove(step_id)
+                host_busy[host] = host_busy.get(host, 0) + 1
+                in_flight[executor.submit(execute, step, dict(values))] = (step_id, host)
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                step_id, host = in_flight.pop(future)
+                host_busy[host] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"error": f"An unexpected error occurred: {str(e)}"}
+                result.update({"id": step_id, "request": plan.steps[step_id].request})
+                result["passed"] = send_succeeded(result) and "extract_error" not in result
+                yield result
+                if not result["passed"]:
+                    yield from skip_dependents(step_id)
+                    continue
+                values.update(result.get("extracted", {}))
+                for dependent in plan.steps[step_id].dependents:
+                    waiting[dependent].discard(step_id)
+                    if not waiting[dependent] and dependent not in skipped:
+                        ready.append(dependent)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def workflow_report(plan, results, elapsed):
+    """Summarizes a workflow run: outcome counts, steps in definition order
+    and the critical path, the longest chain of dependent step durations.
+
+    elapsed_ms close to critical_path_ms means the independent branches
+    overlapped; serial_ms is what running the steps one by one would take.
+    """
+    by_id = {result["id"]: result for result in results}
+    longest = {} # step id -> (ms, chain of step ids ending at it)
+    for step_id in plan.order:
+        result = by_id.get(step_id)
+        if result is None or "started_ms" not in result:
+            continue
+        duration = result["finished_ms"] - result["started_ms"]
+        before = max((longest[dependency] for dependency in plan.steps[step_id].after if dependency in longest),
+                     default=(0.0, []))
+        longest[step_id] = (before[0] + duration, before[1] + [step_id])
+    critical_ms, critical_path = max(longest.values(), default=(0.0, []))
+    passed = sum(1 for result in results if result["passed"])
+    skipped = sum(1 for result in results if "skipped" in result)
+    return {
+        "passed": passed == len(plan.steps),
+        "steps_passed": passed,
+        "steps_failed": len(results) - passed - skipped,
+        "steps_skipped": skipped,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "critical_path_ms": round(critical_ms, 1),
+        "critical_path": critical_path,
+        "serial_ms": round(sum(result["finished_ms"] - result["started_ms"]
+                               for result in results if "started_ms" in result), 1),
+        "steps": [by_id[step_id] for step_id in plan.steps if step_id in by_id],
+    }
+
+# --- Request history log ---
+def history_matches(entry, method=None, host=None, status=None, url_prefix=None, since=None, until=None):
+    """Tells whether a history entry passes the query filters (None = any).
+
+    since/until are ISO 8601 strings compared against the entry timestamp;
+    since is inclusive, until exclusive.
+    """
+    if method and entry.get("method") != method:
+        return False
+    if host and (urlsplit(entry.get("url", "")).hostname or "") != host:
+        return False
+    if status is not None and entry.get("status_code") != status:
+        return False
+    if url_prefix and not entry.get("url", "").startswith(url_prefix):
+        return False
+    timestamp = entry.get("timestamp", "")
+    if since and timestamp < since:
+        return False
+    if until and timestamp >= until:
+        return False
+    return True
+
+class HistoryLog:
+    """Append-only request history stored as JSONL segment files.
+
+    Each send appends one line to the newest segment, so the cost of a write
+    does not depend on how much history exists. Once a segment holds
+    segment_size entries a new one is started, and whole segments that fall
+    outside max_entries are deleted (compaction). An in-memory index of line
+    offsets per segment lets the newest N entries be read and parsed without
+    touching the rest of the log.
+
+    Entries get increasing integer ids. Ids are contiguous within a segment,
+    so an id maps straight to a segment and line without a separate index.
+
+    With a persister attached, appended lines wait in memory and are written
+    together by flush(); reads flush first, so they always see every entry.
+    Appends only take the queue lock, never the lock held while writing.
+    """
+
+    READ_WINDOW = 256 # Lines read per block when scanning backwards
+    persister = None # Set by Persister.register()
+
+    def __init__(self, directory, max_entries, segment_size, legacy_file=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.segment_size = segment_size
+        self._segments = [] # Oldest first: {"seq", "first_id", "offsets", "size"}
+        self._file = None # Append handle for the newest segment
+        self._pending = [] # Encoded lines appended but not yet written
+        self._lock = threading.Lock() # Segment files and their index
+        self._queue_lock = threading.Lock() # _pending and _next_free
+        os.makedirs(directory, exist_ok=True)
+        for seq in sorted(self._segment_numbers()):
+            segment = self._scan(seq)
+            if segment["first_id"] is None:
+                # Written before entries carried ids; continue from the previous segment
+                segment["first_id"] = self._next_id()
+            self._segments.append(segment)
+        self._next_free = self._next_id() # Id of the next append, counting queued lines
+        if not self._segments and legacy_file and os.path.exists(legacy_file):
+            self._migrate(legacy_file)
+
+    def _segment_numbers(self):
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext == ".jsonl" and stem.isdigit():
+                yield int(stem)
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:08d}.jsonl")
+
+    def _scan(self, seq):
+        """Builds the line-offset index of a segment, dropping a torn last line."""
+        path = self._segment_path(seq)
+        offsets = array("Q")
+        pos = 0
+        first_line = b""
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                if pos == 0:
+                    first_line = chunk.split(b"\n", 1)[0]
+                start = 0
+                while True:
+                    nl = chunk.find(b"\n", start)
+                    if nl < 0:
+                        break
+                    start = nl + 1
+                    offsets.append(pos + start) # Start of the *next* line
+                pos += len(chunk)
+        # offsets now holds line ends; turn them into line starts
+        ends = offsets
+        size = ends[-1] if ends else 0
+        if size != pos:
+            # A crash mid-append left a partial line; cut it off
+            with open(path, "r+b") as f:
+                f.truncate(size)
+        starts = array("Q", [0]) + ends[:-1] if ends else array("Q")
+        first_id = None
+        if starts:
+            try:
+                first_id = json.loads(first_line).get("id")
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        return {"seq": seq, "first_id": first_id, "offsets": starts, "size": size}
+
+    def _migrate(self, legacy_file):
+        """Imports the old newest-first JSON history file into the log."""
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (json.JSONDecodeError, IOError):
+            return
+        if isinstance(entries, list):
+            for entry in reversed(entries):
+                self.append(entry)
+
+    def _next_id(self):
+        if not self._segments:
+            return 1
+        last = self._segments[-1]
+        return last["first_id"] + len(last["offsets"])
+
+    def _oldest_id(self):
+        """Lowest id still within max_entries. Caller holds the lock."""
+        return max(1, self._next_id() - self.max_entries)
+
+    def _rotate(self):
+        """Starts a new segment and drops segments past the retention limit."""
+        if self._file:
+            self._file.close()
+        seq = self._segments[-1]["seq"] + 1 if self._segments else 1
+        self._segments.append({"seq": seq, "first_id": self._next_id(), "offsets": array("Q"), "size": 0})
+        self._file = open(self._segment_path(seq), "ab")
+        self._compact()
+
+    def _compact(self):
+        total = sum(len(seg["offsets"]) for seg in self._segments)
+        dropped = False
+        while len(self._segments) > 1 and total - len(self._segments[0]["offsets"]) >= self.max_entries:
+            oldest = self._segments.pop(0)
+            total -= len(oldest["offsets"])
+            dropped = True
+            try:
+                os.remove(self._segment_path(oldest["seq"]))
+            except OSError as e:
+                print(f"Error removing history segment {oldest['seq']}: {e}")
+        if dropped:
+            sweep_blobs(self)
+
+    def blob_digests(self):
+        """Returns the digests of the response bodies the kept entries refer to."""
+        with self._lock, self._queue_lock:
+            paths = [self._segment_path(seg["seq"]) for seg in self._segments]
+            digests = {match.group(1).decode() for line in self._pending
+                       for match in BLOB_DIGEST_PATTERN.finditer(line)}
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    digests.update(match.group(1).decode() for match in BLOB_DIGEST_PATTERN.finditer(f.read()))
+            except FileNotFoundError:
+                pass # Compacted meanwhile
+        return digests
+
+    def append(self, entry):
+        """Appends one entry to the newest segment, setting entry["id"]. Returns the id."""
+        with self._queue_lock:
+            entry["id"] = self._next_free
+            self._next_free += 1
+            self._pending.append((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        if self.persister is None:
+            self.flush()
+        else:
+            self.persister.schedule(self)
+        return entry["id"]
+
+    def _write_pending(self):
+        """Writes queued lines, one write per segment touched. Caller holds the
+        lock; the queue is swapped out first so appends don't wait for the disk."""
+        with self._queue_lock:
+            pending, self._pending = self._pending, []
+        try:
+            while pending:
+                if not self._segments or len(self._segments[-1]["offsets"]) >= self.segment_size:
+                    self._rotate()
+                elif self._file is None:
+                    self._file = open(self._segment_path(self._segments[-1]["seq"]), "ab")
+                segment = self._segments[-1]
+                lines = pending[:self.segment_size - len(segment["offsets"])]
+                self._file.write(b"".join(lines))
+                self._file.flush()
+                for line in lines:
+                    segment["offsets"].append(segment["size"])
+                    segment["size"] += len(line)
+                del pending[:len(lines)]
+        except OSError:
+            with self._queue_lock:
+                self._pending = pending + self._pending # Retried with the next flush
+            raise
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def sync(self):
+        """Writes queued lines and fsyncs the newest segment."""
+        with self._lock:
+            self._write_pending()
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+
+    def __len__(self):
+        with self._lock:
+            self._write_pending()
+            return min(self.max_entries, sum(len(seg["offsets"]) for seg in self._segments))
+
+    def version(self):
+        """Returns a value that changes whenever entries are added or dropped."""
+        with self._queue_lock:
+            return self._next_free # Compaction only happens on append
+
+    def _read_lines(self, segment, start, stop):
+        """Returns raw lines [start, stop) of a segment. Caller holds the lock."""
+        offsets = segment["offsets"]
+        end = offsets[stop] if stop < len(offsets) else segment["size"]
+        with open(self._segment_path(segment["seq"]), "rb") as f:
+            f.seek(offsets[start])
+            return f.read(end - offsets[start]).splitlines()
+
+    def get(self, entry_id):
+        """Returns the entry with the given id, or None if unknown or compacted."""
+        with self._lock:
+            self._write_pending()
+            if not self._oldest_id() <= entry_id < self._next_id():
+                return None
+            firsts = [seg["first_id"] for seg in self._segments]
+            segment = self._segments[bisect.bisect_right(firsts, entry_id) - 1]
+            index = entry_id - segment["first_id"]
+            try:
+                line = self._read_lines(segment, index, index + 1)[0]
+                entry = json.loads(line)
+            except (IOError, IndexError, json.JSONDecodeError):
+                return None
+        entry["id"] = entry_id
+        return entry
+
+    def newest(self, limit):
+        """Returns up to `limit` entries, newest first."""
+        return self.query(limit)
+
+    def query(self, limit, before=None, after=None, **filters):
+        """Returns up to `limit` entries matching history_matches(), newest first.
+
+        `before` is an id cursor: only entries with a smaller id are returned.
+        With `after` only entries with a larger id are.
+        Without filters only the lines returned are read; with filters the
+        log is scanned backwards (it has no secondary indexes) until enough
+        matches are found.
+        """
+        matches = []
+        with self._lock:
+            self._write_pending()
+            oldest = self._oldest_id() if after is None else max(self._oldest_id(), after + 1)
+            below = self._next_id() if before is None else min(before, self._next_id())
+            for segment in reversed(self._segments):
+                if len(matches) >= limit or below <= oldest:
+                    break
+                first = max(segment["first_id"], oldest)
+                stop = min(below, segment["first_id"] + len(segment["offsets"])) - segment["first_id"]
+                low = first - segment["first_id"]
+                while stop > low and len(matches) < limit:
+                    window = self.READ_WINDOW if filters else limit - len(matches)
+                    start = max(low, stop - window)
+                    try:
+                        lines = self._read_lines(segment, start, stop)
+                    except IOError:
+                        break
+                    for offset, line in enumerate(reversed(lines)):
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        entry["id"] = segment["first_id"] + stop - 1 - offset
+                        if history_matches(entry, **filters):
+                            matches.append(entry)
+                            if len(matches) >= limit:
+                                break
+                    stop = start
+                below = min(below, segment["first_id"])
+        return matches
+
+# --- Saved requests store ---
+class ChangeLog:
+    """Remembers which saved requests changed at which store version.
+
+    Lets a client that last saw version V fetch only the names changed
+    since, instead of the whole collection. Versions older than the log, or
+    from before a reload from disk, can't be answered. Callers hold the
+    store's lock.
+    """
+
+    def __init__(self, size):
+        self._entries = deque(maxlen=size) # (version, name), oldest first
+        self._floor = 0 # Lowest version changes_since() can answer
+
+    def add(self, version, name):
+        if len(self._entries) == self._entries.maxlen:
+            self._floor = self._entries[0][0]
+        self._entries.append((version, name))
+
+    def reset(self, version):
+        """Forgets everything up to `version` (the data was replaced wholesale)."""
+        self._entries.clear()
+        self._floor = version
+
+    def changes_since(self, version, current):
+        """Returns the names changed after `version`, or None if unknown."""
+        if not self._floor <= version <= current:
+            return None
+        return {name for changed, name in self._entries if changed > version}
+
+class SavedRequestStore:
+    """Authoritative in-memory copy of the saved requests file.
+
+    Reads are served from memory. The file is re-read only when its mtime or
+    size changes (checked at most every recheck_interval seconds), so edits
+    made outside the app are still picked up. Writes replace the dict instead
+    of mutating it, so a reader never sees a half-updated collection. With a
+    persister attached, the file is rewritten once per flush however many
+    changes were made in between.
+    """
+
+    persister = None # Set by Persister.register()
+
+    def __init__(self, filename, recheck_interval):
+        self.filename = filename
+        self.recheck_interval = recheck_interval
+        self._lock = threading.Lock()
+        self._data = {}
+        self._dirty = False # Memory holds changes not yet in the file
+        self._generation = 0 # Bumped whenever _data is replaced; see version()
+        self._changes = ChangeLog(SAVED_CHANGE_LOG_SIZE)
+        self._signature = None # (mtime_ns, size) of the file last read or written
+        self._checked_at = 0.0
+        self._reload()
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _reload(self):
+        data = load_data(self.filename, {})
+        self._data = data if isinstance(data, dict) else {}
+        self._generation += 1
+        self._changes.reset(self._generation)
+        self._signature = self._stat_signature()
+        self._checked_at = time.monotonic()
+
+    def _refresh(self, force=False):
+        """Re-reads the file if it changed on disk. Caller holds the lock."""
+        now = time.monotonic()
+        if self._dirty or (not force and now - self._checked_at < self.recheck_interval):
+            return
+        self._checked_at = now
+        if self._stat_signature() != self._signature:
+            self._reload()
+
+    def _write(self, data, name):
+        self._data = data
+        self._generation += 1
+        self._changes.add(self._generation, name)
+        self._dirty = True
+        if self.persister is None:
+            self._save()
+
+    def _save(self):
+        """Writes the in-memory data if it changed. Caller holds the lock."""
+        if self._dirty:
+            save_data(self.filename, self._data)
+            self._dirty = False
+            self._signature = self._stat_signature()
+
+    def flush(self):
+        with self._lock:
+            self._save()
+
+    def sync(self):
+        self.flush() # save_data() already fsyncs
+
+    def version(self):
+        """Returns a value that changes whenever the saved requests change."""
+        with self._lock:
+            self._refresh()
+            return self._generation
+
+    def changes_since(self, version):
+        """Returns (current version, names changed since `version` or None if unknown)."""
+        with self._lock:
+            self._refresh()
+            return self._generation, self._changes.changes_since(version, self._generation)
+
+    def all(self):
+        """Returns a snapshot of all saved requests keyed by name. Do not mutate it."""
+        with self._lock:
+            self._refresh()
+            return self._data
+
+    def get(self, name):
+        with self._lock:
+            self._refresh()
+            return self._data.get(name)
+
+    def put(self, name, entry):
+        with self._lock:
+            self._refresh(force=True)
+            data = dict(self._data)
+            data[name] = entry
+            self._write(data, name)
+        if self.persister is not None:
+            self.persister.schedule(self)
+
+    def delete(self, name):
+        """Removes a saved request. Returns False if it didn't exist."""
+        with self._lock:
+            self._refresh(force=True)
+            if name not in self._data:
+                return False
+            data = dict(self._data)
+            del data[name]
+            self._write(data, name)
+        if self.persister is not None:
+            self.persister.schedule(self)
+        return True
+
+# --- SQLite storage backend ---
+class SqliteStorage:
+    """SQLite database (WAL mode) holding saved requests and history.
+
+    History rows keep the full entry as JSON next to indexed columns for
+    timestamp, host, method, status and URL, so filtered queries over large
+    histories don't need to load every entry. Connections are pooled and
+    shared between Flask's request threads.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS saved_requests (
+            name TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS environments (
+            name TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS workflows (
+            name TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seq INTEGER, -- Insert order; ids don't follow it when several processes write
+            timestamp TEXT NOT NULL,
+            method TEXT,
+            url TEXT,
+            host TEXT,
+            status_code INTEGER,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp);
+        CREATE INDEX IF NOT EXISTS idx_history_url ON history (url);
+    """
+
+    # Created after the seq column is added to databases from before it
+    HISTORY_SEQ_INDEXES = """
+        DROP INDEX IF EXISTS idx_history_host;
+        DROP INDEX IF EXISTS idx_history_method;
+        DROP INDEX IF EXISTS idx_history_status;
+        CREATE INDEX IF NOT EXISTS idx_history_seq ON history (seq);
+        CREATE INDEX IF NOT EXISTS idx_history_host_seq ON history (host, seq);
+        CREATE INDEX IF NOT EXISTS idx_history_method_seq ON history (method, seq);
+        CREATE INDEX IF NOT EXISTS idx_history_status_seq ON history (status_code, seq);
+    """
+
+    def __init__(self, filename, max_history, json_sources=None):
+        self.filename = filename
+        self._idle = [] # Pooled connections not currently checked out
+        self._pool_lock = threading.Lock()
+        with self.connect() as conn:
+            conn.executescript(self.SCHEMA)
+            # Names this database in ETags and cursors built from its version counters
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('store_id', ?)", (secrets.token_hex(4),))
+            self.store_id = conn.execute("SELECT value FROM meta WHERE key = 'store_id'").fetchone()[0]
+        self._add_history_seq()
+        if json_sources:
+            self.migrate_from_json(*json_sources)
+        self.saved = SqliteSavedRequests(self, SAVED_RECHECK_INTERVAL)
+        self.history = SqliteHistory(self, max_history)
+        self.environments = SqliteSavedRequests(self, SAVED_RECHECK_INTERVAL,
+                                                table="environments", version_key="environments_version")
+        self.workflows = SqliteSavedRequests(self, SAVED_RECHECK_INTERVAL,
+                                             table="workflows", version_key="workflows_version")
+
+    @contextmanager
+    def connect(self):
+        """Checks out a pooled connection; commits on success, rolls back on error."""
+        with self._pool_lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            with conn:
+                yield conn
+        finally:
+            with self._pool_lock:
+                self._idle.append(conn)
+
+    def _add_history_seq(self):
+        """Numbers the rows of a database from before the seq column in id order."""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+            if "seq" not in columns:
+                conn.execute("ALTER TABLE history ADD COLUMN seq INTEGER")
+                conn.execute("UPDATE history SET seq = id")
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) "
+                             "SELECT 'history_seq', COALESCE(MAX(id), 0) FROM history")
+        with self.connect() as conn:
+            conn.executescript(self.HISTORY_SEQ_INDEXES)
+
+    def checkpoint(self):
+        """Copies the WAL into the database file and fsyncs it."""
+        with self.connect() as conn:
+            conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def migrate_from_json(self, saved_file, history_dir, legacy_history_file):
+        """One-time import of the flat JSON stores, recorded in the meta table."""
+        with self.connect() as conn:
+            # Take the write lock before checking, so two processes starting
+            # on a fresh database don't both import
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return
+            saved = load_data(saved_file, {}) if os.path.exists(saved_file) else {}
+            if os.path.isdir(history_dir):
+                log = HistoryLog(history_dir, MAX_HISTORY_SIZE, HISTORY_SEGMENT_SIZE)
+                history = log.newest(len(log))
+            elif os.path.exists(legacy_history_file):
+                history = load_data(legacy_history_file, [])
+            else:
+                history = []
+            if isinstance(saved, dict):
+                conn.executemany(
+                    "INSERT OR REPLACE INTO saved_requests (name, data) VALUES (?, ?)",
+                    [(name, json.dumps(entry, ensure_ascii=False)) for name, entry in saved.items()])
+            if isinstance(history, list):
+                SqliteHistory.insert(conn, [(None,) + SqliteHistory.row(entry) for entry in reversed(history)])
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)",
+                         (datetime.utcnow().isoformat() + "Z",))
+
+class SqliteSavedRequests:
+    """Saved requests table with the same in-memory caching as SavedRequestStore.
+
+    Also serves the environments and workflows tables, which have the same name -> JSON
+    layout. Every write bumps meta.<version_key> in the same transaction; readers
+    compare it against their copy at most every recheck_interval seconds to
+    pick up writes from other processes. That counter is also the store's
+    version(), so every process sharing the database hands out the same
+    ETags and /changes cursors. With a persister attached, changes are
+    applied to memory at once and written in one transaction per flush.
+    """
+
+    persister = None # Set by Persister.register()
+
+    def __init__(self, storage, recheck_interval, table="saved_requests", version_key="saved_version"):
+        self.storage = storage
+        self.recheck_interval = recheck_interval
+        self.table = table
+        self.version_key = version_key
+        self._lock = threading.Lock()
+        self._data = {}
+        self._pending = {} # name -> entry, or None for a delete, not yet written
+        self._changes = ChangeLog(SAVED_CHANGE_LOG_SIZE) # Keyed by the shared version
+        self._version = None # meta.<version_key> that _data reflects
+        self._checked_at = 0.0
+        with self.storage.connect() as conn:
+            self._reload(conn, self._read_version(conn))
+
+    def _read_version(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (self.version_key,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _reload(self, conn, version):
+        """Reads the table. Names that differ from memory are logged as changed at `version`."""
+        rows = conn.execute(f"SELECT name, data FROM {self.table}").fetchall()
+        data = {name: json.loads(entry) for name, entry in rows}
+        if self._version is None:
+            self._changes.reset(version)
+        else:
+            for name in data.keys() | self._data.keys():
+                if data.get(name) != self._data.get(name):
+                    self._changes.add(version, name)
+        self._data = data
+        self._version = version
+        self._checked_at = time.monotonic()
+
+    def _refresh(self, conn=None, force=False):
+        """Reloads if another writer bumped the version. Caller holds the lock."""
+        now = time.monotonic()
+        if self._pending or (not force and now - self._checked_at < self.recheck_interval):
+            return
+        self._checked_at = now
+        if conn is None:
+            with self.storage.connect() as conn:
+                self._refresh(conn, force=True)
+            return
+        version = self._read_version(conn)
+        if version != self._version:
+            self._reload(conn, version)
+
+    def all(self):
+        """Returns a snapshot of all saved requests keyed by name. Do not mutate it."""
+        with self._lock:
+            self._refresh()
+            return self._data
+
+    def get(self, name):
+        with self._lock:
+            self._refresh()
+            return self._data.get(name)
+
+    def _change(self, name, entry):
+        """Applies a put (entry) or delete (None) to memory and queues it. Caller holds the lock."""
+        data = dict(self._data)
+        if entry is None:
+            del data[name]
+        else:
+            data[name] = entry
+        self._data = data
+        self._pending[name] = entry
+        if self.persister is None:
+            self._write_pending()
+
+    def _write_pending(self):
+        """Writes queued changes in one transaction. Caller holds the lock."""
+        if not self._pending:
+            return
+        with self.storage.connect() as conn:
+            for name, entry in self._pending.items():
+                if entry is None:
+                    conn.execute(f"DELETE FROM {self.table} WHERE name = ?", (name,))
+                else:
+                    conn.execute(f"INSERT OR REPLACE INTO {self.table} (name, data) VALUES (?, ?)",
+                                 (name, json.dumps(entry, ensure_ascii=False)))
+            # Read under the write lock taken by the first statement, so no
+            # other process can bump the version in between
+            current = self._read_version(conn)
+            version = current + 1
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (self.version_key, str(version)))
+            if current != self._version:
+                self._reload(conn, version) # Another process wrote meanwhile; log its changes too
+            for name in self._pending:
+                self._changes.add(version, name)
+            self._version = version
+        self._pending = {}
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def sync(self):
+        self.flush()
+        self.storage.checkpoint()
+
+    def version(self):
+        """Returns meta.<version_key>, writing queued changes first.
+
+        Like the data it is rechecked against the database at most every
+        recheck_interval seconds.
+        """
+        with self._lock:
+            self._write_pending()
+            self._refresh()
+            return self._version
+
+    def changes_since(self, version):
+        """Returns (current version, names changed since `version` or None if unknown)."""
+        with self._lock:
+            self._write_pending()
+            self._refresh()
+            return self._version, self._changes.changes_since(version, self._version)
+
+    def put(self, name, entry):
+        with self._lock:
+            self._refresh(force=True)
+            self._change(name, entry)
+        if self.persister is not None:
+            self.persister.schedule(self)
+
+    def delete(self, name):
+        """Removes a saved request. Returns False if it didn't exist."""
+        with self._lock:
+            self._refresh(force=True)
+            if name not in self._data:
+                return False
+            self._change(name, None)
+        if self.persister is not None:
+            self.persister.schedule(self)
+        return True
+
+class SqliteHistory:
+    """History table; same interface as HistoryLog but with indexed queries.
+
+    Every insert or trim bumps meta.history_version in the same transaction,
+    so version() sees writes from other processes too. With a persister
+    attached, rows are queued and inserted in one transaction per flush;
+    reads flush first. Queued rows need their ids up
+    front, so ids are reserved from the table's AUTOINCREMENT counter in
+    blocks of HISTORY_ID_BLOCK, which keeps them unique when several
+    processes share the database. Ids then only ascend within a process, so
+    rows are ordered and paged by seq, numbered from meta.history_seq in
+    the inserting transaction. Appends only take the queue lock; a flush
+    swaps the queue out and holds the write lock for the transaction.
+    """
+
+    INSERT = ("INSERT INTO history (id, seq, timestamp, method, url, host, status_code, data) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    TRIM_EVERY = 1000 # Inserts between deletions of rows past max_entries
+    persister = None # Set by Persister.register()
+
+    def __init__(self, storage, max_entries):
+        self.storage = storage
+        self.max_entries = max_entries
+        self._inserts = 0
+        self._pending = [] # Rows (with id) not yet inserted
+        self._next_id = self._id_limit = 0 # Reserved, unused id range [next, limit)
+        self._lock = threading.Lock() # _pending and the reserved ids
+        self._write_lock = threading.Lock() # Held by the flush writing the swapped-out rows
+
+    @staticmethod
+    def row(entry):
+        entry = {key: value for key, value in entry.items() if key != "id"}
+        url = entry.get("url", "")
+        return (entry.get("timestamp", ""), entry.get("method"), url,
+                urlsplit(url).hostname or "", entry.get("status_code"),
+                json.dumps(entry, ensure_ascii=False))
+
+    @classmethod
+    def insert(cls, conn, rows):
+        """Inserts rows made by row(), each led by its id or None for a new
+        one, and numbers them in insert order."""
+        conn.execute("INSERT INTO meta (key, value) VALUES ('history_seq', ?) "
+                     "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + ?", (len(rows), len(rows)))
+        first = int(conn.execute("SELECT value FROM meta WHERE key = 'history_seq'").fetchone()[0]) - len(rows) + 1
+        conn.executemany(cls.INSERT, [(row[0], first + i) + row[1:] for i, row in enumerate(rows)])
+
+    def append(self, entry):
+        """Inserts an entry, setting entry["id"]. Returns the id."""
+        if self.persister is None:
+            with self.storage.connect() as conn:
+                self.insert(conn, [(None,) + self.row(entry)])
+                entry["id"] = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                self._bump_version(conn)
+            self._count_inserts(1)
+            return entry["id"]
+        with self._lock:
+            if self._next_id >= self._id_limit:
+                self._reserve_ids()
+            entry["id"] = self._next_id
+            self._next_id += 1
+            self._pending.append((entry["id"],) + self.row(entry))
+        self.persister.schedule(self)
+        return entry["id"]
+
+    def _reserve_ids(self):
+        """Takes the next HISTORY_ID_BLOCK ids from sqlite_sequence. Caller holds the lock."""
+        with self.storage.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'").fetchone()
+            last = row[0] if row else conn.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+            if row:
+                conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'history'", (last + HISTORY_ID_BLOCK,))
+            else:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('history', ?)",
+                             (last + HISTORY_ID_BLOCK,))
+        self._next_id, self._id_limit = last + 1, last + 1 + HISTORY_ID_BLOCK
+
+    def _release_ids(self):
+        """Hands the unused reserved ids back if no process reserved after us."""
+        with self._lock:
+            if self._next_id >= self._id_limit:
+                return
+            with self.storage.connect() as conn:
+                conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'history' AND seq = ?",
+                             (self._next_id - 1, self._id_limit - 1))
+            self._next_id = self._id_limit = 0
+
+    def _count_inserts(self, count):
+        with self._lock:
+            trim = (self._inserts + count) // self.TRIM_EVERY > self._inserts // self.TRIM_EVERY
+            self._inserts += count
+        if trim:
+            self._trim()
+
+    def flush(self):
+        """Inserts queued rows in one transaction.
+
+        Reads wait on the write lock, so they see the rows of a flush that
+        another thread has in flight.
+        """
+        with self._write_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+            try:
+                with self.storage.connect() as conn:
+                    self.insert(conn, rows)
+                    self._bump_version(conn)
+            except sqlite3.Error:
+                with self._lock:
+                    self._pending = rows + self._pending # Retried with the next flush
+                raise
+        self._count_inserts(len(rows))
+
+    def sync(self):
+        self.flush()
+        self._release_ids()
+        self.storage.checkpoint()
+
+    def _trim(self):
+        with self.storage.connect() as conn:
+            deleted = conn.execute("DELETE FROM history WHERE seq <= "
+                                   "(SELECT seq FROM history ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                                   (self.max_entries,)).rowcount
+            if deleted:
+                self._bump_version(conn)
+        if deleted:
+            sweep_blobs(self)
+
+    def blob_digests(self):
+        """Returns the digests of the response bodies the kept rows refer to."""
+        with self.storage.connect() as conn:
+            rows = conn.execute("SELECT json_extract(data, '$.response_body.sha256') FROM history "
+                                "WHERE data LIKE '%\"response_body\"%'").fetchall()
+        return {digest for digest, in rows if digest}
+
+    @staticmethod
+    def _bump_version(conn):
+        conn.execute("INSERT INTO meta (key, value) VALUES ('history_version', '1') "
+                     "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+    def version(self):
+        """Returns a value that changes whenever rows are added or trimmed."""
+        self.flush()
+        with self.storage.connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'history_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def __len__(self):
+        self.flush()
+        with self.storage.connect() as conn:
+            count = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+        return min(count, self.max_entries)
+
+    @staticmethod
+    def _entry(entry_id, data):
+        entry = json.loads(data)
+        entry["id"] = entry_id
+        return entry
+
+    def get(self, entry_id):
+        """Returns the entry with the given id, or None if unknown or trimmed."""
+        self.flush()
+        with self.storage.connect() as conn:
+            row = conn.execute("SELECT id, data FROM history WHERE id = ?", (entry_id,)).fetchone()
+        return self._entry(*row) if row else None
+
+    def newest(self, limit):
+        """Returns up to `limit` entries, newest first."""
+        return self.query(limit)
+
+    def query(self, limit, before=None, after=None, method=None, host=None, status=None, url_prefix=None,
+              since=None, until=None):
+        """Returns up to `limit` entries matching the filters, newest first.
+
+        `before` is an id cursor: only entries inserted before that one are
+        returned. With `after` only entries inserted after it are. A cursor
+        whose entry is gone counts as older than every entry.
+        """
+        clauses, params = [], []
+        if before is not None:
+            clauses.append("seq < COALESCE((SELECT seq FROM history WHERE id = ?), 0)")
+            params.append(before)
+        if after is not None:
+            clauses.append("seq > COALESCE((SELECT seq FROM history WHERE id = ?), 0)")
+            params.append(after)
+        if method:
+            clauses.append("method = ?")
+            params.append(method)
+        if host:
+            clauses.append("host = ?")
+            params.append(host)
+        if status is not None:
+            clauses.append("status_code = ?")
+            params.append(status)
+        if url_prefix:
+            # Range scan instead of LIKE so the url index is used
+            clauses.append("url >= ? AND url < ?")
+            params.extend([url_prefix, url_prefix + "\U0010ffff"])
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        self.flush()
+        with self.storage.connect() as conn:
+            rows = conn.execute(f"SELECT id, data FROM history {where}ORDER BY seq DESC LIMIT ?",
+                                params + [min(limit, self.max_entries)]).fetchall()
+        return [self._entry(entry_id, data) for entry_id, data in rows]
+
+def open_storage(backend):
+    """Returns (saved_store, history_store, environment_store, workflow_store) for the configured backend."""
+    if backend == "sqlite":
+        storage = SqliteStorage(SQLITE_DB_FILE, MAX_HISTORY_SIZE,
+                                json_sources=(SAVED_REQUESTS_FILE, REQUEST_HISTORY_DIR, REQUEST_HISTORY_FILE))
+        return storage.saved, storage.history, storage.environments, storage.workflows
+    if backend == "json":
+        return (SavedRequestStore(SAVED_REQUESTS_FILE, SAVED_RECHECK_INTERVAL),
+                HistoryLog(REQUEST_HISTORY_DIR, MAX_HISTORY_SIZE, HISTORY_SEGMENT_SIZE,
+                           legacy_file=REQUEST_HISTORY_FILE),
+                SavedRequestStore(ENVIRONMENTS_FILE, SAVED_RECHECK_INTERVAL),
+                SavedRequestStore(WORKFLOWS_FILE, SAVED_RECHECK_INTERVAL))
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+# --- Write-behind persistence ---
+class Persister:
+    """Background thread that writes queued store changes in batches.
+
+    Stores keep changes in memory and call schedule(). The thread waits
+    interval seconds after the first change, then flushes every registered
+    store, so a burst of sends or saves costs one write or transaction per
+    store instead of one each. Only stores that scheduled changes are
+    flushed, and each flush is timed as a store write. Failed flushes are
+    logged and retried on the next change. close() flushes and fsyncs
+    everything; open_stores() registers it to run at exit.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stores = [] # (metrics label, store)
+        self._dirty = set() # Stores with changes since their last flush
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event() # Set by close(); cuts the coalescing pause short
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="store-persister", daemon=True)
+        self._thread.start()
+
+    def register(self, store, name):
+        self._stores.append((name, store))
+        store.persister = self
+
+    def schedule(self, store):
+        with self._lock:
+            self._dirty.add(store)
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            if self._closed:
+                return
+            self._stop.wait(self.interval)
+            self._wakeup.clear() # Changes queued from here on start the next round
+            if self._closed:
+                return # close() writes what is left
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for name, store in self._stores:
+            if store not in dirty:
+                continue
+            try:
+                with metrics.timer("resttool_store_write_duration_seconds", {"store": name}):
+                    store.flush()
+            except (OSError, sqlite3.Error) as e:
+                with self._lock:
+                    self._dirty.add(store) # Retried with the next change
+                metrics.inc("resttool_store_write_errors_total", {"file": type(store).__name__})
+                print(f"Error writing {type(store).__name__}: {e}")
+
+    def close(self):
+        """Stops the thread, then writes and fsyncs everything still queued."""
+        self._closed = True
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join(timeout=self.interval + 5)
+        for _, store in self._stores:
+            try:
+                store.sync()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Error writing {type(store).__name__} at shutdown: {e}")
+
+def store_write_timer(store):
+    """Times a write made while the caller waits. With write-behind that is
+    just queueing the change, so the Persister times the real writes instead."""
+    if PERSIST_WRITE_BEHIND:
+        return nullcontext()
+    return metrics.timer("resttool_store_write_duration_seconds", {"store": store})
+
+# Opened on first use by open_stores()
+saved_store = None
+history_store = None
+environment_store = None
+workflow_store = None
+_store_tag = None
+
+def open_stores():
+    """Opens the configured stores once.
+
+    Returns (saved_store, history_store, environment_store, workflow_store).
+    """
+    global saved_store, history_store, environment_store, workflow_store, _store_tag
+    if saved_store is None:
+        saved_store, history_store, environment_store, workflow_store = open_storage(STORAGE_BACKEND)
+        storage = getattr(saved_store, "storage", None)
+        _store_tag = storage.store_id if storage is not None else secrets.token_hex(4)
+        if PERSIST_WRITE_BEHIND:
+            persister = Persister(PERSIST_FLUSH_INTERVAL)
+            persister.register(saved_store, "saved")
+            persister.register(history_store, "history")
+            persister.register(environment_store, "environments")
+            persister.register(workflow_store, "workflows")
+            atexit.register(persister.close)
+    return saved_store, history_store, environment_store, workflow_store
+
+def store_tag():
+    """Names what the stores' version() values count in.
+
+    With SQLite the versions live in the database, so the tag is the
+    database's and every process sharing it agrees. The json backend
+    counts in memory, so its tag is new on every start.
+    """
+    open_stores()
+    return _store_tag
@@ -1,42 +1,132 @@
 #!/usr/bin/env python
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, g, request, jsonify, render_template_string, send_file
 import requests
+import argparse
+import gzip
+import hashlib
 import json
 import os
-from datetime import datetime
+import signal
+import sqlite3
+import sys
+import time
+from o4engine import (
+    BATCH_DEFAULT_WORKERS, BATCH_MAX_WORKERS, BATCH_PER_HOST_LIMIT, DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT, ENVIRONMENTS_FILE, HTTP2_AVAILABLE, HTTP_ENGINES, LOADTEST_MAX_CONCURRENCY,
+    LOADTEST_MAX_DURATION, REPLAY_MODES, REQUEST_HISTORY_DIR, RESPONSE_BLOB_DIR, RETRY_DEFAULT_STATUSES,
+    RETRY_MAX, SAVED_REQUESTS_FILE, SEND_OPTION_FIELDS, SQLITE_DB_FILE, STORAGE_BACKEND,
+    WORKFLOW_PER_HOST_LIMIT, WORKFLOWS_FILE, WorkflowPlan, blob_store,
+    compile_assertions, compile_request, get_download, get_session, load_environment, load_profile,
+    metrics, new_history_entry, open_stores, parse_environment, parse_send_options, parse_workflow,
+    record_history, release_session, run_batch, run_load_test, run_open_load_test, run_workflow,
+    select_saved, send_succeeded, send_with_replay, status_class, store_tag, store_write_timer,
+    workflow_report,
+)
 
 app = Flask(__name__)
 
-# Filenames for storing data
-SAVED_REQUESTS_FILE = 'saved_requests.json'
-REQUEST_HISTORY_FILE = 'request_history.json'
-MAX_HISTORY_SIZE = 20 # Limit history size
-
-# --- Helper functions for file handling ---
-def load_data(filename, default_data):
-    """Loads data from a JSON file. Creates the file if it doesn't exist."""
-    if not os.path.exists(filename):
-        save_data(filename, default_data)
-        return default_data
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        # If the file is corrupt or unreadable, reset to default
-        save_data(filename, default_data)
-        return default_data
-
-def save_data(filename, data):
-    """Saves data to a JSON file."""
-    try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except IOError as e:
-        print(f"Error saving data to {filename}: {e}")
+# Serving (python o4rest.py --production)
+SERVER_HOST = '127.0.0.1' # Use '0.0.0.0' to serve the whole network (use with caution)
+SERVER_PORT = 5000
+SERVER_THREADS = 16 # Requests handled concurrently in production mode
+
+# Sidebar and history API
+HISTORY_DISPLAY_SIZE = 20 # Entries shown in the sidebar (default page size)
+HISTORY_MAX_PAGE_SIZE = 500 # Upper bound for /history?limit=
+
+# Recorded response viewer (/history/<id>/body)
+BODY_PAGE_BYTES = 64 * 1024 # Default length of a ranged body read (viewer page size)
+BODY_MAX_RANGE = 4 * 1024 * 1024 # Largest range served in one /history/<id>/body call
+
+# Conditional GET and compression of read endpoints
+GZIP_MIN_BYTES = 1024 # Smaller responses are sent uncompressed
+GZIP_LEVEL = 6 # zlib level; higher levels save little on JSON
+
+# Pass-through CORS proxy (/proxy/<url>)
+PROXY_TIMEOUT = (10, 60) # (connect, read) seconds; read applies per chunk
+PROXY_CHUNK_SIZE = 64 * 1024 # Bytes relayed per chunk; bounds memory per proxied request
+PROXY_PREFLIGHT_MAX_AGE = 600 # Seconds browsers may cache a preflight answer
+
+# --- Pass-through proxy helpers ---
+# Headers that describe a single connection and must not be relayed (RFC 7230 6.1)
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "trailers", "transfer-encoding", "upgrade",
+}
+
+def proxy_target_url(target, query_string):
+    """Rebuilds the upstream URL from the /proxy/<path:target> segment."""
+    # Clients and servers may collapse "https://" to "https:/" in paths
+    for scheme in ("http:/", "https:/"):
+        if target.startswith(scheme) and not target.startswith(scheme + "/"):
+            target = scheme + "/" + target[len(scheme):]
+    if "://" not in target:
+        target = "http://" + target
+    if query_string:
+        target += "?" + query_string.decode("latin-1")
+    return target
+
+def cors_headers(origin, requested_headers=None):
+    """CORS headers letting the calling page read the proxied response."""
+    headers = {
+        "Access-Control-Allow-Origin": origin or "*",
+        "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, PATCH, OPTIONS, HEAD",
+        "Access-Control-Allow-Headers": requested_headers or "*",
+        "Access-Control-Expose-Headers": "*",
+    }
+    if origin:
+        # Echoing a specific origin allows credentialed requests
+        headers["Access-Control-Allow-Credentials"] = "true"
+        headers["Vary"] = "Origin"
+    return headers
 
-# Load initial data when the app starts
-saved_requests_data = load_data(SAVED_REQUESTS_FILE, {})
-request_history_data = load_data(REQUEST_HISTORY_FILE, [])
+# --- Conditional GET and compression ---
+# ETags and /changes cursors built from store versions start with the
+# store's tag, so they match in every worker sharing a SQLite database
+# and never across a json-backend restart
+ETAG_PREFIX = store_tag()
+
+def read_etag(*parts):
+    """Strong ETag for a read response; gzip and identity variants differ."""
+    tag = "-".join(map(str, parts))
+    return tag + ".gz" if request.accept_encodings["gzip"] else tag
+
+def not_modified(etag):
+    """Returns a 304 response if the client already holds this ETag, else None."""
+    if not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept-Encoding")
+    return response
+
+def finish_read(response, etag, compressed=None):
+    """Sets the ETag of a 200 read response and gzips it if large enough.
+
+    Cache-Control: no-cache makes browsers revalidate on every fetch(), so
+    a sidebar refresh of unchanged data costs a 304 and no serialization.
+    """
+    if response.status_code != 200:
+        return response
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept-Encoding")
+    if etag.endswith(".gz") and not response.is_streamed:
+        if compressed is None and response.content_length >= GZIP_MIN_BYTES:
+            compressed = gzip.compress(response.get_data(), GZIP_LEVEL, mtime=0) # Same bytes in every worker
+        if compressed is not None:
+            response.set_data(compressed)
+            response.headers["Content-Encoding"] = "gzip"
+    return response
+
+# --- Server-Sent Events ---
+def sse_event(event, data):
+    """Formats one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Open the stores when the app starts
+saved_store, history_store, environment_store, workflow_store = open_stores()
 
 # --- HTML Template (Updated with English) ---
 HTML = """
@@ -62,15 +152,23 @@ HTML = """
         .section { margin-bottom: 20px; }
         .section h3 { margin-top: 0; border-bottom: 1px solid #eee; padding-bottom: 5px; }
         #savedRequestsList, #historyList { max-height: 200px; overflow-y: auto; border: 1px solid #eee; padding: 5px; margin-bottom: 10px; }
+        .virtual-spacer { position: relative; }
+        .virtual-row { position: absolute; left: 0; right: 0; height: 30px; box-sizing: border-box; }
         .list-item { display: flex; justify-content: space-between; align-items: center; padding: 3px 0; border-bottom: 1px dashed #eee; }
         .list-item:last-child { border-bottom: none; }
         .list-item span { flex-grow: 1; margin-right: 10px; overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
+        .send-options { display: flex; gap: 5px; }
+        .send-options input { flex: 1; min-width: 0; padding: 8px; margin: 5px 0 10px 0; border: 1px solid #ccc; border-radius: 4px; box-sizing: border-box; }
     </style>
 </head>
 <body>
     <div class="main-container">
         <h2>REST Client Tool</h2>
         <form id="restForm">
+            <label for="environment">Environment:</label>
+            <select id="environment" name="environment" onchange="showEnvironment()" title="Fills in {% raw %}{{variables}}{% endraw %} in URL, headers and body">
+                <option value="">None</option>
+            </select>
             <label for="url">URL:</label>
             <input type="text" id="url" name="url" placeholder="Enter URL" value="https://httpbin.org/get" required>
 
@@ -90,10 +188,33 @@ HTML = """
             <label for="body">Request Body:</label>
             <textarea id="body" name="body" rows="6" placeholder="Enter request body"></textarea>
 
+            <label for="assertions">Assertions (JSON list, optional):</label>
+            <textarea id="assertions" name="assertions" rows="3" placeholder='[{"type": "status", "value": 200}, {"type": "jsonpath", "path": "$.id", "exists": true}, {"type": "latency", "max_ms": 500}]'></textarea>
+
             <label>
                 <input type="checkbox" id="proxy" name="proxy" style="width: auto; margin-right: 5px;">
                 Use CORS Proxy
             </label>
+            <label for="replay">Replay Mode:</label>
+            <select id="replay" name="replay">
+                <option value="off">Off (always live)</option>
+                <option value="record">Record</option>
+                <option value="replay">Replay (recorded if fresh, else live)</option>
+                <option value="offline">Offline (recorded only)</option>
+            </select>
+            <label for="engine">HTTP Engine:</label>
+            <select id="engine" name="engine">
+                <option value="http1">HTTP/1.1 (requests)</option>
+                <option value="http2">HTTP/2 (httpx){% if not http2_available %} - not installed, falls back to HTTP/1.1{% endif %}</option>
+            </select>
+            <label>Timeouts (s) and Retries:</label>
+            <div class="send-options">
+                <input type="number" id="connect_timeout" min="0" step="any" placeholder="Connect ({{ default_connect_timeout }})" title="Connect timeout in seconds">
+                <input type="number" id="read_timeout" min="0" step="any" placeholder="Read ({{ default_read_timeout }})" title="Read timeout: max seconds without data">
+                <input type="number" id="deadline" min="0" step="any" placeholder="Deadline" title="Overall limit in seconds, including retries">
+                <input type="number" id="retries" min="0" max="{{ retry_max }}" placeholder="Retries" title="Extra attempts for idempotent methods">
+                <input type="text" id="retry_on" placeholder="Retry on ({{ retry_default_statuses }})" title="Upstream statuses to retry, comma separated">
+            </div>
             <br><br>
             <button type="submit">Send Request</button>
         </form>
@@ -106,13 +227,88 @@ HTML = """
             <h3>Saved Requests</h3>
             <label for="saveName">Save current as:</label>
             <input type="text" id="saveName" placeholder="Name for the request">
+            <input type="text" id="saveCollection" placeholder="Collection (optional)">
             <button onclick="saveCurrentRequest()">Save</button>
             <div id="savedRequestsList">Loading saved requests...</div>
         </div>
 
+        <div class="section">
+            <h3>Environments</h3>
+            <label for="envName">Name:</label>
+            <input type="text" id="envName" placeholder="e.g. dev, stage, prod">
+            <label for="envVariables">Variables (JSON object):</label>
+            <textarea id="envVariables" rows="4" placeholder='{"base_url": "https://dev.example.com", "token": "..."}'></textarea>
+            <button onclick="saveEnvironment()">Save</button>
+            <button class="delete" onclick="deleteEnvironment()">Delete</button>
+        </div>
+
+        <div class="section">
+            <h3>Batch Run</h3>
+            <label for="batchCollection">Collection:</label>
+            <input type="text" id="batchCollection" placeholder="Collection name">
+            <button onclick="runBatch('collection')">Run Collection</button>
+            <button onclick="runBatch('selected')">Run Selected</button>
+        </div>
+
+        <div class="section">
+            <h3>Workflows</h3>
+            <label for="workflowSelect">Workflow:</label>
+            <select id="workflowSelect" onchange="showWorkflow()"></select>
+            <label for="workflowName">Name:</label>
+            <input type="text" id="workflowName" placeholder="e.g. item-lifecycle">
+            <label for="workflowSteps">Steps (JSON list):</label>
+            <textarea id="workflowSteps" rows="6" placeholder='[{"id": "login", "request": "login", "extract": {"token": "$.access_token"}}, {"id": "create", "request": "create-item", "extract": {"item_id": "$.id"}}, {"id": "delete", "request": "delete-item"}]'></textarea>
+            <button onclick="runWorkflow()">Run</button>
+            <button onclick="saveWorkflow()">Save</button>
+            <button class="delete" onclick="deleteWorkflow()">Delete</button>
+        </div>
+
+        <div class="section">
+            <h3>Load Test</h3>
+            <label for="loadTestName">Saved request:</label>
+            <select id="loadTestName"></select>
+            <label for="loadTestMode">Mode:</label>
+            <select id="loadTestMode" onchange="updateLoadTestMode()">
+                <option value="closed">Closed loop (workers send back to back)</option>
+                <option value="open">Open loop (target arrival rate)</option>
+            </select>
+            <div id="loadTestClosed">
+                <label for="loadTestCount">Total requests:</label>
+                <input type="text" id="loadTestCount" value="100">
+            </div>
+            <div id="loadTestOpen" style="display: none;">
+                <label for="loadTestProfile">Rate profile:</label>
+                <select id="loadTestProfile">
+                    <option value="constant">Constant</option>
+                    <option value="ramp">Linear ramp (start rate to rate)</option>
+                    <option value="step">Steps</option>
+                    <option value="spike">Spike</option>
+                </select>
+                <label>Rate (req/s) / Start rate (ramp):</label>
+                <div class="send-options">
+                    <input type="number" id="loadTestRate" min="0" step="any" value="50" title="Target rate, end rate of a ramp, base rate of a spike">
+                    <input type="number" id="loadTestStartRate" min="0" step="any" placeholder="Start rate" title="Ramp start rate">
+                </div>
+                <label for="loadTestSteps">Steps (seconds:rate, ...):</label>
+                <input type="text" id="loadTestSteps" placeholder="10:50, 10:100, 10:200">
+                <label>Spike (rate, at second, for seconds):</label>
+                <div class="send-options">
+                    <input type="number" id="loadTestSpikeRate" min="0" step="any" placeholder="Spike rate">
+                    <input type="number" id="loadTestSpikeAt" min="0" step="any" placeholder="At">
+                    <input type="number" id="loadTestSpikeDuration" min="0" step="any" placeholder="For">
+                </div>
+            </div>
+            <label for="loadTestConcurrency">Concurrency (max in flight for open loop):</label>
+            <input type="text" id="loadTestConcurrency" value="10">
+            <label for="loadTestDuration">Duration (seconds; optional for closed loop):</label>
+            <input type="text" id="loadTestDuration" placeholder="No limit">
+            <button onclick="runLoadTest()">Run Load Test</button>
+        </div>
+
         <div class="section">
             <h3>History (Last {{ max_history }})</h3>
              <div id="historyList">Loading history...</div>
+             <button id="historyMore" class="load" style="display: none;" onclick="loadOlderHistory()">Load older</button>
         </div>
     </div>
 
@@ -121,54 +317,169 @@ HTML = """
         const methodEl = document.getElementById('method');
         const headersEl = document.getElementById('headers');
         const bodyEl = document.getElementById('body');
+        const assertionsEl = document.getElementById('assertions');
         const proxyEl = document.getElementById('proxy');
+        const replayEl = document.getElementById('replay');
+        const engineEl = document.getElementById('engine');
+        const SEND_OPTION_FIELDS = ['connect_timeout', 'read_timeout', 'deadline', 'retries', 'retry_on'];
         const responseEl = document.getElementById('response');
         const saveNameEl = document.getElementById('saveName');
+        const saveCollectionEl = document.getElementById('saveCollection');
         const savedRequestsListEl = document.getElementById('savedRequestsList');
         const historyListEl = document.getElementById('historyList');
+        const loadTestNameEl = document.getElementById('loadTestName');
 
-        // --- Saved Requests Functions ---
-        async function loadSavedRequests() {
-            try {
-                const response = await fetch('/saved');
-                if (!response.ok) throw new Error('Could not fetch saved requests');
-                const savedRequests = await response.json();
-                savedRequestsListEl.innerHTML = ''; // Clear list
-                if (Object.keys(savedRequests).length === 0) {
-                    savedRequestsListEl.innerHTML = 'No saved requests.';
-                    return;
+        // --- Virtualized Lists ---
+        // Renders only the rows scrolled into view. Rows are {key, data}; a row's
+        // element is kept while its data object stays the same, so an update
+        // rebuilds only the rows that actually changed.
+        const LIST_ROW_HEIGHT = 30; // px, matches .virtual-row
+        const LIST_OVERSCAN = 5; // Rows rendered above and below the visible ones
+
+        class VirtualList {
+            constructor(container, renderRow) {
+                this.container = container;
+                this.renderRow = renderRow;
+                this.rows = [];
+                this.nodes = new Map(); // key -> {data, el} of the rendered rows
+                this.frame = null;
+                this.spacer = document.createElement('div');
+                this.spacer.className = 'virtual-spacer';
+                this.empty = document.createElement('div');
+                this.empty.textContent = container.textContent; // Keep the "Loading..." text
+                container.replaceChildren(this.spacer, this.empty);
+                container.addEventListener('scroll', () => this.schedule());
+            }
+
+            setRows(rows, emptyText = '') {
+                this.rows = rows;
+                this.empty.textContent = rows.length ? '' : emptyText;
+                this.schedule();
+            }
+
+            schedule() {
+                if (this.frame === null) {
+                    this.frame = requestAnimationFrame(() => { this.frame = null; this.render(); });
                 }
-                // Sort names alphabetically
-                const sortedNames = Object.keys(savedRequests).sort((a, b) => a.localeCompare(b));
-
-                sortedNames.forEach(name => {
-                    const div = document.createElement('div');
-                    div.className = 'list-item';
-                    const span = document.createElement('span');
-                    span.textContent = name;
-                    span.title = name; // Show full name on hover
-                    div.appendChild(span);
-
-                    const loadButton = document.createElement('button');
-                    loadButton.textContent = 'Load';
-                    loadButton.className = 'load';
-                    loadButton.onclick = () => loadRequestDetails(name, 'saved');
-                    div.appendChild(loadButton);
-
-                    const deleteButton = document.createElement('button');
-                    deleteButton.textContent = 'Delete';
-                    deleteButton.className = 'delete';
-                    deleteButton.onclick = () => deleteSavedRequest(name);
-                    div.appendChild(deleteButton);
-
-                    savedRequestsListEl.appendChild(div);
-                });
+            }
+
+            render() {
+                this.spacer.style.height = `${this.rows.length * LIST_ROW_HEIGHT}px`;
+                const top = this.container.scrollTop;
+                const first = Math.max(0, Math.floor(top / LIST_ROW_HEIGHT) - LIST_OVERSCAN);
+                const last = Math.min(this.rows.length,
+                    Math.ceil((top + this.container.clientHeight) / LIST_ROW_HEIGHT) + LIST_OVERSCAN);
+                const visible = new Set();
+                for (let i = first; i < last; i++) {
+                    const { key, data } = this.rows[i];
+                    visible.add(key);
+                    let node = this.nodes.get(key);
+                    if (!node || node.data !== data) {
+                        const el = this.renderRow(data, key);
+                        el.classList.add('virtual-row');
+                        if (node) node.el.replaceWith(el); else this.spacer.appendChild(el);
+                        node = { data, el };
+                        this.nodes.set(key, node);
+                    }
+                    node.el.style.top = `${i * LIST_ROW_HEIGHT}px`;
+                }
+                for (const [key, node] of this.nodes) {
+                    if (!visible.has(key)) {
+                        node.el.remove();
+                        this.nodes.delete(key);
+                    }
+                }
+            }
+        }
+
+        // --- Incremental Sidebar Updates ---
+        // /changes returns only what changed since the last cursor, and the lists patch those rows
+        const SIDEBAR_POLL_MS = 5000; // Also picks up changes from other tabs or the CLI
+        let changesCursor = '';
+        let refreshRunning = false;
+        let refreshQueued = false; // A change happened while a refresh was in flight
+
+        async function refreshSidebar() {
+            if (refreshRunning) {
+                refreshQueued = true;
+                return;
+            }
+            refreshRunning = true;
+            try {
+                do {
+                    refreshQueued = false;
+                    const response = await fetch(`/changes?since=${encodeURIComponent(changesCursor)}`);
+                    if (!response.ok) throw new Error('Could not fetch changes');
+                    const changes = await response.json();
+                    applySavedChanges(changes.saved);
+                    applyHistoryChanges(changes.history);
+                    changesCursor = changes.cursor;
+                } while (refreshQueued);
             } catch (error) {
-                console.error("Error loading saved requests:", error);
-                savedRequestsListEl.innerHTML = 'Error loading requests.';
+                console.error("Error refreshing lists:", error);
+                if (!changesCursor) {
+                    savedList.setRows([], 'Error loading requests.');
+                    historyList.setRows([], 'Error loading history.');
+                }
+            } finally {
+                refreshRunning = false;
             }
         }
 
+        // --- Saved Requests Functions ---
+        let savedRequests = {}; // name -> saved request, patched by applySavedChanges()
+        const batchSelection = new Set(); // Names ticked for "Run Selected"
+        const nameCollator = new Intl.Collator();
+        const savedList = new VirtualList(savedRequestsListEl, renderSavedRow);
+
+        function renderSavedRow(item, name) {
+            const div = document.createElement('div');
+            div.className = 'list-item';
+            const checkbox = document.createElement('input');
+            checkbox.type = 'checkbox';
+            checkbox.className = 'batch-select';
+            checkbox.checked = batchSelection.has(name);
+            checkbox.title = 'Select for batch run';
+            checkbox.onchange = () => checkbox.checked ? batchSelection.add(name) : batchSelection.delete(name);
+            div.appendChild(checkbox);
+            const span = document.createElement('span');
+            span.textContent = item.collection ? `${name} [${item.collection}]` : name;
+            span.title = name; // Show full name on hover
+            div.appendChild(span);
+
+            const loadButton = document.createElement('button');
+            loadButton.textContent = 'Load';
+            loadButton.className = 'load';
+            loadButton.onclick = () => loadRequestDetails(name, 'saved');
+            div.appendChild(loadButton);
+
+            const deleteButton = document.createElement('button');
+            deleteButton.textContent = 'Delete';
+            deleteButton.className = 'delete';
+            deleteButton.onclick = () => deleteSavedRequest(name);
+            div.appendChild(deleteButton);
+            return div;
+        }
+
+        function applySavedChanges(changes) {
+            let namesChanged = changes.reset; // Names added or removed, not just entries edited
+            if (changes.reset) savedRequests = {};
+            for (const [name, item] of Object.entries(changes.items)) {
+                if (item === null) {
+                    namesChanged = namesChanged || name in savedRequests;
+                    delete savedRequests[name];
+                    batchSelection.delete(name);
+                } else {
+                    namesChanged = namesChanged || !(name in savedRequests);
+                    savedRequests[name] = item;
+                }
+            }
+            if (!namesChanged && Object.keys(changes.items).length === 0) return;
+            const sortedNames = Object.keys(savedRequests).sort(nameCollator.compare);
+            if (namesChanged) updateLoadTestOptions(sortedNames);
+            savedList.setRows(sortedNames.map(name => ({ key: name, data: savedRequests[name] })), 'No saved requests.');
+        }
+
         async function saveCurrentRequest() {
             const name = saveNameEl.value.trim();
             if (!name) {
@@ -187,7 +498,7 @@ HTML = """
                 const response = await fetch('/saved', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ name, ...requestData })
+                    body: JSON.stringify({ name, collection: saveCollectionEl.value.trim(), ...requestData })
                 });
                 if (!response.ok) {
                     const errorData = await response.json();
@@ -195,7 +506,7 @@ HTML = """
                 }
                 saveNameEl.value = ''; // Clear the input field
                 alert(`Request '${name}' saved.`);
-                loadSavedRequests(); // Reload the list
+                refreshSidebar(); // Patch the list
             } catch (error) {
                 console.error("Error saving request:", error);
                 alert(`Error: ${error.message}`);
@@ -213,51 +524,402 @@ HTML = """
                     throw new Error(errorData.error || 'Could not delete the request');
                 }
                 alert(`Request '${name}' deleted.`);
-                loadSavedRequests(); // Reload the list
+                refreshSidebar(); // Patch the list
             } catch (error) {
                 console.error("Error deleting request:", error);
                 alert(`Error: ${error.message}`);
             }
         }
 
-        // --- History Functions ---
-        async function loadHistory() {
+        // --- Environment Functions ---
+        // The selected environment fills in {% raw %}{{variables}}{% endraw %} when sending; it is not part of saved requests
+        const environmentEl = document.getElementById('environment');
+        const envNameEl = document.getElementById('envName');
+        const envVariablesEl = document.getElementById('envVariables');
+        let environments = {}; // name -> {variables}
+
+        async function loadEnvironments() {
+            try {
+                const response = await fetch('/environments');
+                if (!response.ok) throw new Error('Could not fetch environments');
+                environments = await response.json();
+                const selected = environmentEl.value;
+                environmentEl.innerHTML = '<option value="">None</option>';
+                Object.keys(environments).sort(nameCollator.compare).forEach(name => {
+                    const option = document.createElement('option');
+                    option.value = name;
+                    option.textContent = name;
+                    environmentEl.appendChild(option);
+                });
+                if (selected in environments) environmentEl.value = selected;
+            } catch (error) {
+                console.error("Error loading environments:", error);
+            }
+        }
+
+        function showEnvironment() {
+            const name = environmentEl.value;
+            envNameEl.value = name;
+            envVariablesEl.value = name ? JSON.stringify(environments[name].variables, null, 2) : '';
+        }
+
+        async function saveEnvironment() {
+            const name = envNameEl.value.trim();
+            if (!name) {
+                alert("Please enter a name for the environment.");
+                return;
+            }
+            let variables;
+            try {
+                variables = JSON.parse(envVariablesEl.value.trim() || '{}');
+            } catch (e) {
+                alert("Invalid JSON format in Variables.");
+                return;
+            }
             try {
-                const response = await fetch('/history');
-                 if (!response.ok) throw new Error('Could not fetch history');
-                const history = await response.json();
-                historyListEl.innerHTML = ''; // Clear the list
-                if (history.length === 0) {
-                    historyListEl.innerHTML = 'No history yet.';
+                const response = await fetch('/environments', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ name, variables })
+                });
+                if (!response.ok) {
+                    const errorData = await response.json();
+                    throw new Error(errorData.error || 'Could not save the environment');
+                }
+                await loadEnvironments();
+                environmentEl.value = name;
+            } catch (error) {
+                console.error("Error saving environment:", error);
+                alert(`Error: ${error.message}`);
+            }
+        }
+
+        async function deleteEnvironment() {
+            const name = envNameEl.value.trim();
+            if (!name || !confirm(`Are you sure you want to delete environment '${name}'?`)) {
+                return;
+            }
+            try {
+                const response = await fetch(`/environments/${encodeURIComponent(name)}`, { method: 'DELETE' });
+                if (!response.ok) {
+                    const errorData = await response.json();
+                    throw new Error(errorData.error || 'Could not delete the environment');
+                }
+                await loadEnvironments();
+                showEnvironment();
+            } catch (error) {
+                console.error("Error deleting environment:", error);
+                alert(`Error: ${error.message}`);
+            }
+        }
+
+        // --- Batch Run Functions ---
+        let batchSource = null; // EventSource of the running batch
+
+        function runBatch(mode) {
+            const params = new URLSearchParams();
+            if (mode === 'collection') {
+                const collection = document.getElementById('batchCollection').value.trim();
+                if (!collection) {
+                    alert("Enter a collection name.");
                     return;
                 }
-                history.forEach((item, index) => {
-                    const div = document.createElement('div');
-                    div.className = 'list-item';
-                    const span = document.createElement('span');
-                    // Try to create a readable timestamp
-                    let timeStr = '';
-                    try {
-                       // Use locale default, or specify 'en-US' / 'en-GB' etc. if needed
-                       timeStr = new Date(item.timestamp).toLocaleString(undefined, {dateStyle: 'short', timeStyle: 'medium'});
-                    } catch {
-                       timeStr = item.timestamp; // Fallback
-                    }
-                    const displayText = `${item.method} ${item.url.substring(0, 30)}${item.url.length > 30 ? '...' : ''} (${timeStr})`;
-                    span.textContent = displayText;
-                    span.title = `${item.method} ${item.url}\n${timeStr}`; // Full info on hover
-                    div.appendChild(span);
-
-                    const loadButton = document.createElement('button');
-                    loadButton.textContent = 'Load';
-                    loadButton.className = 'load';
-                    loadButton.onclick = () => loadRequestDetails(index, 'history');
-                    div.appendChild(loadButton);
-                    historyListEl.appendChild(div);
+                params.append('collection', collection);
+            } else {
+                const names = [...batchSelection];
+                if (names.length === 0) {
+                    alert("Tick one or more saved requests first.");
+                    return;
+                }
+                names.forEach(name => params.append('names', name));
+            }
+            if (environmentEl.value) params.append('environment', environmentEl.value);
+            if (batchSource) batchSource.close();
+            const lines = [];
+            responseEl.textContent = 'Starting batch...';
+            batchSource = new EventSource(`/batch?${params}`);
+            batchSource.addEventListener('start', e => {
+                const info = JSON.parse(e.data);
+                lines.push(`Running ${info.total} requests (${info.workers} workers, ${info.per_host} per host)`);
+                responseEl.textContent = lines.join('\\n');
+            });
+            batchSource.addEventListener('result', e => {
+                const r = JSON.parse(e.data);
+                const outcome = r.error ? `ERROR ${r.error}` : r.status_code;
+                const ms = r.timing ? ` ${r.timing.total_ms} ms` : '';
+                let checks = '';
+                if (r.assertions) {
+                    const failed = r.assertions.results.filter(a => !a.passed).map(a => `${a.assertion} (got ${a.actual})`);
+                    checks = failed.length ? `, FAILED ${failed.join('; ')}` : `, ${r.assertions.passed} assertions passed`;
+                }
+                lines.push(`${r.name}: ${r.method || ''} ${r.url || ''} -> ${outcome}${ms}${checks}`);
+                responseEl.textContent = lines.join('\\n');
+            });
+            batchSource.addEventListener('done', e => {
+                const d = JSON.parse(e.data);
+                lines.push(`Done: ${d.succeeded} ok, ${d.failed} failed in ${d.elapsed_ms} ms`);
+                responseEl.textContent = lines.join('\\n');
+                batchSource.close();
+                batchSource = null;
+                refreshSidebar();
+            });
+            batchSource.onerror = () => {
+                // Validation errors come back as plain JSON, which EventSource reports as an error
+                if (batchSource && lines.length === 0) responseEl.textContent = 'Batch could not be started.';
+                if (batchSource) batchSource.close();
+                batchSource = null;
+            };
+        }
+
+        // --- Workflow Functions ---
+        // Steps run once the steps they depend on passed; extracted values fill in {% raw %}{{variables}}{% endraw %} of later steps
+        const workflowSelectEl = document.getElementById('workflowSelect');
+        const workflowNameEl = document.getElementById('workflowName');
+        const workflowStepsEl = document.getElementById('workflowSteps');
+        let workflows = {}; // name -> {steps}
+        let workflowSource = null; // EventSource of the running workflow
+
+        async function loadWorkflows() {
+            try {
+                const response = await fetch('/workflows');
+                if (!response.ok) throw new Error('Could not fetch workflows');
+                workflows = await response.json();
+                const selected = workflowSelectEl.value;
+                workflowSelectEl.innerHTML = '<option value="">New workflow</option>';
+                Object.keys(workflows).sort(nameCollator.compare).forEach(name => {
+                    const option = document.createElement('option');
+                    option.value = name;
+                    option.textContent = name;
+                    workflowSelectEl.appendChild(option);
+                });
+                if (selected in workflows) workflowSelectEl.value = selected;
+            } catch (error) {
+                console.error("Error loading workflows:", error);
+            }
+        }
+
+        function showWorkflow() {
+            const name = workflowSelectEl.value;
+            workflowNameEl.value = name;
+            workflowStepsEl.value = name ? JSON.stringify(workflows[name].steps, null, 2) : '';
+        }
+
+        async function saveWorkflow() {
+            const name = workflowNameEl.value.trim();
+            if (!name) {
+                alert("Please enter a name for the workflow.");
+                return;
+            }
+            let steps;
+            try {
+                steps = JSON.parse(workflowStepsEl.value.trim() || '[]');
+            } catch (e) {
+                alert("Invalid JSON format in Steps.");
+                return;
+            }
+            try {
+                const response = await fetch('/workflows', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ name, steps })
+                });
+                if (!response.ok) {
+                    const errorData = await response.json();
+                    throw new Error(errorData.error || 'Could not save the workflow');
+                }
+                await loadWorkflows();
+                workflowSelectEl.value = name;
+            } catch (error) {
+                console.error("Error saving workflow:", error);
+                alert(`Error: ${error.message}`);
+            }
+        }
+
+        async function deleteWorkflow() {
+            const name = workflowNameEl.value.trim();
+            if (!name || !confirm(`Are you sure you want to delete workflow '${name}'?`)) {
+                return;
+            }
+            try {
+                const response = await fetch(`/workflows/${encodeURIComponent(name)}`, { method: 'DELETE' });
+                if (!response.ok) {
+                    const errorData = await response.json();
+                    throw new Error(errorData.error || 'Could not delete the workflow');
+                }
+                await loadWorkflows();
+                showWorkflow();
+            } catch (error) {
+                console.error("Error deleting workflow:", error);
+                alert(`Error: ${error.message}`);
+            }
+        }
+
+        function runWorkflow() {
+            const name = workflowSelectEl.value;
+            if (!name) {
+                alert("Save the workflow first, then pick it to run it.");
+                return;
+            }
+            const params = new URLSearchParams();
+            if (environmentEl.value) params.append('environment', environmentEl.value);
+            if (workflowSource) workflowSource.close();
+            const lines = [];
+            responseEl.textContent = 'Starting workflow...';
+            workflowSource = new EventSource(`/workflows/${encodeURIComponent(name)}/run?${params}`);
+            workflowSource.addEventListener('start', e => {
+                const info = JSON.parse(e.data);
+                lines.push(`Running workflow ${info.workflow}: ${info.total} steps`);
+                responseEl.textContent = lines.join('\\n');
+            });
+            workflowSource.addEventListener('step', e => {
+                const r = JSON.parse(e.data);
+                let outcome;
+                if (r.skipped) outcome = `SKIPPED (${r.skipped})`;
+                else if (r.error) outcome = `ERROR ${r.error}`;
+                else outcome = `${r.status_code} ${r.passed ? 'ok' : 'FAILED'}`;
+                const span = r.started_ms !== undefined ? ` [${r.started_ms}-${r.finished_ms} ms]` : '';
+                const extracted = r.extracted ? ` -> ${Object.keys(r.extracted).join(', ')}` : '';
+                const problem = r.extract_error ? ` (${r.extract_error})` : '';
+                lines.push(`${r.id}: ${r.method || ''} ${r.url || ''} ${outcome}${span}${extracted}${problem}`);
+                responseEl.textContent = lines.join('\\n');
+            });
+            workflowSource.addEventListener('done', e => {
+                const d = JSON.parse(e.data);
+                lines.push(`Done: ${d.steps_passed} passed, ${d.steps_failed} failed, ${d.steps_skipped} skipped in ${d.elapsed_ms} ms`);
+                lines.push(`Critical path ${d.critical_path_ms} ms (${d.critical_path.join(' > ')}); ${d.serial_ms} ms if run one by one`);
+                responseEl.textContent = lines.join('\\n');
+                workflowSource.close();
+                workflowSource = null;
+                refreshSidebar();
+            });
+            workflowSource.onerror = () => {
+                if (workflowSource && lines.length === 0) responseEl.textContent = 'Workflow could not be started.';
+                if (workflowSource) workflowSource.close();
+                workflowSource = null;
+            };
+        }
+
+        // --- Load Test Functions ---
+        function updateLoadTestOptions(names) {
+            const selected = loadTestNameEl.value;
+            loadTestNameEl.innerHTML = '';
+            names.sort((a, b) => a.localeCompare(b)).forEach(name => {
+                const option = document.createElement('option');
+                option.value = name;
+                option.textContent = name;
+                loadTestNameEl.appendChild(option);
+            });
+            if (names.includes(selected)) loadTestNameEl.value = selected;
+        }
+
+        function updateLoadTestMode() {
+            const open = document.getElementById('loadTestMode').value === 'open';
+            document.getElementById('loadTestOpen').style.display = open ? '' : 'none';
+            document.getElementById('loadTestClosed').style.display = open ? 'none' : '';
+        }
+
+        async function runLoadTest() {
+            const name = loadTestNameEl.value;
+            if (!name) {
+                alert("Save a request first to load test it.");
+                return;
+            }
+            const value = id => document.getElementById(id).value.trim();
+            const mode = value('loadTestMode');
+            const params = {
+                name,
+                mode,
+                environment: environmentEl.value,
+                concurrency: value('loadTestConcurrency'),
+                duration: value('loadTestDuration')
+            };
+            if (mode === 'open') {
+                Object.assign(params, {
+                    profile: value('loadTestProfile'),
+                    rate: value('loadTestRate'),
+                    start_rate: value('loadTestStartRate'),
+                    steps: value('loadTestSteps'),
+                    spike_rate: value('loadTestSpikeRate'),
+                    spike_at: value('loadTestSpikeAt'),
+                    spike_duration: value('loadTestSpikeDuration')
+                });
+            } else {
+                params.count = value('loadTestCount');
+            }
+            responseEl.textContent = `Running load test for '${name}'...`;
+            try {
+                const response = await fetch('/loadtest', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify(params)
                 });
+                const data = await response.json();
+                responseEl.textContent = JSON.stringify(data, null, 2);
+            } catch (error) {
+                console.error("Error running load test:", error);
+                responseEl.textContent = `Error running load test: ${error}`;
+            }
+        }
+
+        // --- History Functions ---
+        let historyItems = []; // Newest first: the latest page plus pages loaded with "Load older"
+        let historyCursor = null; // next_cursor of the oldest page loaded
+        const historyList = new VirtualList(historyListEl, renderHistoryRow);
+
+        function renderHistoryRow(item) {
+            const div = document.createElement('div');
+            div.className = 'list-item';
+            const span = document.createElement('span');
+            // Try to create a readable timestamp
+            let timeStr = '';
+            try {
+               // Use locale default, or specify 'en-US' / 'en-GB' etc. if needed
+               timeStr = new Date(item.timestamp).toLocaleString(undefined, {dateStyle: 'short', timeStyle: 'medium'});
+            } catch {
+               timeStr = item.timestamp; // Fallback
+            }
+            const displayText = `${item.method} ${item.url.substring(0, 30)}${item.url.length > 30 ? '...' : ''} (${timeStr})`;
+            span.textContent = displayText;
+            span.title = `${item.method} ${item.url}\n${timeStr}`; // Full info on hover
+            div.appendChild(span);
+
+            const loadButton = document.createElement('button');
+            loadButton.textContent = 'Load';
+            loadButton.className = 'load';
+            loadButton.onclick = () => loadRequestDetails(item.id, 'history');
+            div.appendChild(loadButton);
+            return div;
+        }
+
+        function showHistory() {
+            historyList.setRows(historyItems.map(item => ({ key: item.id, data: item })), 'No history yet.');
+            document.getElementById('historyMore').style.display = historyCursor !== null ? '' : 'none';
+        }
+
+        function applyHistoryChanges(changes) {
+            if (changes.reset) {
+                historyItems = changes.items;
+                historyCursor = changes.next_cursor;
+            } else if (changes.items.length) {
+                historyItems = changes.items.concat(historyItems);
+            } else {
+                return;
+            }
+            showHistory();
+        }
+
+        async function loadOlderHistory() {
+            if (historyCursor === null) return;
+            try {
+                const response = await fetch(`/history?limit={{ max_history }}&cursor=${historyCursor}`);
+                if (!response.ok) throw new Error('Could not fetch history');
+                const page = await response.json();
+                historyItems = historyItems.concat(page.items);
+                historyCursor = page.next_cursor;
+                showHistory();
             } catch (error) {
                 console.error("Error loading history:", error);
-                historyListEl.innerHTML = 'Error loading history.';
+                alert(`Error: ${error.message}`);
             }
         }
 
@@ -282,7 +944,12 @@ HTML = """
                 // Save headers as string to easily repopulate textarea
                 headers: headersText,
                 body: bodyEl.value,
-                proxy: proxyEl.checked
+                assertions: assertionsEl.value,
+                proxy: proxyEl.checked,
+                replay: replayEl.value,
+                engine: engineEl.value,
+                // Empty fields mean the server defaults
+                ...Object.fromEntries(SEND_OPTION_FIELDS.map(field => [field, document.getElementById(field).value]))
             };
         }
 
@@ -291,7 +958,12 @@ HTML = """
             methodEl.value = data.method || 'GET';
             headersEl.value = data.headers || ''; // Restore as string
             bodyEl.value = data.body || '';
+            assertionsEl.value = data.assertions || '';
             proxyEl.checked = data.proxy || false;
+            replayEl.value = data.replay || 'off';
+            engineEl.value = data.engine || 'http1';
+            SEND_OPTION_FIELDS.forEach(field => { document.getElementById(field).value = data[field] ?? ''; });
+            saveCollectionEl.value = data.collection || '';
         }
 
         async function loadRequestDetails(identifier, type) {
@@ -302,21 +974,22 @@ HTML = """
                     if (!response.ok) throw new Error('Could not fetch saved request details');
                     dataToLoad = await response.json();
                 } else if (type === 'history') {
-                    // Fetch the whole history again and select the correct index
-                    // (Alternative: an endpoint like /history/<index>)
-                    const response = await fetch('/history');
-                     if (!response.ok) throw new Error('Could not fetch history for loading');
-                    const history = await response.json();
-                    if (identifier >= 0 && identifier < history.length) {
-                         dataToLoad = history[identifier];
-                    } else {
-                        throw new Error('Invalid history index');
-                    }
+                    const response = await fetch(`/history/${identifier}`);
+                    if (!response.ok) throw new Error('Could not fetch history entry');
+                    dataToLoad = await response.json();
                 }
 
                 if (dataToLoad) {
                     populateForm(dataToLoad);
                     responseEl.textContent = `Loaded '${type === 'saved' ? identifier : 'history item'}'. Send request to see results.`;
+                    if (type === 'history' && dataToLoad.response_body) {
+                        // The response body recorded for this entry is kept in the blob store
+                        const viewButton = document.createElement('button');
+                        viewButton.className = 'load';
+                        viewButton.textContent = `View recorded response (${dataToLoad.status_code}, ${dataToLoad.response_body.bytes} bytes)`;
+                        viewButton.onclick = () => showRecordedBody(identifier);
+                        responseEl.append(document.createElement('br'), viewButton);
+                    }
                     // Scroll form to top if needed
                     window.scrollTo(0, 0);
                 }
@@ -326,6 +999,59 @@ HTML = """
             }
         }
 
+        // --- Recorded Response Viewer ---
+        // Pages through a stored body with ranged requests, so huge bodies are never loaded whole
+        const BODY_PAGE_BYTES = {{ body_page_bytes }};
+
+        async function showRecordedBody(id, { offset = 0, line = null } = {}) {
+            try {
+                let url = `/history/${id}/body?length=${BODY_PAGE_BYTES}`;
+                url += line !== null ? `&line=${line}` : `&offset=${offset}`;
+                const response = await fetch(url);
+                if (response.status === 416) {
+                    alert('That position is past the end of the response.');
+                    return;
+                }
+                if (!response.ok) throw new Error('Could not fetch recorded response');
+                const start = parseInt(response.headers.get('X-Body-Offset') || '0', 10);
+                const size = parseInt(response.headers.get('X-Body-Size') || '0', 10);
+                const lines = response.headers.get('X-Body-Lines');
+                const bytes = await response.arrayBuffer();
+                const end = start + bytes.byteLength;
+
+                responseEl.innerHTML = '';
+                const controls = document.createElement('div');
+                const info = document.createElement('span');
+                info.textContent = `Bytes ${start}-${end} of ${size || '?'}${lines ? ` (${lines} lines)` : ''} `;
+                controls.appendChild(info);
+                const prev = document.createElement('button');
+                prev.textContent = 'Previous';
+                prev.disabled = start === 0;
+                prev.onclick = () => showRecordedBody(id, { offset: Math.max(0, start - BODY_PAGE_BYTES) });
+                controls.appendChild(prev);
+                const next = document.createElement('button');
+                next.textContent = 'Next';
+                next.disabled = size > 0 && end >= size;
+                next.onclick = () => showRecordedBody(id, { offset: end });
+                controls.appendChild(next);
+                const lineInput = document.createElement('input');
+                lineInput.type = 'number';
+                lineInput.min = '1';
+                lineInput.placeholder = 'Line';
+                lineInput.style.width = '90px';
+                controls.appendChild(lineInput);
+                const goButton = document.createElement('button');
+                goButton.textContent = 'Go to line';
+                goButton.onclick = () => showRecordedBody(id, { line: Math.max(0, parseInt(lineInput.value, 10) - 1 || 0) });
+                controls.appendChild(goButton);
+                responseEl.appendChild(controls);
+                responseEl.appendChild(document.createTextNode(new TextDecoder().decode(bytes)));
+            } catch (error) {
+                console.error("Error loading recorded response:", error);
+                alert(`Error: ${error.message}`);
+            }
+        }
+
         // --- Form Submit Event Listener ---
         document.getElementById('restForm').addEventListener('submit', async function(e) {
             e.preventDefault();
@@ -340,7 +1066,7 @@ HTML = """
                     // This parse should succeed because it was validated in getCurrentRequestData
                     headersObj = JSON.parse(requestData.headers);
                  }
-                 const payload = { ...requestData, headers: headersObj }; // Send parsed object
+                 const payload = { ...requestData, headers: headersObj, environment: environmentEl.value }; // Send parsed object
 
                  const response = await fetch('/request', {
                     method: 'POST',
@@ -350,7 +1076,14 @@ HTML = """
                 const data = await response.json();
                 // Display regardless of ok status, as backend includes status_code/error
                 responseEl.textContent = JSON.stringify(data, null, 2);
-                loadHistory(); // Reload history after a request attempt
+                if (data.download_url) {
+                    // Body was larger than the preview; offer the full file
+                    const link = document.createElement('a');
+                    link.href = data.download_url;
+                    link.textContent = `Download full body (${data.body_bytes} bytes)`;
+                    responseEl.prepend(link, document.createElement('br'));
+                }
+                refreshSidebar(); // Show the new history entry
 
             } catch (error) {
                  // If the error was due to invalid JSON caught by getCurrentRequestData
@@ -363,14 +1096,16 @@ HTML = """
                 console.error("Error sending request:", error);
                 responseEl.textContent = `Error sending request: ${error}`;
                 // Optionally load history even on failure for debugging
-                // loadHistory();
+                // refreshSidebar();
             }
         });
 
         // --- Load initial data on page load ---
         document.addEventListener('DOMContentLoaded', () => {
-            loadSavedRequests();
-            loadHistory();
+            refreshSidebar();
+            loadEnvironments();
+            loadWorkflows();
+            setInterval(() => { if (!document.hidden) refreshSidebar(); }, SIDEBAR_POLL_MS);
         });
 
     </script>
@@ -378,16 +1113,58 @@ HTML = """
 </html>
 """
 
+# --- Request metrics for the tool itself ---
+metrics.describe("resttool_http_request_duration_seconds", "histogram",
+                 "Time spent handling requests to the tool itself, by route.")
+metrics.describe("resttool_http_in_flight", "gauge", "Requests to the tool currently being handled.")
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    metrics.inc("resttool_http_in_flight", amount=1)
+
+@app.after_request
+def observe_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("resttool_http_request_duration_seconds",
+                    {"route": route, "method": request.method, "status_class": status_class(response.status_code)},
+                    time.perf_counter() - g.metrics_started)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if "metrics_started" in g:
+        metrics.inc("resttool_http_in_flight", amount=-1)
+
 # --- Flask Routes ---
+index_page = None # Rendered once by render_index()
+
+def render_index():
+    """Renders the page on first use; every value it uses is fixed at startup."""
+    global index_page
+    if index_page is None:
+        # Pass max history size to the template
+        body = render_template_string(HTML, max_history=HISTORY_DISPLAY_SIZE, body_page_bytes=BODY_PAGE_BYTES,
+                                      http2_available=HTTP2_AVAILABLE,
+                                      default_connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                                      default_read_timeout=DEFAULT_READ_TIMEOUT, retry_max=RETRY_MAX,
+                                      retry_default_statuses=",".join(map(str, RETRY_DEFAULT_STATUSES))
+                                      ).encode("utf-8")
+        index_page = {"body": body, "gzip": gzip.compress(body, GZIP_LEVEL, mtime=0),
+                      "etag": hashlib.sha256(body).hexdigest()[:16]}
+    return index_page
+
 @app.route("/")
 def index():
-    # Pass max history size to the template
-    return render_template_string(HTML, max_history=MAX_HISTORY_SIZE)
+    page = render_index()
+    etag = read_etag(page["etag"])
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    return finish_read(Response(page["body"], mimetype="text/html"), etag, compressed=page["gzip"])
 
 @app.route("/request", methods=["POST"])
 def make_request():
-    global request_history_data # Allow modification of the global list
-
     data = request.get_json()
     if not data or not data.get("url"):
         return jsonify({"error": "Missing 'url' in request"}), 400
@@ -398,75 +1175,41 @@ def make_request():
     headers = data.get("headers", {})
     body = data.get("body", "")
     use_proxy = data.get("proxy", False)
+    replay_mode = data.get("replay") or "off"
+    if replay_mode not in REPLAY_MODES:
+        return jsonify({"error": f"'replay' must be one of: {', '.join(REPLAY_MODES)}"}), 400
+    engine = data.get("engine") or "http1"
+    if engine not in HTTP_ENGINES:
+        return jsonify({"error": f"'engine' must be one of: {', '.join(HTTP_ENGINES)}"}), 400
+    try:
+        options = parse_send_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Fill in {{variables}} from the selected environment
+    environment = data.get("environment") or ""
+    try:
+        url, headers, body = compile_request(url, headers, body).render(load_environment(environment))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        checks = compile_assertions(data.get("assertions"))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid assertions: {e}"}), 400
 
     # --- Prepare details for history BEFORE the request ---
     # Advantage: Saved even if the request fails completely
     # Disadvantage: Timestamp is *before* the request completes
     # We save afterwards to get a more complete picture (including status)
-    request_details_for_history = {
-        "timestamp": datetime.utcnow().isoformat() + "Z", # ISO 8601 UTC
-        "url": url,
-        "method": method,
-        # Store headers as string in history, like saved requests
-        "headers": json.dumps(headers) if headers else "",
-        "body": body,
-        "proxy": use_proxy
-    }
-
-    result = {}
-    status_code = 500 # Default for unexpected errors
-
-    try:
-        # Send body as JSON if Content-Type is application/json
-        # Otherwise send as raw data (string)
-        kwargs = {
-            "headers": headers,
-            "timeout": 10 # Add a timeout
-        }
-        if body:
-            # Try to parse as JSON only if Content-Type header is set correctly
-            if str(headers.get("Content-Type", "")).lower().strip() == "application/json":
-                try:
-                    # Use json= for requests library to handle serialization and Content-Type
-                    kwargs["json"] = json.loads(body)
-                except json.JSONDecodeError:
-                    # If it's not valid JSON but header is set, send as data anyway? Or error?
-                    # Sending as data here. Ensure it's bytes.
-                     kwargs["data"] = body.encode('utf-8')
-            else:
-                 # Ensure body is bytes for the data argument
-                 kwargs["data"] = body.encode('utf-8')
-
-        resp = requests.request(method, url, **kwargs)
-
-        status_code = resp.status_code
-        result = {
-            "status_code": resp.status_code,
-            "headers": dict(resp.headers),
-            "body": resp.text # Always show text, even if it's JSON content
-        }
-    except requests.exceptions.Timeout:
-        result = {"error": "Request timed out after 10 seconds."}
-        status_code = 408
-    except requests.exceptions.RequestException as e:
-        result = { "error": f"Request failed: {str(e)}" }
-        # Status code isn't set by the exception, default 500 might be misleading
-        # Let's use a common code for connection errors if possible, or leave it
-        status_code = 503 # Service Unavailable might fit network issues
-    except Exception as e:
-        result = { "error": f"An unexpected error occurred: {str(e)}" }
-        status_code = 500
+    request_details_for_history = new_history_entry(url, method, headers, body, use_proxy)
+    if environment:
+        request_details_for_history["environment"] = environment
 
+    result, status_code = send_with_replay(method, url, headers, body, replay_mode, engine, options)
+    if checks:
+        result["assertions"] = checks.summary(checks.evaluate(result))
 
     # --- Save to history AFTER the request attempt ---
-    # Optionally add status code to history item
-    # request_details_for_history["status_code"] = status_code
-    request_history_data.insert(0, request_details_for_history) # Add to beginning (newest)
-    # Limit history size
-    if len(request_history_data) > MAX_HISTORY_SIZE:
-        request_history_data = request_history_data[:MAX_HISTORY_SIZE]
-    # Save updated history to file
-    save_data(REQUEST_HISTORY_FILE, request_history_data)
+    result["history_id"] = record_history(request_details_for_history, result)
 
     # --- Send response to client ---
     response = jsonify(result)
@@ -479,70 +1222,568 @@ def make_request():
 
     return response
 
+# --- Pass-through CORS Proxy ---
+@app.route("/proxy/<path:target>", merge_slashes=False,
+           methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"])
+def proxy(target):
+    """Forwards a request upstream and streams the response back with CORS headers.
+
+    Point a browser app at /proxy/https://api.example.com/path to get around
+    CORS during development. Bodies are relayed chunk by chunk in both
+    directions, so large responses are never held in memory.
+    """
+    origin = request.headers.get("Origin")
+    if request.method == "OPTIONS" and "Access-Control-Request-Method" in request.headers:
+        # Answer the browser's preflight ourselves instead of forwarding it
+        response = Response(status=204)
+        response.headers.update(cors_headers(origin, request.headers.get("Access-Control-Request-Headers")))
+        response.headers["Access-Control-Max-Age"] = str(PROXY_PREFLIGHT_MAX_AGE)
+        return response
+
+    url = proxy_target_url(target, request.query_string)
+    headers = {key: value for key, value in request.headers.items()
+               if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in ("host", "origin")}
+    has_body = request.content_length or request.headers.get("Transfer-Encoding")
+
+    pool_entry = get_session(url)
+    try:
+        upstream = pool_entry["session"].request(
+            request.method, url, headers=headers,
+            data=request.stream if has_body else None,
+            stream=True, allow_redirects=False, timeout=PROXY_TIMEOUT)
+    except requests.exceptions.Timeout:
+        release_session(pool_entry)
+        response = jsonify({"error": f"Upstream timed out: {url}"})
+        response.status_code = 504
+        response.headers.update(cors_headers(origin))
+        return response
+    except requests.exceptions.RequestException as e:
+        release_session(pool_entry)
+        response = jsonify({"error": f"Upstream request failed: {str(e)}"})
+        response.status_code = 502
+        response.headers.update(cors_headers(origin))
+        return response
+
+    def relay():
+        try:
+            # Pass bytes through untouched; Content-Encoding is relayed as-is
+            for chunk in upstream.raw.stream(PROXY_CHUNK_SIZE, decode_content=False):
+                yield chunk
+        finally:
+            upstream.close()
+            release_session(pool_entry)
+
+    response_headers = [(key, value) for key, value in upstream.raw.headers.items()
+                        if key.lower() not in HOP_BY_HOP_HEADERS
+                        and not key.lower().startswith("access-control-")]
+    response = Response(relay(), status=upstream.status_code, headers=response_headers,
+                        direct_passthrough=True)
+    response.headers.update(cors_headers(origin))
+    # "*" is ignored for credentialed requests, so name the relayed headers
+    response.headers["Access-Control-Expose-Headers"] = ", ".join(key for key, _ in response_headers)
+    return response
+
 # --- Endpoints for Saved Requests ---
 @app.route("/saved", methods=["GET"])
 def get_saved_requests():
     """Returns all saved requests (names and data)."""
-    # Read from file each time to get latest data (alternative: use global)
-    data = load_data(SAVED_REQUESTS_FILE, {})
-    return jsonify(data)
+    etag = read_etag(ETAG_PREFIX, "saved", saved_store.version())
+    return not_modified(etag) or finish_read(jsonify(saved_store.all()), etag)
 
 @app.route("/saved/<name>", methods=["GET"])
 def get_saved_request_details(name):
     """Returns details for a specific saved request."""
-    data = load_data(SAVED_REQUESTS_FILE, {})
-    if name in data:
-        return jsonify(data[name])
+    etag = read_etag(ETAG_PREFIX, "saved", saved_store.version())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    saved = saved_store.get(name)
+    if saved is not None:
+        return finish_read(jsonify(saved), etag)
     else:
         return jsonify({"error": "Saved request not found"}), 404
 
 @app.route("/saved", methods=["POST"])
 def add_saved_request():
     """Saves a new request."""
-    global saved_requests_data # Use global variable to update in memory
     req_data = request.get_json()
     name = req_data.get('name')
     if not name:
         return jsonify({"error": "Missing 'name' for saved request"}), 400
 
-    # Read current data from file first to avoid overwrites in concurrent scenarios (unlikely here)
-    current_data = load_data(SAVED_REQUESTS_FILE, {})
-
-    current_data[name] = {
+    entry = {
         "url": req_data.get("url", ""),
         "method": req_data.get("method", "GET"),
         "headers": req_data.get("headers", ""), # Save as string
         "body": req_data.get("body", ""),
-        "proxy": req_data.get("proxy", False)
+        "proxy": req_data.get("proxy", False),
+        "collection": req_data.get("collection", ""), # Optional group for batch runs
+        "replay": req_data.get("replay", "off"),
+        "engine": req_data.get("engine", "http1"),
+        "assertions": req_data.get("assertions", "") # JSON list as a string, like headers
     }
-    saved_requests_data = current_data # Update global variable too
-    save_data(SAVED_REQUESTS_FILE, current_data)
+    # Timeout and retry settings, validated here so bad values fail on save
+    entry.update({field: req_data.get(field, "") for field in SEND_OPTION_FIELDS})
+    try:
+        parse_send_options(entry)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        compile_assertions(entry["assertions"])
+    except ValueError as e:
+        return jsonify({"error": f"Invalid assertions: {e}"}), 400
+    try:
+        with store_write_timer("saved"):
+            saved_store.put(name, entry)
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({"error": f"Could not save request: {e}"}), 500
     return jsonify({"message": f"Request '{name}' saved successfully."}), 201
 
 @app.route("/saved/<name>", methods=["DELETE"])
 def delete_saved_request(name):
     """Deletes a saved request."""
-    global saved_requests_data
-    current_data = load_data(SAVED_REQUESTS_FILE, {})
-    if name in current_data:
-        del current_data[name]
-        saved_requests_data = current_data # Update global
-        save_data(SAVED_REQUESTS_FILE, current_data)
+    try:
+        with store_write_timer("saved"):
+            deleted = saved_store.delete(name)
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({"error": f"Could not delete request: {e}"}), 500
+    if deleted:
         return jsonify({"message": f"Request '{name}' deleted successfully."}), 200
     else:
         return jsonify({"error": "Saved request not found"}), 404
 
+# --- Endpoints for Environments ---
+@app.route("/environments", methods=["GET"])
+def get_environments():
+    """Returns all environments: {name: {"variables": {...}}}."""
+    etag = read_etag(ETAG_PREFIX, "environments", environment_store.version())
+    return not_modified(etag) or finish_read(jsonify(environment_store.all()), etag)
+
+@app.route("/environments/<name>", methods=["GET"])
+def get_environment(name):
+    """Returns one environment."""
+    etag = read_etag(ETAG_PREFIX, "environments", environment_store.version())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    environment = environment_store.get(name)
+    if environment is None:
+        return jsonify({"error": "Environment not found"}), 404
+    return finish_read(jsonify(environment), etag)
+
+@app.route("/environments", methods=["POST"])
+def save_environment():
+    """Creates or replaces an environment from {"name": ..., "variables": {...}}."""
+    req_data = request.get_json() or {}
+    name = req_data.get("name")
+    if not name:
+        return jsonify({"error": "Missing 'name' for environment"}), 400
+    try:
+        variables = parse_environment(req_data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        with store_write_timer("environments"):
+            environment_store.put(name, {"variables": variables})
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({"error": f"Could not save environment: {e}"}), 500
+    return jsonify({"message": f"Environment '{name}' saved successfully."}), 201
+
+@app.route("/environments/<name>", methods=["DELETE"])
+def delete_environment(name):
+    try:
+        with store_write_timer("environments"):
+            deleted = environment_store.delete(name)
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({"error": f"Could not delete environment: {e}"}), 500
+    if deleted:
+        return jsonify({"message": f"Environment '{name}' deleted successfully."}), 200
+    return jsonify({"error": "Environment not found"}), 404
+
 # --- Endpoint for History ---
 @app.route("/history", methods=["GET"])
 def get_history():
-    """Returns the request history."""
-    # Read from file each time for latest data
-    data = load_data(REQUEST_HISTORY_FILE, [])
-    return jsonify(data)
+    """Returns one page of history, newest first.
+
+    Query parameters: limit, cursor (the next_cursor of the previous page),
+    and the filters method, host, status, url_prefix and since/until
+    (ISO 8601 timestamps).
+    """
+    try:
+        limit = int(request.args.get("limit") or HISTORY_DISPLAY_SIZE)
+        before = int(request.args["cursor"]) if request.args.get("cursor") else None
+        status = int(request.args["status"]) if request.args.get("status") else None
+    except ValueError:
+        return jsonify({"error": "'limit', 'cursor' and 'status' must be integers"}), 400
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    filters = {key: request.args[key] for key in ("method", "host", "url_prefix", "since", "until")
+               if request.args.get(key)}
+    if "method" in filters:
+        filters["method"] = filters["method"].upper()
+
+    etag = read_etag(ETAG_PREFIX, "history", history_store.version())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    items = history_store.query(limit, before=before, status=status, **filters)
+    next_cursor = items[-1]["id"] if len(items) == limit else None
+    return finish_read(jsonify({"items": items, "next_cursor": next_cursor}), etag)
+
+@app.route("/history/<int:entry_id>", methods=["GET"])
+def get_history_entry(entry_id):
+    """Returns a single history entry by its id."""
+    etag = read_etag(ETAG_PREFIX, "history", history_store.version())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    entry = history_store.get(entry_id)
+    if entry is None:
+        return jsonify({"error": "History entry not found"}), 404
+    return finish_read(jsonify(entry), etag)
+
+@app.route("/history/<int:entry_id>/body", methods=["GET"])
+def get_history_body(entry_id):
+    """Returns the stored response body of a history entry.
+
+    Without parameters the whole body is streamed. With offset/length (or
+    line, a 0-based line number to start at) only that range is returned as
+    206 Partial Content, plus X-Body-Offset, X-Body-Size and X-Body-Lines
+    headers so a viewer can page through large bodies.
+    """
+    entry = history_store.get(entry_id)
+    if entry is None:
+        return jsonify({"error": "History entry not found"}), 404
+    ref = entry.get("response_body")
+    if not ref or not blob_store.exists(ref["sha256"]):
+        return jsonify({"error": "No stored response body for this entry"}), 404
+    digest = ref["sha256"]
+    mimetype = ref.get("content_type") or "application/octet-stream"
+    # Blobs are content-addressed and never change; ranges are not compressed
+    etag = digest[:32]
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    if not any(key in request.args for key in ("offset", "length", "line")):
+        return finish_read(Response(blob_store.iter_chunks(digest), mimetype=mimetype), etag)
+
+    try:
+        offset = int(request.args.get("offset") or 0)
+        length = int(request.args.get("length") or BODY_PAGE_BYTES)
+        line = int(request.args["line"]) if request.args.get("line") else None
+    except ValueError:
+        return jsonify({"error": "'offset', 'length' and 'line' must be integers"}), 400
+    length = max(1, min(length, BODY_MAX_RANGE))
+    index = blob_store.index(digest)
+    size = index["size"] if index["size"] is not None else ref.get("bytes")
+    if line is not None:
+        offset = blob_store.line_offset(digest, line)
+        if offset is None:
+            offset = size or 0 # Past the last line: answer as out of range below
+    if offset < 0 or (size is not None and offset >= size and size > 0):
+        response = jsonify({"error": "Requested range is outside the body"})
+        response.status_code = 416
+        response.headers["Content-Range"] = f"bytes */{size}"
+        return response
+
+    data = blob_store.read_range(digest, offset, length)
+    response = Response(data, status=206, mimetype=mimetype)
+    response.headers["Content-Range"] = f"bytes {offset}-{offset + max(len(data), 1) - 1}/{size if size is not None else '*'}"
+    response.headers["X-Body-Offset"] = str(offset)
+    response.headers["X-Body-Size"] = str(size) if size is not None else ""
+    response.headers["X-Body-Lines"] = str(index["lines"]) if index["lines"] is not None else ""
+    response.set_etag(etag)
+    return response
+
+# --- Endpoint for Incremental Sidebar Updates ---
+@app.route("/changes", methods=["GET"])
+def get_changes():
+    """Returns what changed in saved requests and history since a cursor.
+
+    `since` is the `cursor` of a previous answer. Saved changes map names
+    to entries, or null if deleted; history lists entries newer than the
+    cursor, newest first. Without a usable cursor (first call, restart,
+    too many changes) a part holds the full first page and "reset": true.
+    """
+    try:
+        prefix, saved_version, history_id = request.args.get("since", "").split(".")
+        saved_version, history_id = int(saved_version), int(history_id)
+        if prefix != ETAG_PREFIX:
+            raise ValueError("cursor from another store")
+    except ValueError:
+        saved_version = history_id = None
+
+    current, names = saved_store.changes_since(saved_version) if saved_version is not None else (None, None)
+    if names is None:
+        current = saved_store.version()
+        saved = {"reset": True, "items": saved_store.all()}
+    else:
+        saved = {"reset": False, "items": {name: saved_store.get(name) for name in names}}
+
+    limit = HISTORY_DISPLAY_SIZE
+    items = history_store.query(limit, after=history_id)
+    history = {"reset": history_id is None or len(items) == limit, "items": items}
+    if history["reset"]:
+        # First call, or more new entries than a page: the client replaces its list
+        history["next_cursor"] = items[-1]["id"] if len(items) == limit else None
+    # Items come newest first in insert order; ids alone don't follow it
+    # when several processes share the database
+    newest = items[0]["id"] if items else history_id or 0
+    return jsonify({"cursor": f"{ETAG_PREFIX}.{current}.{newest}", "saved": saved, "history": history})
+
+# --- Endpoint for Spilled Response Bodies ---
+@app.route("/download/<token>", methods=["GET"])
+def download_body(token):
+    """Serves the full body of a response that exceeded the preview cap."""
+    item = get_download(token)
+    if item is None or not os.path.exists(item["path"]):
+        return jsonify({"error": "Download not found or expired"}), 404
+    return send_file(item["path"], mimetype=item["content_type"], as_attachment=True,
+                     download_name=f"response-{token[:8]}")
+
+# --- Endpoint for Batch Runs ---
+@app.route("/batch", methods=["GET", "POST"])
+def batch_run():
+    """Runs a set of saved requests in parallel and streams results as SSE.
+
+    Pick requests with `names` (list) and/or `collection`, as JSON body or
+    query parameters (GET works with EventSource). Optional: `workers` and
+    `per_host`. Emits one `result` event per request as it completes, then
+    a `done` event with totals. `environment` fills in {{variables}}.
+    """
+    params = (request.get_json(silent=True) or {}) if request.method == "POST" else {}
+    names = params.get("names") or request.args.getlist("names")
+    if isinstance(names, str):
+        names = [names]
+    collection = params.get("collection") or request.args.get("collection")
+    try:
+        workers = int(params.get("workers") or request.args.get("workers") or BATCH_DEFAULT_WORKERS)
+        per_host = int(params.get("per_host") or request.args.get("per_host") or BATCH_PER_HOST_LIMIT)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'workers' and 'per_host' must be integers"}), 400
+    workers = max(1, min(workers, BATCH_MAX_WORKERS))
+    per_host = max(1, per_host)
+    try:
+        variables = load_environment(params.get("environment") or request.args.get("environment"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+
+    jobs, missing = select_saved(saved_store.all(), names, collection)
+    if missing:
+        return jsonify({"error": f"Saved requests not found: {', '.join(missing)}"}), 404
+    if not jobs:
+        return jsonify({"error": "No saved requests selected; give 'names' or a non-empty 'collection'"}), 400
+
+    def stream():
+        started = time.monotonic()
+        succeeded = failed = 0
+        yield sse_event("start", {"total": len(jobs), "workers": workers, "per_host": per_host})
+        for result in run_batch(jobs, workers, per_host, variables=variables):
+            ok = send_succeeded(result)
+            succeeded += ok
+            failed += not ok
+            yield sse_event("result", result)
+        yield sse_event("done", {"total": len(jobs), "succeeded": succeeded, "failed": failed,
+                                 "elapsed_ms": round((time.monotonic() - started) * 1000, 1)})
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # Don't let a fronting proxy buffer events
+    return response
+
+# --- Endpoints for Workflows ---
+@app.route("/workflows", methods=["GET"])
+def get_workflows():
+    """Returns all workflows: {name: {"steps": [...]}}."""
+    etag = read_etag(ETAG_PREFIX, "workflows", workflow_store.version())
+    return not_modified(etag) or finish_read(jsonify(workflow_store.all()), etag)
+
+@app.route("/workflows/<name>", methods=["GET"])
+def get_workflow(name):
+    """Returns one workflow."""
+    etag = read_etag(ETAG_PREFIX, "workflows", workflow_store.version())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    workflow = workflow_store.get(name)
+    if workflow is None:
+        return jsonify({"error": "Workflow not found"}), 404
+    return finish_read(jsonify(workflow), etag)
+
+@app.route("/workflows", methods=["POST"])
+def save_workflow():
+    """Creates or replaces a workflow from {"name": ..., "steps": [...]}, see parse_workflow()."""
+    req_data = request.get_json() or {}
+    name = req_data.get("name")
+    if not name:
+        return jsonify({"error": "Missing 'name' for workflow"}), 400
+    try:
+        workflow = parse_workflow(req_data)
+        WorkflowPlan(workflow, saved_store.all()) # Unknown requests and cycles fail on save
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        with store_write_timer("workflows"):
+            workflow_store.put(name, workflow)
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({"error": f"Could not save workflow: {e}"}), 500
+    return jsonify({"message": f"Workflow '{name}' saved successfully."}), 201
+
+@app.route("/workflows/<name>", methods=["DELETE"])
+def delete_workflow(name):
+    try:
+        with store_write_timer("workflows"):
+            deleted = workflow_store.delete(name)
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({"error": f"Could not delete workflow: {e}"}), 500
+    if deleted:
+        return jsonify({"message": f"Workflow '{name}' deleted successfully."}), 200
+    return jsonify({"error": "Workflow not found"}), 404
+
+@app.route("/workflows/<name>/run", methods=["GET", "POST"])
+def run_workflow_steps(name):
+    """Runs a workflow and streams its steps as SSE.
+
+    Emits a `step` event per step as it finishes or is skipped, then a
+    `done` event with the report of workflow_report(). Optional, as JSON
+    body or query parameters: `environment`, `workers` and `per_host`.
+    """
+    params = (request.get_json(silent=True) or {}) if request.method == "POST" else {}
+    workflow = workflow_store.get(name)
+    if workflow is None:
+        return jsonify({"error": "Workflow not found"}), 404
+    try:
+        workers = int(params.get("workers") or request.args.get("workers") or BATCH_DEFAULT_WORKERS)
+        per_host = int(params.get("per_host") or request.args.get("per_host") or WORKFLOW_PER_HOST_LIMIT)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'workers' and 'per_host' must be integers"}), 400
+    workers = max(1, min(workers, BATCH_MAX_WORKERS))
+    per_host = max(1, per_host)
+    try:
+        variables = load_environment(params.get("environment") or request.args.get("environment"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    try:
+        plan = WorkflowPlan(workflow, saved_store.all())
+    except ValueError as e:
+        return jsonify({"error": f"Invalid workflow: {e}"}), 400
+
+    def stream():
+        started = time.monotonic()
+        results = []
+        yield sse_event("start", {"workflow": name, "total": len(plan.steps), "order": plan.order})
+        for result in run_workflow(plan, workers, per_host, variables=variables):
+            results.append(result)
+            yield sse_event("step", result)
+        report = workflow_report(plan, results, time.monotonic() - started)
+        report["workflow"] = name
+        yield sse_event("done", report)
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# --- Endpoint for Metrics ---
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Exposes tool and upstream metrics in Prometheus text format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# --- Endpoint for Load Testing ---
+@app.route("/loadtest", methods=["POST"])
+def load_test():
+    """Runs a saved request under load and returns throughput and latency stats.
+
+    Closed loop by default: `concurrency` workers send back to back. With
+    mode "open" requests are sent at the rate of a profile instead, see
+    load_profile() and run_open_load_test().
+    """
+    req_data = request.get_json() or {}
+    name = req_data.get("name")
+    if not name:
+        return jsonify({"error": "Missing 'name' of saved request"}), 400
+
+    saved = saved_store.get(name)
+    if saved is None:
+        return jsonify({"error": "Saved request not found"}), 404
+    try:
+        variables = load_environment(req_data.get("environment"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+
+    if req_data.get("mode") == "open":
+        try:
+            segments = load_profile(req_data)
+            max_in_flight = int(req_data.get("concurrency") or LOADTEST_MAX_CONCURRENCY)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if not 1 <= max_in_flight <= LOADTEST_MAX_CONCURRENCY:
+            return jsonify({"error": f"'concurrency' must be between 1 and {LOADTEST_MAX_CONCURRENCY}"}), 400
+        try:
+            summary = run_open_load_test(saved, segments, max_in_flight, variables)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid saved request: {e}"}), 400
+        summary["name"] = name
+        return jsonify(summary)
+
+    try:
+        count = int(req_data["count"]) if req_data.get("count") else None
+        concurrency = int(req_data.get("concurrency") or 1)
+        duration = float(req_data["duration"]) if req_data.get("duration") else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "'count', 'concurrency' and 'duration' must be numbers"}), 400
+    if count is None and duration is None:
+        return jsonify({"error": "Provide 'count', 'duration' or both"}), 400
+    if (count is not None and count < 1) or (duration is not None and duration <= 0):
+        return jsonify({"error": "'count' and 'duration' must be positive"}), 400
+    if not 1 <= concurrency <= LOADTEST_MAX_CONCURRENCY:
+        return jsonify({"error": f"'concurrency' must be between 1 and {LOADTEST_MAX_CONCURRENCY}"}), 400
+    duration = min(duration or LOADTEST_MAX_DURATION, LOADTEST_MAX_DURATION)
+
+    try:
+        summary = run_load_test(saved, count, concurrency, duration, variables)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid saved request: {e}"}), 400
+    summary["name"] = name
+    return jsonify(summary)
+
+
+def serve_production(host, port, threads):
+    """Serves the app with a multi-threaded production WSGI server.
+
+    Uses waitress if it is installed (pip install waitress), otherwise
+    Werkzeug's threaded server without the debugger and reloader. One process
+    keeps the in-memory caches shared; the stores lock around every write.
+    SIGTERM exits through sys.exit so queued store writes are flushed.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        from waitress import serve
+    except ImportError:
+        print("waitress is not installed (pip install waitress); using Werkzeug's threaded server")
+        app.run(host=host, port=port, debug=False, threaded=True)
+        return
+    serve(app, host=host, port=port, threads=threads)
 
 
 if __name__ == "__main__":
-    print(f"Saved requests will be stored in: {os.path.abspath(SAVED_REQUESTS_FILE)}")
-    print(f"History will be stored in: {os.path.abspath(REQUEST_HISTORY_FILE)}")
-    # Set host='0.0.0.0' to make it accessible on your network (use with caution)
-    app.run(debug=True) # debug=True enables auto-reloading and error pages
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="REST Client Tool web server.")
+    parser.add_argument("--production", action="store_true",
+                        help="multi-threaded server without debugger or auto-reload")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS, help="worker threads (production mode)")
+    args = parser.parse_args()
+    if STORAGE_BACKEND == "sqlite":
+        print(f"Saved requests, environments, workflows and history will be stored in: "
+              f"{os.path.abspath(SQLITE_DB_FILE)}")
+    else:
+        print(f"Saved requests will be stored in: {os.path.abspath(SAVED_REQUESTS_FILE)}")
+        print(f"Environments will be stored in: {os.path.abspath(ENVIRONMENTS_FILE)}")
+        print(f"Workflows will be stored in: {os.path.abspath(WORKFLOWS_FILE)}")
+        print(f"History will be stored in: {os.path.abspath(REQUEST_HISTORY_DIR)}")
+    print(f"Response bodies will be stored in: {os.path.abspath(RESPONSE_BLOB_DIR)}")
+    if args.production:
+        serve_production(args.host, args.port, args.threads)
+    else:
+        app.run(host=args.host, port=args.port, debug=True) # debug=True enables auto-reloading and error pages
@@ -0,0 +1,77 @@
+"""Unit tests for the load test helpers of o4engine. Run with: python -m pytest"""
+import random
+
+import pytest
+
+from o4engine import LatencyHistogram, arrival_offsets, load_profile
+
+
+# --- arrival_offsets ---
+def test_constant_rate_is_evenly_spaced():
+    offsets = list(arrival_offsets([(2.0, 5.0, 5.0)]))
+    assert offsets == pytest.approx([0.2 * n for n in range(1, 11)])
+
+def test_ramp_follows_the_integral_of_the_rate():
+    # Rate 0 -> 10 over 2 s: n requests are due at t = sqrt(2n/5)
+    offsets = list(arrival_offsets([(2.0, 0.0, 10.0)]))
+    assert offsets == pytest.approx([(2.0 * n / 5.0) ** 0.5 for n in range(1, 11)])
+
+def test_segments_continue_where_the_previous_ended():
+    offsets = list(arrival_offsets([(1.0, 2.0, 2.0), (1.0, 4.0, 4.0)]))
+    assert offsets == pytest.approx([0.5, 1.0, 1.25, 1.5, 1.75, 2.0])
+
+def test_zero_rate_segment_sends_nothing():
+    assert list(arrival_offsets([(1.0, 0.0, 0.0), (1.0, 1.0, 1.0)])) == pytest.approx([2.0])
+
+def test_ramp_down_to_zero_stays_real_and_within_the_segment():
+    assert list(arrival_offsets(load_profile({"profile": "ramp", "start_rate": 45, "rate": 0,
+                                              "duration": 2.8})))[-1] == pytest.approx(2.8)
+    rng = random.Random(1)
+    for _ in range(20000):
+        seconds, rate = round(rng.uniform(0.1, 10), 1), round(rng.uniform(0.1, 100), 1)
+        offsets = list(arrival_offsets([(seconds, rate, 0.0)]))
+        assert all(isinstance(offset, float) and 0 < offset <= seconds for offset in offsets)
+        assert offsets == sorted(offsets)
+
+
+# --- LatencyHistogram ---
+def test_empty_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) == 0
+    assert histogram.summary_ms()["mean"] == 0
+
+def test_small_values_are_exact():
+    histogram = LatencyHistogram()
+    for micros in range(1, 11):
+        histogram.record(micros / 1_000_000)
+    assert histogram.percentile(50) == 5
+    assert histogram.percentile(100) == 10
+    assert (histogram.min, histogram.max, histogram.total, histogram.sum) == (1, 10, 10, 55)
+
+def test_large_values_are_within_the_bucket_precision():
+    histogram = LatencyHistogram()
+    rng = random.Random(2)
+    values = sorted(rng.randint(1, 10_000_000) for _ in range(10000))
+    for micros in values:
+        histogram.record(micros / 1_000_000)
+    for pct in (50, 90, 99, 99.9):
+        expected = values[max(1, round(len(values) * pct / 100.0)) - 1]
+        assert histogram.percentile(pct) == pytest.approx(expected, rel=1.0 / LatencyHistogram.SUB_BUCKETS)
+
+def test_percentile_never_exceeds_the_maximum():
+    histogram = LatencyHistogram()
+    histogram.record(0.000128) # Slot 128-129, whose midpoint is 129
+    assert histogram.percentile(99.9) == histogram.max == 128
+
+def test_values_past_the_top_bucket_are_clamped():
+    histogram = LatencyHistogram()
+    histogram.record(10 ** 9)
+    histogram.record(-1)
+    assert histogram.counts[-1] == 1 and histogram.min == 0
+
+def test_summary_is_in_milliseconds():
+    histogram = LatencyHistogram()
+    histogram.record(0.002)
+    histogram.record(0.004)
+    summary = histogram.summary_ms()
+    assert summary["min"] == 2.0 and summary["max"] == 4.0 and summary["mean"] == 3.0